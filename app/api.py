@@ -1,14 +1,29 @@
 """
 API for video streaming that stores the video as chunks in redis and serves the video after re-assembling the chunks.
 """
-from fastapi import FastAPI, File, Request, UploadFile
+from typing import Optional
+
+from fastapi import FastAPI, File, Form, Request, UploadFile
 from fastapi.exceptions import HTTPException
-from fastapi.responses import FileResponse, RedirectResponse
+from fastapi.responses import (
+    PlainTextResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
 
+import byterange
+import cache
+import config
 import delete
 import egress
 import information
 import ingress
+import jobs
+import manifest
+import progress
+import tier
+import videoindex
 import videolist
 
 app = FastAPI()
@@ -20,6 +35,20 @@ app = FastAPI(
 )
 
 
+@app.on_event("startup")
+def start_background_tasks():
+    """
+    Sweep the cache at startup and keep sweeping it in the background,
+    listen for invalidations of the cached video metadata and demote the
+    videos that are not watched to the cold tier. The ingest jobs left
+    unfinished by dead worker processes are recovered.
+    """
+    cache.start_sweeper()
+    information.start_invalidation_listener()
+    tier.start_sweeper()
+    jobs.start_heartbeat()
+
+
 @app.exception_handler(404)
 async def not_found_exception_handler(request: Request, exc: HTTPException):
     """
@@ -29,47 +58,148 @@ async def not_found_exception_handler(request: Request, exc: HTTPException):
 
 
 @app.post("/video/ingest")
-def ingest_video(video: UploadFile = File(...)):
+def ingest_video(
+    video: UploadFile = File(...), chunk_seconds: Optional[int] = Form(None)
+):
     """
-    Ingest video file. Returns video metadata.
+    Ingest video file. The video is processed in the background,
+    returns the video ID to poll the ingest status with.
+    chunk_seconds is the length of the chunks the video is stored as,
+    CHUNK_SECONDS by default.
     """
+    if chunk_seconds is not None and not 1 <= chunk_seconds <= config.MAX_CHUNK_SECONDS:
+        video.file.close()
+        return {
+            "message": f"Invalid chunk_seconds value chunk_seconds must be between 1 and {config.MAX_CHUNK_SECONDS}"
+        }
+
     video_id = ingress.get_new_video_id()
     video_file_ingest_path = ingress.get_video_ingest_path(video_id)
     file_name = video.filename
 
     try:
-        contents = video.file.read()
-        with open(video_file_ingest_path, "wb") as upload_file:
-            upload_file.write(contents)
+        upload_information = ingress.save_uploaded_video(
+            video.file, video_file_ingest_path
+        )
     except Exception:
+        ingress.delete_video_ingress_directory(video_id)
         return {"message": "There was an error ingesting the file"}
     finally:
         video.file.close()
 
-    data = ingress.ingress(video_file_ingest_path, video_id, file_name)
-    data["message"] = "Video ingested successfully"
+    if "error" in upload_information:
+        ingress.delete_video_ingress_directory(video_id)
+        return {"message": upload_information["error"]}
+
+    if chunk_seconds is not None:
+        upload_information["chunk_seconds"] = chunk_seconds
 
-    return data
+    jobs.submit_ingest_job(
+        video_file_ingest_path, video_id, file_name, upload_information
+    )
+
+    return {
+        "video_id": video_id,
+        "job_id": video_id,
+        "status_url": f"/video/{video_id}/status",
+        "message": "Video ingest started",
+    }
 
 
 @app.get("/video/all")
-def list_all_videos():
+async def list_all_videos(
+    cursor: int = 0,
+    limit: int = config.VIDEO_LIST_PAGE_SIZE,
+    sort: Optional[str] = None,
+    order: str = "asc",
+    min_duration: Optional[float] = None,
+    max_duration: Optional[float] = None,
+    min_fps: Optional[float] = None,
+    max_fps: Optional[float] = None,
+    resolution: Optional[str] = None,
+    audio_codec: Optional[str] = None,
+    has_audio: Optional[bool] = None,
+):
+    """
+    Get video metadata, a page of about limit videos at a time.
+    Pass the next_cursor of a page as cursor to get the next page,
+    it is null after the last page.
+
+    The videos can be sorted by timestamp, duration or fps, in asc or desc
+    order, and filtered by duration, fps, resolution, audio codec and
+    whether they have audio. Sorted or filtered pages have exactly limit
+    videos and the total number of matching videos.
+    """
+    if cursor < 0 or not 1 <= limit <= config.VIDEO_LIST_MAX_PAGE_SIZE:
+        return {
+            "message": f"Invalid cursor and limit values cursor must be >= 0 and limit must be between 1 and {config.VIDEO_LIST_MAX_PAGE_SIZE}"
+        }
+
+    ranges = {
+        field: (
+            "-inf" if minimum is None else minimum,
+            "+inf" if maximum is None else maximum,
+        )
+        for field, minimum, maximum in (
+            ("duration", min_duration, max_duration),
+            ("fps", min_fps, max_fps),
+        )
+        if minimum is not None or maximum is not None
+    }
+    filters = {
+        field: value
+        for field, value in (("resolution", resolution), ("audio_codec", audio_codec))
+        if value is not None
+    }
+    if sort is None and not ranges and not filters and has_audio is None:
+        return StreamingResponse(
+            videolist.stream_video_information(cursor, limit),
+            media_type="application/json",
+        )
+
+    sort = sort or "timestamp"
+    if sort not in videoindex.SORTED_FIELDS or order not in ("asc", "desc"):
+        return {
+            "message": f"Invalid sort and order values sort must be one of {', '.join(videoindex.SORTED_FIELDS)} and order must be asc or desc"
+        }
+
+    return StreamingResponse(
+        videolist.stream_indexed_video_information(
+            sort, order == "desc", ranges, filters, has_audio, cursor, limit
+        ),
+        media_type="application/json",
+    )
+
+
+@app.get("/cache/stats")
+def get_cache_stats():
     """
-    Get all video metadata.
+    Get the cache hit, miss and eviction counters and the cache size.
     """
-    return videolist.get_all_video_information()
+    return cache.get_cache_stats()
 
 
 @app.get("/video/{video_id}.webm")
-def egest_video(video_id: str, start: int = 0, end: int = -1):
+@information.request_scoped
+async def egest_video(
+    request: Request,
+    video_id: str,
+    start: int = 0,
+    end: int = -1,
+    rendition: Optional[str] = None,
+    max_bitrate: Optional[int] = None,
+):
     """
     Get video file.
     Start and end are in seconds. Start and end are optional.
     Start and end are inclusive.
+    Byte ranges of the video can be requested with the Range header.
+    A rendition can be requested by name, or the rendition with the highest
+    bitrate up to max_bitrate in bits per second, the source by default.
     """
 
     # check if video exists
-    video_information = information.get_video_information(video_id)
+    video_information = await information.get_video_information_async(video_id)
     if not video_information:
         return {"message": "Video not found"}
 
@@ -88,29 +218,233 @@ def egest_video(video_id: str, start: int = 0, end: int = -1):
             "message": f"Invalid start and end values start and end must be <= video duration. Video duration is {video_information['duration']}"
         }
 
+    if max_bitrate is not None and max_bitrate < 1:
+        return {"message": "Invalid max_bitrate value max_bitrate must be >= 1"}
+
+    rendition_name = egress.select_rendition(video_information, rendition, max_bitrate)
+    if not rendition_name:
+        return {"message": "Rendition not found"}
+
     # check cache before making request to redis
-    cached_video = egress.requested_video_in_cache(video_id, start, end)
+    cached_video = await egress.requested_video_in_cache(
+        video_id, start, end, rendition_name
+    )
     if cached_video:
-        return FileResponse(cached_video)
+        try:
+            response = byterange.file_response(
+                cached_video, request.headers.get("range")
+            )
+        except FileNotFoundError:
+            # the sweeper evicted the video since it was found in the cache
+            response = None
+        if response is not None:
+            # videos served from the cache are accessed too, they are not demoted
+            await cache.record_hit(cached_video)
+            await tier.record_access(video_id)
+            return response
 
-    requested_video_file_path = egress.egress(video_id, start, end)
-    return FileResponse(requested_video_file_path)
+    await cache.record_miss()
+
+    if config.EGRESS_MODE == "stream" and not request.headers.get("range"):
+        # stream the video unless another request is already streaming the
+        # same video into the cache, then wait until it is muxed and serve the cache
+        lock = await egress.acquire_egress_lock(
+            video_id, start, end, blocking=False, rendition_name=rendition_name
+        )
+        if lock or not config.EGRESS_STREAM_TO_CACHE:
+            return StreamingResponse(
+                egress.stream_egress(video_id, start, end, lock, rendition_name),
+                media_type="video/webm",
+            )
+
+    # the byte offsets of the containerized video are only known once it is
+    # assembled, so the first range request assembles it into the cache and
+    # the following range requests are served from the cache
+    requested_video_file_path = await egress.coalesced_egress(
+        video_id, start, end, rendition_name
+    )
+    if not requested_video_file_path:
+        return {"message": "Could not egress the video"}
+    return byterange.file_response(
+        requested_video_file_path, request.headers.get("range")
+    )
+
+
+@app.get("/video/{video_id}/hls/master.m3u8")
+@information.request_scoped
+async def get_hls_master_playlist(video_id: str, max_bitrate: Optional[int] = None):
+    """
+    Get the HLS master playlist of the video, with every rendition or with
+    the renditions up to max_bitrate in bits per second.
+    """
+    video_information = await information.get_video_information_async(video_id)
+    if not video_information:
+        return {"message": "Video not found"}
+
+    if max_bitrate is not None and max_bitrate < 1:
+        return {"message": "Invalid max_bitrate value max_bitrate must be >= 1"}
+
+    return PlainTextResponse(
+        manifest.generate_master_playlist(video_information, max_bitrate),
+        media_type=manifest.MEDIA_TYPE,
+    )
+
+
+@app.get("/video/{video_id}/hls/video.m3u8")
+@information.request_scoped
+async def get_hls_video_playlist(video_id: str, rendition: Optional[str] = None):
+    """
+    Get the HLS media playlist of the video track of a rendition, the source
+    by default, one segment per chunk.
+    """
+    video_information = await information.get_video_information_async(video_id)
+    if not video_information:
+        return {"message": "Video not found"}
+
+    rendition_name = egress.select_rendition(video_information, rendition, None)
+    if not rendition_name:
+        return {"message": "Rendition not found"}
+
+    segment_durations = await manifest.get_segment_durations(video_id)
+    return PlainTextResponse(
+        manifest.generate_media_playlist(
+            segment_durations,
+            "video",
+            manifest.get_rendition_query(rendition_name),
+        ),
+        media_type=manifest.MEDIA_TYPE,
+    )
+
+
+@app.get("/video/{video_id}/hls/audio.m3u8")
+@information.request_scoped
+async def get_hls_audio_playlist(video_id: str):
+    """
+    Get the HLS media playlist of the audio track, one segment per chunk.
+    """
+    video_information = await information.get_video_information_async(video_id)
+    if not video_information or not video_information.get("audio_codec"):
+        return {"message": "Audio not found"}
+
+    segment_durations = await manifest.get_segment_durations(video_id)
+    return PlainTextResponse(
+        manifest.generate_media_playlist(segment_durations, "audio"),
+        media_type=manifest.MEDIA_TYPE,
+    )
+
+
+@app.get("/video/{video_id}/hls/video/init.mp4")
+@information.request_scoped
+async def get_hls_video_init_segment(video_id: str, rendition: Optional[str] = None):
+    """
+    Get the initialization segment of the video segments of a rendition, the
+    source by default.
+    """
+    if rendition:
+        video_information = await information.get_video_information_async(video_id)
+        if not video_information or not egress.select_rendition(
+            video_information, rendition, None
+        ):
+            return {"message": "Segment not found"}
+
+    segment = await egress.get_video_init_segment(video_id, rendition)
+    if segment is None:
+        return {"message": "Segment not found"}
+
+    return Response(segment, media_type="video/mp4")
+
+
+@app.get("/video/{video_id}/hls/video/{chunk_number}.m4s")
+@information.request_scoped
+async def get_hls_video_segment(
+    video_id: str, chunk_number: int, rendition: Optional[str] = None
+):
+    """
+    Get a video segment of a rendition, the source by default, a fragmented
+    MP4 chunk starting at its start time in the video.
+    """
+    if rendition:
+        video_information = await information.get_video_information_async(video_id)
+        if not video_information or not egress.select_rendition(
+            video_information, rendition, None
+        ):
+            return {"message": "Segment not found"}
+
+    segment = await egress.get_video_segment(video_id, chunk_number, rendition)
+    if segment is None:
+        return {"message": "Segment not found"}
+
+    return Response(segment, media_type="video/iso.segment")
+
+
+@app.get("/video/{video_id}/hls/audio/init.mp4")
+@information.request_scoped
+async def get_hls_audio_init_segment(video_id: str):
+    """
+    Get the initialization segment of the audio segments.
+    """
+    video_information = await information.get_video_information_async(video_id)
+    if not video_information or not video_information.get("audio_codec"):
+        return {"message": "Segment not found"}
+
+    segment = await egress.get_audio_init_segment(video_id)
+    if segment is None:
+        return {"message": "Segment not found"}
+
+    return Response(segment, media_type="audio/mp4")
+
+
+@app.get("/video/{video_id}/hls/audio/{chunk_number}.m4s")
+@information.request_scoped
+async def get_hls_audio_segment(video_id: str, chunk_number: int):
+    """
+    Get the audio segment of a chunk, a fragmented MP4 chunk starting at its
+    start time in the video.
+    """
+    video_information = await information.get_video_information_async(video_id)
+    if not video_information or not video_information.get("audio_codec"):
+        return {"message": "Segment not found"}
+
+    segment = await egress.get_audio_segment(video_id, chunk_number)
+    if segment is None:
+        return {"message": "Segment not found"}
+
+    return Response(segment, media_type="audio/mp4")
 
 
 @app.get("/video/{video_id}/information")
-def get_video_information(video_id: str):
+async def get_video_information(video_id: str):
     """
     Get video metadata.
     """
 
-    video_information = information.get_video_information(video_id)
+    video_information = await information.get_video_information_async(video_id)
     if video_information:
         return video_information
 
     return {"message": "Video not found"}
 
 
+@app.get("/video/{video_id}/status")
+async def get_video_ingest_status(video_id: str):
+    """
+    Get the ingest stage and progress of a video.
+    """
+
+    ingest_progress = await progress.get_ingest_progress_async(video_id)
+    if ingest_progress:
+        ingest_progress.pop("worker", None)
+        return ingest_progress
+
+    # videos ingested before the progress was tracked
+    if await information.get_video_information_async(video_id):
+        return {"video_id": video_id, "stage": "ready"}
+
+    return {"message": "Video not found"}
+
+
 @app.delete("/video/{video_id}")
+@information.request_scoped
 def delete_video(video_id: str):
     """
     Delete video and all its metadata, audio and video chunks.
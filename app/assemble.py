@@ -3,34 +3,43 @@ Module for assembling videos.
 Concatenate videos using the concat demuxer.
 """
 
-import subprocess
+import asyncio
 from typing import List
 
 
-def concatenate_videos(
+def write_concat_list(video_files: List[str], video_input_txt_path: str) -> None:
+    """
+    Write the list of videos to concatenate for the concat demuxer.
+    """
+    with open(video_input_txt_path, "w", encoding="utf-8") as txt_file:
+        for video in video_files:
+            txt_file.write(f"file '{video}'\n")
+
+
+async def concatenate_videos(
     video_files: List[str], output_file: str, video_input_txt_path: str
 ):
     """
     Concatenate videos using the concat demuxer.
+    The videos can be files or subfile URLs of chunks in packed files.
     """
 
     # Create a text file with a list of videos to concatenate
-    with open(video_input_txt_path, "w", encoding="utf-8") as txt_file:
-        for video in video_files:
-            txt_file.write(f"file '{video}'\n")
+    write_concat_list(video_files, video_input_txt_path)
 
     # Concatenate the videos using the concat demuxer
-    subprocess.call(
-        [
-            "ffmpeg",
-            "-f",
-            "concat",
-            "-safe",
-            "0",
-            "-i",
-            video_input_txt_path,
-            "-c",
-            "copy",
-            output_file,
-        ]
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg",
+        "-f",
+        "concat",
+        "-safe",
+        "0",
+        "-protocol_whitelist",
+        "file,subfile",
+        "-i",
+        video_input_txt_path,
+        "-c",
+        "copy",
+        output_file,
     )
+    return await process.wait()
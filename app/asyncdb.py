@@ -0,0 +1,281 @@
+"""
+Async database module. Contains async functions to interact with Redis.
+
+The endpoints use these functions, so waiting for redis does not hold a
+worker thread. The ingest jobs run in background threads and use the
+synchronous functions of the db module.
+"""
+
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+import redis.asyncio as aioredis
+from redis.asyncio.lock import Lock
+
+import config
+import packed
+import shard
+import unique
+
+
+def connect(host: str, port: int) -> aioredis.Redis:
+    """
+    Connect to a redis node, requests wait for a free connection when all
+    REDIS_MAX_CONNECTIONS connections of its pool are in use.
+    """
+    pool = aioredis.BlockingConnectionPool(
+        host=host,
+        port=port,
+        db=0,
+        max_connections=config.REDIS_MAX_CONNECTIONS,
+        timeout=config.REDIS_POOL_TIMEOUT,
+    )
+    return aioredis.Redis(connection_pool=pool)
+
+
+# Connect to Redis
+r = connect(config.REDIS_HOST, 6379)
+
+# Connect to the redis nodes that store the video data, one pool per node
+nodes = [connect(host, port) for host, port in shard.NODES]
+
+
+def get_node(video_id: str) -> aioredis.Redis:
+    """
+    Get the redis node that stores the data of a video.
+    """
+    return nodes[shard.get_node_index(video_id)]
+
+
+def get_lock(name: str, timeout: int) -> Lock:
+    """
+    Get a redis lock, shared by all the worker processes.
+    """
+    return r.lock(name, timeout=timeout, thread_local=False)
+
+
+async def publish(channel: str, message: str) -> bool:
+    """
+    Publish a message on redis pub/sub channel.
+    """
+    try:
+        await r.publish(channel, message)
+        return True
+    except Exception:
+        return False
+
+
+async def get_video_metadata_from_redis_hash(video_id: str, hash_name: str) -> Dict:
+    """
+    Get video metadata from redis hash.
+    """
+    try:
+        return json.loads(await r.hget(name=hash_name, key=video_id))
+    except Exception:
+        return {}
+
+
+async def scan_redis_hash(
+    hash_name: str, cursor: int, count: int
+) -> Tuple[int, Dict[bytes, bytes]]:
+    """
+    Get about count fields of redis hash with HSCAN, starting at cursor.
+    Returns the cursor of the next fields, 0 after the last fields.
+    """
+    try:
+        return await r.hscan(name=hash_name, cursor=cursor, count=count)
+    except Exception:
+        return 0, {}
+
+
+async def get_redis_hash_fields(hash_name: str, keys: List[str]) -> List:
+    """
+    Get the given fields of redis hash, None for the missing fields.
+    """
+    if not keys:
+        return []
+    try:
+        return await r.hmget(hash_name, keys)
+    except Exception:
+        return [None] * len(keys)
+
+
+async def query_video_indexes(
+    index_name: str,
+    descending: bool,
+    index_ranges: Dict[str, Tuple[float, float]],
+    index_sets: List[str],
+    excluded_sets: List[str],
+    offset: int,
+    count: int,
+) -> Tuple[List[str], int]:
+    """
+    Get count video IDs from offset of the sorted set index_name, keeping
+    only the videos within the score ranges of the other sorted sets, in all
+    index_sets and in none of excluded_sets.
+
+    The filters are applied in redis with ZRANGESTORE, ZINTERSTORE and
+    ZDIFFSTORE into temporary keys, in one transaction. Returns the video
+    IDs ordered by their index_name score and the number of matching videos.
+    """
+    try:
+        pipe = r.pipeline(transaction=True)
+        if not index_ranges and not index_sets and not excluded_sets:
+            pipe.zrange(index_name, offset, offset + count - 1, desc=descending)
+            pipe.zcard(index_name)
+            video_ids, total = await pipe.execute()
+            return [video_id.decode() for video_id in video_ids], total
+
+        query_name = f"{index_name}_query_{unique.get_new_fetch_id()}"
+        range_names = []
+        weights = {index_name: 1}
+        for range_index_name, (minimum, maximum) in index_ranges.items():
+            range_name = f"{query_name}_{len(range_names)}"
+            pipe.zrangestore(
+                range_name, range_index_name, minimum, maximum, byscore=True
+            )
+            range_names.append(range_name)
+            weights[range_name] = 0
+        for index_set in index_sets:
+            weights[index_set] = 0
+        pipe.zinterstore(query_name, weights)
+        if excluded_sets:
+            pipe.zdiffstore(query_name, [query_name] + excluded_sets)
+        pipe.zrange(query_name, offset, offset + count - 1, desc=descending)
+        pipe.zcard(query_name)
+        pipe.delete(query_name, *range_names)
+        video_ids, total, _ = (await pipe.execute())[-3:]
+        return [video_id.decode() for video_id in video_ids], total
+    except Exception:
+        return [], 0
+
+
+async def increment_redis_hash_field(hash_name: str, key: str, amount: int = 1) -> bool:
+    """
+    Increment an integer field of redis hash.
+    """
+    try:
+        await r.hincrby(name=hash_name, key=key, amount=amount)
+        return True
+    except Exception:
+        return False
+
+
+async def set_redis_hash_field(hash_name: str, key: str, value: str) -> bool:
+    """
+    Set a field of redis hash.
+    """
+    try:
+        await r.hset(name=hash_name, key=key, value=value)
+        return True
+    except Exception:
+        return False
+
+
+async def get_chunks_by_chunk_ids(
+    video_id: str, stream_name: str, index_name: str, chunk_ids: List[str]
+) -> List:
+    """
+    Get only the given chunks from redis stream.
+
+    The entry IDs are looked up in the chunk index hash and the entries are
+    read with pipelined single entry XRANGE commands. Streams stored before
+    the chunk index existed fall back to reading the whole stream, chunks
+    missing from the index of an indexed stream are left out.
+    """
+    try:
+        node = get_node(video_id)
+        pipe = node.pipeline(transaction=False)
+        pipe.exists(index_name)
+        pipe.hmget(index_name, chunk_ids)
+        index_exists, entry_ids = await pipe.execute()
+        if not index_exists:
+            return await node.xrange(name=stream_name, min="-", max="+")
+        if not any(entry_ids):
+            return []
+
+        pipe = node.pipeline(transaction=False)
+        for entry_id in entry_ids:
+            if entry_id:
+                pipe.xrange(name=stream_name, min=entry_id, max=entry_id)
+        return [entry for entries in await pipe.execute() for entry in entries]
+    except Exception:
+        return []
+
+
+async def get_indexed_chunk_ids(
+    video_id: str, track: str, chunk_ids: List[str]
+) -> Optional[List[str]]:
+    """
+    Get the given chunk IDs of a video track or the audio track that are in
+    its chunk index, in order, without reading the chunks.
+
+    Returns None for streams stored before the chunk index existed and for
+    chunks stored in packed files, which have no chunk index.
+    """
+    if config.CHUNK_BACKEND == "packed":
+        return None
+    index_name = shard.get_key(f"{track}_chunk_index", video_id)
+    try:
+        pipe = get_node(video_id).pipeline(transaction=False)
+        pipe.exists(index_name)
+        pipe.hmget(index_name, chunk_ids)
+        index_exists, entry_ids = await pipe.execute()
+    except Exception:
+        return []
+    if not index_exists:
+        return None
+    return [chunk_id for chunk_id, entry_id in zip(chunk_ids, entry_ids) if entry_id]
+
+
+async def get_video_chunks_by_chunk_ids(
+    video_id: str, chunk_ids: List[str], track: str = "video"
+) -> List:
+    """
+    Get only the given video chunks of the video track of a rendition from
+    redis stream.
+    """
+    if config.CHUNK_BACKEND == "packed":
+        return packed.get_chunks_by_chunk_ids(video_id, track, chunk_ids)
+    return await get_chunks_by_chunk_ids(
+        video_id,
+        shard.get_key(track, video_id),
+        shard.get_key(f"{track}_chunk_index", video_id),
+        chunk_ids,
+    )
+
+
+async def get_audio_chunks_by_chunk_ids(video_id: str, chunk_ids: List[str]) -> List:
+    """
+    Get only the given audio chunks from redis stream.
+    """
+    if config.CHUNK_BACKEND == "packed":
+        return packed.get_chunks_by_chunk_ids(video_id, "audio", chunk_ids)
+    return await get_chunks_by_chunk_ids(
+        video_id,
+        shard.get_key("audio_chunks", video_id),
+        shard.get_key("audio_chunk_index", video_id),
+        chunk_ids,
+    )
+
+
+async def get_video_chunk_count(video_id: str) -> int:
+    """
+    Get the number of video chunks in redis stream.
+    """
+    if config.CHUNK_BACKEND == "packed":
+        return packed.get_chunk_count(video_id, "video")
+    try:
+        return await get_node(video_id).xlen(shard.get_key("video", video_id))
+    except Exception:
+        return 0
+
+
+async def get_audio(video_id: str) -> Any:
+    """
+    Get audio redis
+    """
+    try:
+        return await get_node(video_id).get(shard.get_key("audio", video_id))
+    except Exception:
+        return None
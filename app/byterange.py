@@ -0,0 +1,105 @@
+"""
+Module for serving byte ranges of files, as requested with the HTTP Range header.
+"""
+
+import os
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+from fastapi.responses import Response, StreamingResponse
+
+import config
+
+
+def parse_range_header(range_header: str, file_size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a HTTP Range header of the form bytes=start-end, bytes=start- or
+    bytes=-suffix_length.
+
+    Returns the first and the last byte of the range, both inclusive.
+    Returns None if the header is missing, malformed or asks for more than
+    one range, in that case the whole file should be served.
+    Raises ValueError if the range can not be satisfied.
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+
+    byte_range = range_header[len("bytes=") :].strip()
+    if "," in byte_range or "-" not in byte_range:
+        return None
+
+    first, last = (value.strip() for value in byte_range.split("-", 1))
+    if not (first.isdigit() or first == "") or not (last.isdigit() or last == ""):
+        return None
+
+    if first == "":
+        if last == "" or int(last) == 0:
+            raise ValueError(f"Invalid suffix range {range_header}")
+        # bytes=-500 is the last 500 bytes of the file
+        return max(file_size - int(last), 0), file_size - 1
+
+    first_byte = int(first)
+    if last and int(last) < first_byte:
+        return None
+    last_byte = min(int(last), file_size - 1) if last else file_size - 1
+    if first_byte >= file_size:
+        raise ValueError(f"Range {range_header} is not satisfiable")
+
+    return first_byte, last_byte
+
+
+def read_file_range(file: BinaryIO, first_byte: int, last_byte: int) -> Iterator[bytes]:
+    """
+    Read the bytes from first_byte to last_byte of an open file in buffers of
+    EGRESS_BUFFER_SIZE bytes, and close it.
+    """
+    remaining = last_byte - first_byte + 1
+    with file:
+        file.seek(first_byte)
+        while remaining > 0:
+            buffer = file.read(min(config.EGRESS_BUFFER_SIZE, remaining))
+            if not buffer:
+                break
+            remaining -= len(buffer)
+            yield buffer
+
+
+def file_response(
+    file_path: str, range_header: Optional[str], media_type: str = "video/webm"
+) -> Response:
+    """
+    Serve a file, or the requested byte range of it with 206 Partial Content.
+
+    The file is opened before the response is returned, so it is served
+    whole even if it is deleted meanwhile, like a cached video evicted by
+    the sweeper. Raises FileNotFoundError if the file does not exist.
+    """
+    file = open(file_path, "rb")
+    file_size = os.fstat(file.fileno()).st_size
+
+    try:
+        byte_range = parse_range_header(range_header, file_size)
+    except ValueError:
+        file.close()
+        return Response(
+            status_code=416,
+            headers={"Accept-Ranges": "bytes", "Content-Range": f"bytes */{file_size}"},
+        )
+
+    if byte_range is None:
+        return StreamingResponse(
+            read_file_range(file, 0, file_size - 1),
+            media_type=media_type,
+            headers={"Accept-Ranges": "bytes", "Content-Length": str(file_size)},
+        )
+
+    first_byte, last_byte = byte_range
+    return StreamingResponse(
+        read_file_range(file, first_byte, last_byte),
+        status_code=206,
+        media_type=media_type,
+        headers={
+            "Accept-Ranges": "bytes",
+            "Content-Range": f"bytes {first_byte}-{last_byte}/{file_size}",
+            "Content-Length": str(last_byte - first_byte + 1),
+        },
+    )
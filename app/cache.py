@@ -0,0 +1,180 @@
+"""
+Module for managing the egress cache directory.
+
+Cached videos are evicted when they are older than CACHE_TTL seconds, and
+the least recently (lru) or least frequently (lfu) used videos are evicted
+when the cache is larger than CACHE_MAX_BYTES. The hit, miss and eviction
+counters and the use counts are kept in redis, so they are shared by all
+the worker processes.
+"""
+
+import os
+import shutil
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import asyncdb
+import config
+import db
+
+
+def get_cache_key(cache_video_path: str) -> str:
+    """
+    Get the key of a cached video, its path relative to the cache directory.
+    """
+    return os.path.relpath(cache_video_path, config.CACHE_PATH)
+
+
+async def record_hit(cache_video_path: str) -> None:
+    """
+    Record a cache hit, the access time of the file is used by lru eviction.
+    """
+    try:
+        os.utime(cache_video_path, (time.time(), os.stat(cache_video_path).st_mtime))
+    except FileNotFoundError:
+        pass
+    await asyncdb.increment_redis_hash_field(config.REDIS_CACHE_STATS_HASH_NAME, "hits")
+    await asyncdb.increment_redis_hash_field(
+        config.REDIS_CACHE_USE_COUNT_HASH_NAME, get_cache_key(cache_video_path)
+    )
+
+
+async def record_miss() -> None:
+    """
+    Record a cache miss.
+    """
+    await asyncdb.increment_redis_hash_field(
+        config.REDIS_CACHE_STATS_HASH_NAME, "misses"
+    )
+
+
+def get_cache_stats() -> Dict:
+    """
+    Get the cache counters and the current size of the cache.
+    """
+    stats = {"hits": 0, "misses": 0, "evictions": 0}
+    stats.update(
+        {
+            key: int(value)
+            for key, value in db.get_redis_hash(
+                config.REDIS_CACHE_STATS_HASH_NAME
+            ).items()
+        }
+    )
+    cached_videos = get_cached_videos()
+    stats["files"] = len(cached_videos)
+    stats["bytes"] = sum(size for _, size, _, _ in cached_videos)
+    stats["max_bytes"] = config.CACHE_MAX_BYTES
+    return stats
+
+
+def get_cached_videos() -> List[Tuple[str, int, float, float]]:
+    """
+    Get the path, size, access time and modification time of every cached video.
+    """
+    cached_videos = []
+    for directory, _, file_names in os.walk(config.CACHE_PATH):
+        for file_name in file_names:
+            path = os.path.join(directory, file_name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            cached_videos.append((path, stat.st_size, stat.st_atime, stat.st_mtime))
+    return cached_videos
+
+
+def evict(cache_video_path: str) -> None:
+    """
+    Remove a video from the cache.
+    """
+    try:
+        os.remove(cache_video_path)
+    except FileNotFoundError:
+        return
+    db.increment_redis_hash_field(config.REDIS_CACHE_STATS_HASH_NAME, "evictions")
+    db.delete_redis_hash_fields(
+        config.REDIS_CACHE_USE_COUNT_HASH_NAME, [get_cache_key(cache_video_path)]
+    )
+
+
+def sweep() -> int:
+    """
+    Evict the expired videos, then evict videos until the cache fits in
+    CACHE_MAX_BYTES.
+
+    Returns the number of evicted videos.
+    """
+    cached_videos = get_cached_videos()
+    evicted = 0
+
+    if config.CACHE_TTL:
+        expired_before = time.time() - config.CACHE_TTL
+        for cached_video in list(cached_videos):
+            if cached_video[3] < expired_before:
+                evict(cached_video[0])
+                cached_videos.remove(cached_video)
+                evicted += 1
+
+    cache_size = sum(size for _, size, _, _ in cached_videos)
+    if config.CACHE_MAX_BYTES and cache_size > config.CACHE_MAX_BYTES:
+        if config.CACHE_EVICTION_POLICY == "lfu":
+            use_counts = db.get_redis_hash(config.REDIS_CACHE_USE_COUNT_HASH_NAME)
+            cached_videos.sort(
+                key=lambda cached_video: (
+                    int(use_counts.get(get_cache_key(cached_video[0]), 0)),
+                    cached_video[2],
+                )
+            )
+        else:
+            cached_videos.sort(key=lambda cached_video: cached_video[2])
+
+        for path, size, _, _ in cached_videos:
+            if cache_size <= config.CACHE_MAX_BYTES:
+                break
+            evict(path)
+            cache_size -= size
+            evicted += 1
+
+    return evicted
+
+
+def purge_video(video_id: str) -> None:
+    """
+    Remove all the cached files of a video, with those of its renditions.
+    """
+    cache_directory = os.path.join(config.CACHE_PATH, video_id)
+    if not os.path.isdir(cache_directory):
+        return
+
+    db.delete_redis_hash_fields(
+        config.REDIS_CACHE_USE_COUNT_HASH_NAME,
+        [
+            get_cache_key(os.path.join(directory, file_name))
+            for directory, _, file_names in os.walk(cache_directory)
+            for file_name in file_names
+        ],
+    )
+    shutil.rmtree(cache_directory, ignore_errors=True)
+
+
+def run_sweeper() -> None:
+    """
+    Sweep the cache every CACHE_SWEEP_INTERVAL seconds.
+    """
+    while True:
+        time.sleep(config.CACHE_SWEEP_INTERVAL)
+        try:
+            sweep()
+        except Exception as err:
+            print("error while sweeping the cache: ", err)
+
+
+def start_sweeper() -> None:
+    """
+    Sweep the cache once and start sweeping it in a background thread.
+    """
+    sweep()
+    if config.CACHE_SWEEP_INTERVAL:
+        threading.Thread(target=run_sweeper, daemon=True).start()
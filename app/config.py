@@ -23,6 +23,42 @@ EGRESS_PATH = os.path.join(BASE_TMPFS_VIDEO_PATH, "egress")
 # If it is not we process the request and store it in the cache.
 CACHE_PATH = os.path.join(BASE_TMPFS_VIDEO_PATH, "cache")
 
+# Uploads are copied to the ingress directory in buffers of this many bytes,
+# uploads larger than MAX_UPLOAD_SIZE bytes are rejected (0 means no limit).
+UPLOAD_BUFFER_SIZE = int(os.getenv("UPLOAD_BUFFER_SIZE", str(1024 * 1024)))
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(5 * 1024 * 1024 * 1024)))
+
+# Files and byte ranges of files are served in buffers of this many bytes.
+EGRESS_BUFFER_SIZE = int(os.getenv("EGRESS_BUFFER_SIZE", str(1024 * 1024)))
+
+# "stream" sends the video to the client while it is being muxed, "file"
+# assembles the whole video in the cache directory before sending it.
+# Requests with a Range header are always served from a file.
+EGRESS_MODE = os.getenv("EGRESS_MODE", "stream")
+
+# Also save streamed videos to the cache directory.
+EGRESS_STREAM_TO_CACHE = os.getenv("EGRESS_STREAM_TO_CACHE", "1") == "1"
+
+# Streamed videos are fed to ffmpeg from redis through named pipes, this
+# many video chunks are fetched from redis at a time.
+EGRESS_PIPE_CHUNKS = int(os.getenv("EGRESS_PIPE_CHUNKS", "4"))
+
+# Only one request assembles the same video at a time, the others wait up
+# to EGRESS_LOCK_WAIT seconds for it and are then served from the cache.
+# The lock expires after EGRESS_LOCK_TIMEOUT seconds if it is not released.
+EGRESS_LOCK_WAIT = int(os.getenv("EGRESS_LOCK_WAIT", "300"))
+EGRESS_LOCK_TIMEOUT = int(os.getenv("EGRESS_LOCK_TIMEOUT", "600"))
+
+# The cache is limited to CACHE_MAX_BYTES bytes (0 means no limit), when it
+# is larger the least recently used ("lru") or least frequently used ("lfu")
+# videos are evicted. Videos older than CACHE_TTL seconds are evicted too
+# (0 means they never expire). The cache is swept at startup and then every
+# CACHE_SWEEP_INTERVAL seconds (0 means only at startup).
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+CACHE_EVICTION_POLICY = os.getenv("CACHE_EVICTION_POLICY", "lru")
+CACHE_TTL = int(os.getenv("CACHE_TTL", "86400"))
+CACHE_SWEEP_INTERVAL = int(os.getenv("CACHE_SWEEP_INTERVAL", "60"))
+
 # Make sure the directories exist
 os.makedirs(INGRESS_PATH, exist_ok=True)
 os.makedirs(EGRESS_PATH, exist_ok=True)
@@ -34,3 +70,154 @@ os.makedirs(CACHE_PATH, exist_ok=True)
 # The redis database is used to store the video metadata and list of videos.
 REDIS_HASH_NAME = "redis_video_list"
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+
+# The endpoints share a pool of at most REDIS_MAX_CONNECTIONS async redis
+# connections per worker process, a request waits up to REDIS_POOL_TIMEOUT
+# seconds for a free connection.
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "64"))
+REDIS_POOL_TIMEOUT = int(os.getenv("REDIS_POOL_TIMEOUT", "20"))
+
+# The video chunks and audio are spread over these redis nodes, a comma
+# separated list of host:port, every node has its own connection pool.
+# The video metadata, ingest progress and cache counters stay on REDIS_HOST.
+# Every node has REDIS_VIRTUAL_NODES positions on the consistent hash ring.
+# Run rebalance.py after changing the nodes.
+REDIS_NODES = os.getenv("REDIS_NODES", f"{REDIS_HOST}:6379")
+REDIS_VIRTUAL_NODES = int(os.getenv("REDIS_VIRTUAL_NODES", "160"))
+
+# The video list is read from the redis hash in pages of VIDEO_LIST_PAGE_SIZE
+# videos by default, clients can ask for up to VIDEO_LIST_MAX_PAGE_SIZE.
+VIDEO_LIST_PAGE_SIZE = int(os.getenv("VIDEO_LIST_PAGE_SIZE", "100"))
+VIDEO_LIST_MAX_PAGE_SIZE = int(os.getenv("VIDEO_LIST_MAX_PAGE_SIZE", "1000"))
+
+# The ingest timestamp, duration and fps of the videos are indexed in sorted
+# sets and the resolution and audio codec in sets, all named with this
+# prefix, to filter and sort the video list.
+REDIS_VIDEO_INDEX_PREFIX = "redis_video_index"
+
+# Videos uploaded more than once share the stored chunks and audio. This
+# redis hash maps the sha256 of the uploaded files and of the encoded chunks
+# to the ID of the stored data, and a redis set named with this prefix and
+# the data ID holds the IDs of the videos that use the data. The data is
+# deleted with the last of these videos.
+REDIS_CONTENT_HASH_NAME = "redis_video_content"
+REDIS_DATA_REFERENCES_PREFIX = "redis_video_data_references"
+
+# The start time of every chunk and the end time of the last chunk of the
+# videos that are cut at their own keyframes are stored in this redis hash by
+# data ID, the chunks of the other videos are all as long as their chunk
+# seconds.
+REDIS_CHUNK_TIMES_HASH_NAME = "redis_video_chunk_times"
+
+# The stage and progress of ingest jobs are stored in this redis hash.
+REDIS_PROGRESS_HASH_NAME = "redis_video_ingest_progress"
+
+# The time of the last heartbeat of every worker process running ingest jobs
+# is stored in this redis hash.
+REDIS_INGEST_WORKERS_HASH_NAME = "redis_ingest_workers"
+
+# The video metadata is cached in every worker process for
+# METADATA_CACHE_TTL seconds (0 disables the cache), deleted videos are
+# published on this channel to remove them from the cache of every worker.
+METADATA_CACHE_TTL = int(os.getenv("METADATA_CACHE_TTL", "300"))
+REDIS_METADATA_INVALIDATION_CHANNEL = "redis_video_metadata_invalidation"
+
+# The cache hit, miss and eviction counters and the use count of every
+# cached video are stored in these redis hashes.
+REDIS_CACHE_STATS_HASH_NAME = "redis_cache_stats"
+REDIS_CACHE_USE_COUNT_HASH_NAME = "redis_cache_use_count"
+
+# The time of the last access of every video is stored in this redis hash,
+# it is used to find the videos to demote to the cold tier.
+REDIS_LAST_ACCESS_HASH_NAME = "redis_video_last_access"
+
+# Video chunks are written to redis in pipelined batches, a batch is sent
+# once it has this many chunks or this many bytes.
+REDIS_CHUNK_BATCH_SIZE = int(os.getenv("REDIS_CHUNK_BATCH_SIZE", "64"))
+REDIS_CHUNK_BATCH_BYTES = int(
+    os.getenv("REDIS_CHUNK_BATCH_BYTES", str(32 * 1024 * 1024))
+)
+
+
+# CHUNK STORAGE CONFIGURATION
+
+# "redis" stores the video and audio chunks in redis streams. "packed"
+# appends the chunks of every video to packed files in PACKED_STORAGE_PATH,
+# which are memory mapped to read them, for single node deployments that do
+# not need to keep the chunks in redis memory. The metadata stays in redis.
+CHUNK_BACKEND = os.getenv("CHUNK_BACKEND", "redis")
+PACKED_STORAGE_PATH = os.getenv(
+    "PACKED_STORAGE_PATH", os.path.join(os.path.expanduser("~"), "packed_videos")
+)
+
+
+# COLD TIER CONFIGURATION
+
+# Videos that were not accessed for TIER_DEMOTE_AFTER seconds are moved from
+# redis to COLD_STORAGE_PATH, on disk or on a mounted object store
+# (0 disables the cold tier). They are moved back to redis when they are
+# accessed. The videos to demote are looked for every TIER_SWEEP_INTERVAL
+# seconds. Videos are not demoted with the "packed" CHUNK_BACKEND, their
+# chunks are on disk already.
+COLD_STORAGE_PATH = os.getenv(
+    "COLD_STORAGE_PATH", os.path.join(os.path.expanduser("~"), "cold_videos")
+)
+TIER_DEMOTE_AFTER = int(os.getenv("TIER_DEMOTE_AFTER", str(7 * 24 * 60 * 60)))
+TIER_SWEEP_INTERVAL = int(os.getenv("TIER_SWEEP_INTERVAL", "3600"))
+
+
+# INGEST CONFIGURATION
+
+# Number of videos that are ingested at the same time in the background.
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+
+# Every worker process writes a heartbeat every INGEST_HEARTBEAT_INTERVAL
+# seconds. The unfinished ingest jobs of a worker without a heartbeat for
+# three intervals, like one that was restarted, are marked failed and their
+# data and ingress directory deleted. Failed jobs are forgotten after
+# INGEST_FAILED_TTL seconds.
+INGEST_HEARTBEAT_INTERVAL = int(os.getenv("INGEST_HEARTBEAT_INTERVAL", "10"))
+INGEST_FAILED_TTL = int(os.getenv("INGEST_FAILED_TTL", str(24 * 60 * 60)))
+
+
+# DISASSEMBLE CONFIGURATION
+
+# Videos are stored as chunks of CHUNK_SECONDS seconds, an upload can ask
+# for other chunk seconds up to MAX_CHUNK_SECONDS. Every chunk starts with a
+# keyframe, longer chunks need fewer keyframes and redis entries, shorter
+# chunks make egress fetch less video around the requested seconds.
+CHUNK_SECONDS = int(os.getenv("CHUNK_SECONDS", "1"))
+MAX_CHUNK_SECONDS = int(os.getenv("MAX_CHUNK_SECONDS", "10"))
+
+# Store the audio as chunks aligned with the video chunks, instead of one
+# blob with the whole audio.
+AUDIO_CHUNKED = os.getenv("AUDIO_CHUNKED", "1") == "1"
+
+# "parallel" splits the video into ranges and encodes the ranges at the same
+# time, each range with the ffmpeg segment muxer.
+# "segment" encodes the whole video once and cuts it into chunks with the
+# ffmpeg segment muxer. "per_second" runs one ffmpeg process for every chunk
+# of the video, which is much slower for long videos.
+DISASSEMBLE_MODE = os.getenv("DISASSEMBLE_MODE", "parallel")
+
+# Number of ffmpeg processes encoding ranges at the same time and the length
+# of each range in seconds, rounded down to whole chunks, used by the
+# parallel mode.
+DISASSEMBLE_WORKERS = int(os.getenv("DISASSEMBLE_WORKERS", os.cpu_count() or 1))
+DISASSEMBLE_RANGE_SECONDS = int(os.getenv("DISASSEMBLE_RANGE_SECONDS", "30"))
+
+# Videos that are already vp9 are cut into chunks at their own keyframes
+# without re-encoding, unless a chunk would be longer than
+# VIDEO_COPY_MAX_CHUNK_SECONDS, or than twice the chunk seconds if that is
+# longer. Every chunk starts at the first keyframe the chunk seconds or more
+# after the start of the previous chunk. The other videos are encoded with a
+# keyframe at the start of every chunk.
+VIDEO_COPY = os.getenv("VIDEO_COPY", "1") == "1"
+VIDEO_COPY_MAX_CHUNK_SECONDS = float(os.getenv("VIDEO_COPY_MAX_CHUNK_SECONDS", "5"))
+
+# Besides the source rendition every video is encoded at the heights of
+# RENDITION_LADDER below its own height, as comma separated height:bitrate
+# pairs like "1080:4500k,720:2500k,360:800k" (empty disables the ladder).
+# Every rendition is stored as its own chunks, cut at the same times as the
+# chunks of the source rendition.
+RENDITION_LADDER = os.getenv("RENDITION_LADDER", "")
@@ -3,10 +3,16 @@ This module contains the functions to containerize the video and audio files.
 Just simple muxing of the audio and video files.
 """
 
-import subprocess
+import asyncio
+import struct
+from asyncio.subprocess import Process
+from typing import List, Optional, Tuple
 
+# the boxes of fragmented MP4 before the first fragment
+INIT_SEGMENT_BOXES = (b"ftyp", b"moov")
 
-def mux_audio_video(audio_file: str, video_file: str, output_file: str) -> bool:
+
+async def mux_audio_video(audio_file: str, video_file: str, output_file: str) -> bool:
     """
     Mux audio and video files.
     """
@@ -37,8 +43,112 @@ def mux_audio_video(audio_file: str, video_file: str, output_file: str) -> bool:
         ]
 
     # run the muxing command
-    try:
-        subprocess.run(mux_cmd, check=True)
-        return True
-    except subprocess.CalledProcessError:
-        return False
+    process = await asyncio.create_subprocess_exec(*mux_cmd)
+    return await process.wait() == 0
+
+
+async def open_concat_mux_stream(
+    video_input_txt_path: str, audio_input_txt_path: Optional[str] = None
+) -> Process:
+    """
+    Concatenate the video chunks listed in the concat demuxer file and mux
+    them with the audio listed in its own concat demuxer file into webm with
+    a single ffmpeg process.
+
+    The webm is written to the stdout of the returned process as it is
+    produced, nothing is written to disk.
+    """
+    concat_input = ["-f", "concat", "-safe", "0", "-protocol_whitelist", "file,subfile"]
+    mux_cmd = ["ffmpeg"] + concat_input + ["-i", video_input_txt_path]
+    if audio_input_txt_path:
+        mux_cmd += concat_input + ["-i", audio_input_txt_path]
+        mux_cmd += ["-map", "0:v", "-map", "1:a"]
+    mux_cmd += ["-c", "copy", "-f", "webm", "pipe:1"]
+
+    return await asyncio.create_subprocess_exec(
+        *mux_cmd, stdout=asyncio.subprocess.PIPE
+    )
+
+
+async def remux(input_file: str, output_file: str) -> bool:
+    """
+    Remux a video into a file without re-encoding.
+
+    A webm written to a pipe has no cues and no duration, as the muxer can
+    not seek back to write them, remuxing it into a file adds them.
+    """
+    remux_cmd = [
+        "ffmpeg",
+        "-i",
+        input_file,
+        "-map",
+        "0",
+        "-c",
+        "copy",
+        "-y",
+        output_file,
+    ]
+
+    process = await asyncio.create_subprocess_exec(*remux_cmd)
+    return await process.wait() == 0
+
+
+async def remux_to_fragment(
+    chunk: bytes, offset: float
+) -> Optional[Tuple[bytes, bytes]]:
+    """
+    Remux a chunk into fragmented MP4 without re-encoding, to be served as
+    an HLS segment of a video stored before its segments were written at
+    ingest.
+
+    Returns the initialization segment and the media segment, or None if
+    ffmpeg failed.
+    """
+    fragment_cmd = (
+        ["ffmpeg", "-i", "pipe:0"]
+        + get_fragment_options(offset)
+        + ["-f", "mp4", "pipe:1"]
+    )
+
+    process = await asyncio.create_subprocess_exec(
+        *fragment_cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
+    )
+    fragment, _ = await process.communicate(chunk)
+    if process.returncode != 0:
+        return None
+    return split_init_segment(fragment)
+
+
+def get_fragment_options(offset: float) -> List[str]:
+    """
+    Get the ffmpeg output options to remux a chunk into fragmented MP4
+    without re-encoding, as one fragment after the initialization segment.
+
+    The timestamps of every chunk start at zero, they are moved to offset
+    so that the segments of a track continue each other.
+    """
+    return [
+        "-map",
+        "0",
+        "-c",
+        "copy",
+        "-avoid_negative_ts",
+        "disabled",
+        "-use_editlist",
+        "0",
+        "-output_ts_offset",
+        f"{offset:.3f}",
+        "-movflags",
+        "+frag_custom+frag_discont+empty_moov+default_base_moof+skip_trailer",
+    ]
+
+
+def split_init_segment(fragment: bytes) -> Tuple[bytes, bytes]:
+    """
+    Split fragmented MP4 into the initialization segment, its ftyp and moov
+    boxes, and the media segment, the boxes after them.
+    """
+    position = 0
+    while fragment[position + 4 : position + 8] in INIT_SEGMENT_BOXES:
+        position += struct.unpack(">I", fragment[position : position + 4])[0]
+    return fragment[:position], fragment[position:]
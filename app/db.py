@@ -4,16 +4,60 @@ Database module. Contains functions to interact with Redis.
 
 import json
 import os
-from typing import Any, Dict
+from typing import Any, Dict, Iterator, List, Optional, Sequence
 
 import redis
+from redis.client import Pipeline, PubSub
+from redis.lock import Lock
 
 import config
+import packed
+import shard
 
 # Connect to Redis
 r = redis.Redis()
 r = redis.Redis(host=config.REDIS_HOST, port=6379, db=0)
 
+# Connect to the redis nodes that store the video data, one pool per node
+nodes = [redis.Redis(host=host, port=port, db=0) for host, port in shard.NODES]
+
+
+def get_node(video_id: str) -> redis.Redis:
+    """
+    Get the redis node that stores the data of a video.
+    """
+    return nodes[shard.get_node_index(video_id)]
+
+
+def get_lock(name: str, timeout: int) -> Lock:
+    """
+    Get a redis lock, shared by all the worker processes.
+
+    The lock is not thread local, so it can be released by another thread
+    than the one that acquired it.
+    """
+    return r.lock(name, timeout=timeout, thread_local=False)
+
+
+def publish(channel: str, message: str) -> bool:
+    """
+    Publish a message on redis pub/sub channel.
+    """
+    try:
+        r.publish(channel, message)
+        return True
+    except Exception:
+        return False
+
+
+def subscribe(channel: str) -> PubSub:
+    """
+    Subscribe to redis pub/sub channel.
+    """
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(channel)
+    return pubsub
+
 
 def add_video_metadata_to_redis_hash(video_metadata: Dict, hash_name: str) -> bool:
     """
@@ -30,6 +74,37 @@ def add_video_metadata_to_redis_hash(video_metadata: Dict, hash_name: str) -> bo
         return False
 
 
+# sets a field of a hash only if the field exists, so metadata written back
+# after it was read is not added again if the video was deleted meanwhile
+HSET_IF_EXISTS = r.register_script(
+    """
+    if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+        return 0
+    end
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    return 1
+    """
+)
+
+
+def update_video_metadata_in_redis_hash(video_metadata: Dict, hash_name: str) -> bool:
+    """
+    Replace the metadata of a video in redis hash, unless the video was
+    deleted.
+
+    Returns False if the video does not exist or on error.
+    """
+    try:
+        return bool(
+            HSET_IF_EXISTS(
+                keys=[hash_name],
+                args=[video_metadata["video_id"], json.dumps(video_metadata)],
+            )
+        )
+    except Exception:
+        return False
+
+
 def delete_video_metadata_from_redis_hash(video_id: str, hash_name: str) -> bool:
     """
     Delete video metadata from redis hash.
@@ -42,6 +117,54 @@ def delete_video_metadata_from_redis_hash(video_id: str, hash_name: str) -> bool
         return False
 
 
+def delete_video_metadata_and_indexes(
+    video_id: str, hash_name: str, index_names: List[str], index_sets: List[str]
+) -> bool:
+    """
+    Delete video metadata from redis hash and the video from the sorted set
+    and set indexes, in one transaction.
+    """
+    try:
+        pipe = r.pipeline(transaction=True)
+        pipe.hdel(hash_name, video_id)
+        for index_name in index_names:
+            pipe.zrem(index_name, video_id)
+        for index_set in index_sets:
+            pipe.srem(index_set, video_id)
+        pipe.execute()
+        return True
+    except Exception:
+        return False
+
+
+def add_video_to_indexes(
+    pipe: Pipeline, video_id: str, index_scores: Dict[str, float], index_sets: List[str]
+) -> None:
+    """
+    Add a video to the sorted set indexes with the given scores and to the
+    set indexes.
+    """
+    for index_name, score in index_scores.items():
+        pipe.zadd(index_name, {video_id: score})
+    for index_set in index_sets:
+        pipe.sadd(index_set, video_id)
+
+
+def update_video_indexes(
+    video_id: str, index_scores: Dict[str, float], index_sets: List[str]
+) -> bool:
+    """
+    Add a video to the sorted set and set indexes.
+    """
+    try:
+        pipe = r.pipeline(transaction=False)
+        add_video_to_indexes(pipe, video_id, index_scores, index_sets)
+        pipe.execute()
+        return True
+    except Exception:
+        return False
+
+
 def delete_redis_hash(hash_name: str) -> bool:
     """
     Delete redis hash.
@@ -76,6 +199,80 @@ def does_video_metadata_exist_in_redis_hash(video_id: str, hash_name: str) -> bo
         return False
 
 
+def increment_redis_hash_field(hash_name: str, key: str, amount: int = 1) -> bool:
+    """
+    Increment an integer field of redis hash.
+    """
+    try:
+        r.hincrby(name=hash_name, key=key, amount=amount)
+        return True
+    except Exception:
+        return False
+
+
+def set_redis_hash_field(hash_name: str, key: str, value: str) -> bool:
+    """
+    Set a field of redis hash.
+    """
+    try:
+        r.hset(name=hash_name, key=key, value=value)
+        return True
+    except Exception:
+        return False
+
+
+def get_redis_hash(hash_name: str) -> Dict:
+    """
+    Get all fields of redis hash, decoded as strings.
+    """
+    try:
+        return {k.decode(): v.decode() for k, v in r.hgetall(name=hash_name).items()}
+    except Exception:
+        return {}
+
+
+def get_redis_hash_field(hash_name: str, key: str) -> Optional[str]:
+    """
+    Get a field of redis hash, decoded as a string.
+    """
+    try:
+        value = r.hget(name=hash_name, key=key)
+    except Exception:
+        return None
+    return value.decode() if value is not None else None
+
+
+def delete_redis_hash_fields_with_value(
+    hash_name: str, keys: List[str], value: str
+) -> bool:
+    """
+    Delete the fields of redis hash that have the given value.
+    """
+    if not keys:
+        return True
+    try:
+        values = r.hmget(hash_name, keys)
+        keys = [key for key, v in zip(keys, values) if v and v.decode() == value]
+        if keys:
+            r.hdel(hash_name, *keys)
+        return True
+    except Exception:
+        return False
+
+
+def delete_redis_hash_fields(hash_name: str, keys: List[str]) -> bool:
+    """
+    Delete fields from redis hash.
+    """
+    if not keys:
+        return True
+    try:
+        r.hdel(hash_name, *keys)
+        return True
+    except Exception:
+        return False
+
+
 def get_all_video_metadata_from_redis_hash(hash_name: str) -> Dict:
     """
     Get all video metadata from redis hash.
@@ -88,58 +285,359 @@ def get_all_video_metadata_from_redis_hash(hash_name: str) -> Dict:
         return {}
 
 
-def add_video_chunk_to_redis_stream(video_id: str, chunk_dir: str) -> bool:
+def iterate_video_metadata_in_redis_hash(hash_name: str) -> Iterator[Dict]:
     """
-    Add video chunks to redis stream.
+    Iterate over all video metadata in redis hash, read in batches with HSCAN.
+    """
+    for _, value in r.hscan_iter(name=hash_name, count=config.VIDEO_LIST_PAGE_SIZE):
+        yield json.loads(value.decode())
+
+
+def add_chunk_files_to_redis_stream(
+    video_id: str, stream_name: str, index_name: str, chunk_files: List[str]
+) -> bool:
+    """
+    Add the given chunk files to redis stream.
+
+    The chunks are sent in pipelined batches of at most
+    REDIS_CHUNK_BATCH_SIZE chunks or REDIS_CHUNK_BATCH_BYTES bytes, so there
+    is one round trip per batch instead of one per chunk.
+
+    The stream entry ID of every chunk is stored in the chunk index hash
+    index_name, so that egress can read single chunks. Both are stored on
+    the redis node of the video.
     """
     try:
-        chunk_files = sorted(os.listdir(chunk_dir))
+        node = get_node(video_id)
+        pipe = node.pipeline(transaction=False)
+        batch_chunk_ids: List[str] = []
+        batch_bytes = 0
         for chunk_file in chunk_files:
-            chunk_id = chunk_file.split(".")[0].split("_")[1]
-            with open(chunk_dir + "/" + chunk_file, "rb") as file:
+            chunk_id = os.path.basename(chunk_file).split(".")[0].split("_")[1]
+            with open(chunk_file, "rb") as file:
                 chunk = file.read()
-            r.xadd(
-                name=f"video_{video_id}",
+            pipe.xadd(
+                name=stream_name,
                 fields={f"chunk_{chunk_id}": chunk},
             )
+            batch_chunk_ids.append(f"chunk_{chunk_id}")
+            batch_bytes += len(chunk)
+            if (
+                len(batch_chunk_ids) >= config.REDIS_CHUNK_BATCH_SIZE
+                or batch_bytes >= config.REDIS_CHUNK_BATCH_BYTES
+            ):
+                add_entry_ids_to_chunk_index(
+                    node, index_name, batch_chunk_ids, pipe.execute()
+                )
+                batch_chunk_ids = []
+                batch_bytes = 0
+        add_entry_ids_to_chunk_index(node, index_name, batch_chunk_ids, pipe.execute())
         return True
     except Exception:
         return False
 
 
+def add_entry_ids_to_chunk_index(
+    node: redis.Redis, index_name: str, chunk_ids: List[str], results: List
+) -> None:
+    """
+    Add the stream entry IDs returned by a pipelined batch of XADD commands
+    to the chunk index hash.
+    """
+    entry_ids = results[-len(chunk_ids) :] if chunk_ids else []
+    if entry_ids:
+        node.hset(name=index_name, mapping=dict(zip(chunk_ids, entry_ids)))
+
+
+def add_video_chunk_files_to_redis_stream(
+    video_id: str, chunk_files: List[str], track: str = "video"
+) -> bool:
+    """
+    Add the given video chunk files to redis stream, or to the packed file
+    of the video if CHUNK_BACKEND is packed. track is the video track of a
+    rendition, the source rendition by default.
+    """
+    if config.CHUNK_BACKEND == "packed":
+        return packed.add_chunk_files(video_id, track, chunk_files)
+    return add_chunk_files_to_redis_stream(
+        video_id,
+        shard.get_key(track, video_id),
+        shard.get_key(f"{track}_chunk_index", video_id),
+        chunk_files,
+    )
+
+
+def add_audio_chunk_files_to_redis_stream(
+    video_id: str, chunk_files: List[str]
+) -> bool:
+    """
+    Add the given audio chunk files to redis stream, or to the packed file
+    of the video if CHUNK_BACKEND is packed.
+    """
+    if config.CHUNK_BACKEND == "packed":
+        return packed.add_chunk_files(video_id, "audio", chunk_files)
+    return add_chunk_files_to_redis_stream(
+        video_id,
+        shard.get_key("audio_chunks", video_id),
+        shard.get_key("audio_chunk_index", video_id),
+        chunk_files,
+    )
+
+
+def add_video_chunk_to_redis_stream(video_id: str, chunk_dir: str) -> bool:
+    """
+    Add video chunks to redis stream.
+    """
+    try:
+        chunk_files = sorted(os.listdir(chunk_dir))
+    except Exception:
+        return False
+    return add_video_chunk_files_to_redis_stream(
+        video_id, [os.path.join(chunk_dir, chunk_file) for chunk_file in chunk_files]
+    )
+
+
 def add_audio_to_redis(video_id: str, audio_file: str) -> bool:
     """
     Add audio to redis.
     """
     try:
-        key = f"audio_{video_id}"
+        key = shard.get_key("audio", video_id)
         with open(audio_file, "rb") as file:
             value = file.read()
-        r.set(key, value)
+        get_node(video_id).set(key, value)
+        return True
+    except Exception:
+        return False
+
+
+def add_audio_and_video_metadata_to_redis(
+    video_metadata: Dict,
+    hash_name: str,
+    audio_file: Optional[str] = None,
+    index_scores: Optional[Dict[str, float]] = None,
+    index_sets: Optional[List[str]] = None,
+    references_name: Optional[str] = None,
+    content_hashes: Optional[Dict[str, str]] = None,
+    chunk_times: Optional[str] = None,
+) -> bool:
+    """
+    Add the audio and then the video metadata to redis.
+
+    The audio is stored on the redis node of the video and the metadata in
+    the redis hash, the video is listed in the redis hash only once all of
+    its data is stored. The video is added to the sorted set and set
+    indexes, to the set references_name of the videos using its data, and
+    content_hashes are added to the content hash, in the same transaction as
+    the metadata. The chunk times of a video cut at its keyframes are stored
+    by its data ID.
+    """
+    try:
+        if audio_file:
+            with open(audio_file, "rb") as file:
+                get_node(video_metadata["video_id"]).set(
+                    shard.get_key("audio", video_metadata["video_id"]), file.read()
+                )
+        pipe = r.pipeline(transaction=True)
+        pipe.hset(
+            name=hash_name,
+            key=video_metadata["video_id"],
+            value=json.dumps(video_metadata),
+        )
+        add_video_to_indexes(
+            pipe, video_metadata["video_id"], index_scores or {}, index_sets or []
+        )
+        if references_name:
+            pipe.sadd(references_name, video_metadata["video_id"])
+        if content_hashes:
+            pipe.hset(name=config.REDIS_CONTENT_HASH_NAME, mapping=content_hashes)
+        if chunk_times:
+            pipe.hset(
+                name=config.REDIS_CHUNK_TIMES_HASH_NAME,
+                key=video_metadata["data_id"],
+                value=chunk_times,
+            )
+        pipe.execute()
+        return True
+    except Exception:
+        return False
+
+
+def add_video_metadata_with_reference(
+    video_metadata: Dict,
+    hash_name: str,
+    references_name: str,
+    index_scores: Dict[str, float],
+    index_sets: List[str],
+    content_hashes: Dict[str, str],
+) -> bool:
+    """
+    Add the metadata of a video that uses the stored data of other videos
+    to the redis hash, the indexes and the set references_name of the
+    videos using the data, and content_hashes to the content hash, in one
+    transaction.
+
+    Fails if no video uses the data anymore, the set is watched so that the
+    data cannot be deleted while the video is added.
+    """
+    try:
+        with r.pipeline(transaction=True) as pipe:
+            pipe.watch(references_name)
+            if not pipe.scard(references_name):
+                return False
+            pipe.multi()
+            pipe.hset(
+                name=hash_name,
+                key=video_metadata["video_id"],
+                value=json.dumps(video_metadata),
+            )
+            add_video_to_indexes(
+                pipe, video_metadata["video_id"], index_scores, index_sets
+            )
+            pipe.sadd(references_name, video_metadata["video_id"])
+            if content_hashes:
+                pipe.hset(name=config.REDIS_CONTENT_HASH_NAME, mapping=content_hashes)
+            pipe.execute()
         return True
     except Exception:
         return False
 
 
-def get_video_chunks(video_id: str) -> Dict:
+def remove_video_reference(references_name: str, video_id: str) -> int:
+    """
+    Remove a video from the set references_name of the videos using some
+    stored data.
+
+    Returns the number of videos still using the data, or -1 on error.
+    """
+    try:
+        pipe = r.pipeline(transaction=True)
+        pipe.srem(references_name, video_id)
+        pipe.scard(references_name)
+        return pipe.execute()[1]
+    except Exception:
+        return -1
+
+
+def get_redis_set_members(set_name: str) -> List[str]:
+    """
+    Get the members of redis set, decoded as strings.
+    """
+    try:
+        return [member.decode() for member in r.smembers(set_name)]
+    except Exception:
+        return []
+
+
+def get_video_chunks(video_id: str, track: str = "video") -> Dict:
     """
     Get video chunks by chunk_id range from redis stream.
 
     """
+    if config.CHUNK_BACKEND == "packed":
+        return packed.get_chunks(video_id, track)
 
     try:
-        video_chunks = r.xrange(name=f"video_{video_id}", min="-", max="+")
+        video_chunks = get_node(video_id).xrange(
+            name=shard.get_key(track, video_id), min="-", max="+"
+        )
     except Exception:
         return {}
     return video_chunks
 
 
+def get_audio_chunks(video_id: str) -> List:
+    """
+    Get all the audio chunks of a video from redis stream.
+    """
+    if config.CHUNK_BACKEND == "packed":
+        return packed.get_chunks(video_id, "audio")
+    try:
+        return get_node(video_id).xrange(
+            name=shard.get_key("audio_chunks", video_id), min="-", max="+"
+        )
+    except Exception:
+        return []
+
+
+def get_chunks_by_chunk_ids(
+    video_id: str, stream_name: str, index_name: str, chunk_ids: List[str]
+) -> List:
+    """
+    Get only the given chunks from redis stream.
+
+    The entry IDs are looked up in the chunk index hash and the entries are
+    read with pipelined single entry XRANGE commands. Streams stored before
+    the chunk index existed fall back to reading the whole stream, chunks
+    missing from the index of an indexed stream are left out.
+    """
+
+    try:
+        node = get_node(video_id)
+        pipe = node.pipeline(transaction=False)
+        pipe.exists(index_name)
+        pipe.hmget(index_name, chunk_ids)
+        index_exists, entry_ids = pipe.execute()
+        if not index_exists:
+            return node.xrange(name=stream_name, min="-", max="+")
+        if not any(entry_ids):
+            return []
+
+        pipe = node.pipeline(transaction=False)
+        for entry_id in entry_ids:
+            if entry_id:
+                pipe.xrange(name=stream_name, min=entry_id, max=entry_id)
+        return [entry for entries in pipe.execute() for entry in entries]
+    except Exception:
+        return []
+
+
+def get_video_chunks_by_chunk_ids(video_id: str, chunk_ids: List[str]) -> List:
+    """
+    Get only the given video chunks from redis stream.
+    """
+    if config.CHUNK_BACKEND == "packed":
+        return packed.get_chunks_by_chunk_ids(video_id, "video", chunk_ids)
+    return get_chunks_by_chunk_ids(
+        video_id,
+        shard.get_key("video", video_id),
+        shard.get_key("video_chunk_index", video_id),
+        chunk_ids,
+    )
+
+
+def get_audio_chunks_by_chunk_ids(video_id: str, chunk_ids: List[str]) -> List:
+    """
+    Get only the given audio chunks from redis stream.
+    """
+    if config.CHUNK_BACKEND == "packed":
+        return packed.get_chunks_by_chunk_ids(video_id, "audio", chunk_ids)
+    return get_chunks_by_chunk_ids(
+        video_id,
+        shard.get_key("audio_chunks", video_id),
+        shard.get_key("audio_chunk_index", video_id),
+        chunk_ids,
+    )
+
+
+def get_video_chunk_count(video_id: str) -> int:
+    """
+    Get the number of video chunks in redis stream.
+    """
+    if config.CHUNK_BACKEND == "packed":
+        return packed.get_chunk_count(video_id, "video")
+    try:
+        return get_node(video_id).xlen(shard.get_key("video", video_id))
+    except Exception:
+        return 0
+
+
 def get_audio(video_id: str) -> Any:
     """
     Get audio redis
     """
     try:
-        return r.get(f"audio_{video_id}")
+        return get_node(video_id).get(shard.get_key("audio", video_id))
     except Exception:
         return None
 
@@ -153,3 +651,16 @@ def delete_redis_stream(stream_name: str) -> bool:
     except Exception:
         return False
     return True
+
+
+def delete_video_data(video_id: str, tracks: Sequence[str] = ()) -> bool:
+    """
+    Delete the video and audio chunks, chunk indexes and audio of a video
+    from its redis node, and its packed files. tracks are the video tracks
+    of its renditions besides the source.
+    """
+    try:
+        get_node(video_id).delete(*shard.get_video_keys(video_id, tracks))
+    except Exception:
+        return False
+    return packed.delete_video(video_id)
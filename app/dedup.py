@@ -0,0 +1,182 @@
+"""
+Module for sharing the stored data of videos with the same content.
+
+The chunks and audio of a video are stored under its data ID, the ID of the
+first video with the same content. The sha256 of every uploaded file and of
+the encoded chunks of every video are mapped to its data ID, an upload of a
+file that is already stored, or that is encoded into chunks that are already
+stored, only adds its metadata and uses the stored data.
+
+The IDs of the videos using the data are kept in a redis set, the data is
+deleted with the last of these videos.
+"""
+
+import hashlib
+import os
+from typing import Dict, List, Optional
+
+import config
+import db
+
+# fields of the metadata that describe the stored data, they are copied to
+# the metadata of the videos using the data
+STORED_DATA_FIELDS = (
+    "audio_chunked",
+    "chunk_seconds",
+    "video_duration",
+    "keyframe_chunks",
+    "rendition_ladder",
+    "renditions",
+    "hls_fragments",
+    "video_bitrate",
+    "tier",
+    "chunks_sha256",
+)
+
+# sha256 fields of the metadata that are mapped to the data ID
+CONTENT_FIELDS = ("file_sha256", "chunks_sha256")
+
+
+def get_data_id(video_metadata: Dict) -> str:
+    """
+    Get the ID the chunks and audio of a video are stored under, the ID of
+    the first video with the same content.
+    """
+    return video_metadata.get("data_id") or video_metadata["video_id"]
+
+
+def get_references_name(data_id: str) -> str:
+    """
+    Get the name of the redis set of the videos using the stored data.
+    """
+    return f"{config.REDIS_DATA_REFERENCES_PREFIX}_{data_id}"
+
+
+def get_video_ids(data_id: str) -> List[str]:
+    """
+    Get the IDs of the videos using the stored data. Videos stored before
+    the data was shared are the only users of their data.
+    """
+    return db.get_redis_set_members(get_references_name(data_id)) or [data_id]
+
+
+def get_encoding(video_metadata: Dict) -> str:
+    """
+    Get the part of the keys of the content hash for the chunk seconds and
+    the rendition ladder the data is stored with. It is empty for one
+    second chunks without renditions, like for videos stored before these
+    were configurable.
+    """
+    encoding = ""
+    if (video_metadata.get("chunk_seconds") or 1) != 1:
+        encoding += f"_{video_metadata['chunk_seconds']}s"
+    if video_metadata.get("rendition_ladder"):
+        encoding += f"_{video_metadata['rendition_ladder']}"
+    return encoding
+
+
+def get_content_hash(video_metadata: Dict, field: str) -> Optional[str]:
+    """
+    Get the key of the content hash for a sha256 field of the metadata,
+    file_sha256 or chunks_sha256.
+
+    Stored data is only used by a video with the same chunk seconds and
+    rendition ladder. The chunks hash covers the audio and the source
+    rendition, so it is checked before the renditions are encoded.
+    """
+    if not video_metadata.get(field):
+        return None
+    return f"{field}_{video_metadata[field]}{get_encoding(video_metadata)}"
+
+
+def get_content_hashes(video_metadata: Dict) -> Dict[str, str]:
+    """
+    Get the keys of the content hash of a video mapped to its data ID.
+    """
+    content_hashes = {}
+    for field in CONTENT_FIELDS:
+        content_hash = get_content_hash(video_metadata, field)
+        if content_hash:
+            content_hashes[content_hash] = get_data_id(video_metadata)
+    return content_hashes
+
+
+def hash_file(file_path: str) -> str:
+    """
+    Get the sha256 of a file.
+    """
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for buffer in iter(lambda: file.read(config.UPLOAD_BUFFER_SIZE), b""):
+            file_hash.update(buffer)
+    return file_hash.hexdigest()
+
+
+def hash_chunk_files(track: str, chunk_files: List[str]) -> Dict[str, str]:
+    """
+    Get the sha256 of chunk files, keyed by the track and the chunk ID.
+    """
+    return {
+        f"{track}_{os.path.basename(chunk_file).split('.')[0]}": hash_file(chunk_file)
+        for chunk_file in chunk_files
+    }
+
+
+def get_chunks_sha256(chunk_hashes: Dict[str, str]) -> str:
+    """
+    Get the sha256 of all the chunks of a video from the sha256 of every
+    chunk, keyed by the track and the chunk ID.
+    """
+    return hashlib.sha256(
+        "".join(f"{key}:{chunk_hashes[key]}\n" for key in sorted(chunk_hashes)).encode()
+    ).hexdigest()
+
+
+def find_stored_data(content_hash: str) -> Optional[Dict]:
+    """
+    Get the metadata of a video using the stored data of the given key of
+    the content hash, or None if no video uses it anymore.
+    """
+    data_id = db.get_redis_hash_field(config.REDIS_CONTENT_HASH_NAME, content_hash)
+    if not data_id:
+        return None
+    for video_id in db.get_redis_set_members(get_references_name(data_id)):
+        video_metadata = db.get_video_metadata_from_redis_hash(
+            video_id=video_id, hash_name=config.REDIS_HASH_NAME
+        )
+        if video_metadata and get_data_id(video_metadata) == data_id:
+            return video_metadata
+    return None
+
+
+def use_stored_data(video_metadata: Dict, stored_metadata: Dict) -> None:
+    """
+    Make a video use the stored data of another video. Fields missing from
+    the metadata of older videos are removed, so their defaults apply.
+    """
+    video_metadata["data_id"] = get_data_id(stored_metadata)
+    for field in STORED_DATA_FIELDS:
+        if field in stored_metadata:
+            video_metadata[field] = stored_metadata[field]
+        else:
+            video_metadata.pop(field, None)
+
+
+def remove_reference(video_metadata: Dict) -> int:
+    """
+    Remove a video from the videos using its stored data. The content hash
+    no longer maps to the data once no video uses it.
+
+    Returns the number of videos still using the data, or -1 on error.
+    """
+    data_id = get_data_id(video_metadata)
+    remaining = db.remove_video_reference(
+        get_references_name(data_id), video_metadata["video_id"]
+    )
+    if remaining == 0:
+        db.delete_redis_hash_fields_with_value(
+            config.REDIS_CONTENT_HASH_NAME,
+            list(get_content_hashes(video_metadata)),
+            data_id,
+        )
+    return remaining
@@ -1,22 +1,77 @@
 """
-Module to delete video metadata, audio and video chunks from redis.
+Module to delete video metadata, audio and video chunks from redis,
+the cold copy of the video and the cached videos from the cache directory.
 """
 
+from typing import Dict, Optional
+
+import cache
 import config
 import db
+import dedup
+import information
+import progress
+import rendition
+import tier
+import videoindex
 
 
 def delete_video_metadata_and_audio_video_chunks(video_id: str) -> bool:
     """
-    Delete video from redis hash and chunks in the redis stream.
+    Delete video from redis hash and the indexes and chunks in the redis
+    stream. The chunks are shared by the videos with the same content, they
+    are only deleted with the last of these videos.
+
+    The tier lock of the data is held, so the metadata is not written back
+    by a tier change and the data is not moved while it is deleted.
     """
-    status_metadata = db.delete_video_metadata_from_redis_hash(
+    video_metadata = db.get_video_metadata_from_redis_hash(
         video_id=video_id, hash_name=config.REDIS_HASH_NAME
     )
-    video_chunk_stream_name = f"video_{video_id}"
-    status_video = db.delete_redis_stream(stream_name=video_chunk_stream_name)
+    if not video_metadata:
+        return delete_video_with_metadata(video_id, video_metadata)
+
+    lock = tier.get_tier_lock(dedup.get_data_id(video_metadata))
+    if not lock.acquire(blocking_timeout=tier.TIER_LOCK_TIMEOUT):
+        return False
+    try:
+        # the metadata may have changed tier while waiting for the lock
+        return delete_video_with_metadata(
+            video_id,
+            db.get_video_metadata_from_redis_hash(
+                video_id=video_id, hash_name=config.REDIS_HASH_NAME
+            ),
+        )
+    finally:
+        tier.release_lock(lock)
+
+
+def delete_video_with_metadata(video_id: str, video_metadata: Optional[Dict]) -> bool:
+    """
+    Delete a video with the given metadata, read while the tier lock of its
+    data is held.
+    """
+    status_metadata = db.delete_video_metadata_and_indexes(
+        video_id=video_id,
+        hash_name=config.REDIS_HASH_NAME,
+        index_names=videoindex.get_index_names(),
+        index_sets=videoindex.get_index_sets(video_metadata) if video_metadata else [],
+    )
+    information.invalidate_video_information(video_id)
+
+    video_metadata = video_metadata or {"video_id": video_id}
+    remaining = dedup.remove_reference(video_metadata)
+    status_data = remaining >= 0
+    if remaining == 0:
+        data_id = dedup.get_data_id(video_metadata)
+        status_data = db.delete_video_data(
+            data_id, rendition.get_tracks(video_metadata)
+        )
+        db.delete_redis_hash_fields(config.REDIS_CHUNK_TIMES_HASH_NAME, [data_id])
+        tier.purge_data(data_id)
 
-    audio_chunk_stream_name = f"audio_{video_id}"
-    status_audio = db.delete_redis_stream(stream_name=audio_chunk_stream_name)
+    progress.delete_ingest_progress(video_id)
+    cache.purge_video(video_id)
+    tier.purge_video(video_id)
 
-    return status_metadata and status_video and status_audio
+    return status_metadata and status_data
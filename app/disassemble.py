@@ -1,42 +1,517 @@
 """
 Module for disassembling a video into chunks.
+
+The chunks are written without the tags of the upload and with -fflags
++bitexact, without random IDs or encoder versions in the container, so the
+same video is always encoded into the same bytes and stored chunks can be
+found by their sha256.
+
+Videos that are already vp9 with keyframes close enough together are cut at
+their own keyframes without re-encoding, their chunks have the length of the
+keyframe intervals and the audio is cut at the same times.
+
+The renditions of a video are encoded at their height and bitrate and cut
+into chunks with the same boundaries as the chunks of the video.
+
+The chunks of every track are also remuxed into fragmented MP4 chunks, which
+are served as HLS segments as they are stored.
 """
+import math
+import os
+import shutil
 import subprocess
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional
+
+import config
+import containerize
+import timeline
 
+# the segment muxer cuts at the first packet at most this many seconds before
+# a segment time, the packet times of Matroska files are rounded to milliseconds
+SEGMENT_TIME_DELTA = 0.002
 
-def disassemble_video(input_file: str, output_dir: str) -> Dict:
+# segment times passed to one ffmpeg process, a command line is limited to
+# 128 KiB so longer videos are cut by several processes one after the other
+SEGMENT_TIMES_PER_PROCESS = 4000
+
+
+def get_video_duration(input_file: str) -> float:
     """
-    Disassemble a video into chunks.
+    Get the duration of the video in seconds using ffprobe.
+    """
+    command = f"ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 {input_file}"
+    return float(
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+        .stdout.strip()
+        .decode("utf-8")
+    )
+
+
+def disassemble_video_per_second(
+    input_file: str,
+    output_dir: str,
+    video_duration: Optional[float] = None,
+    chunk_seconds: int = 1,
+) -> Dict:
+    """
+    Disassemble a video into chunks of chunk_seconds, running one ffmpeg
+    process per chunk.
     """
     response: Dict = {}
     chunks = []
     try:
-        # get video duration
-        command = f"ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 {input_file}"
-        video_duration = float(
-            subprocess.run(command, shell=True, stdout=subprocess.PIPE)
-            .stdout.strip()
-            .decode("utf-8")
-        )
+        # get video duration, unless it is known
+        if video_duration is None:
+            video_duration = get_video_duration(input_file)
         # calculate number of chunks
-        num_chunks = int(video_duration)
+        num_chunks = int(video_duration // chunk_seconds)
         # chunk video
         for i in range(num_chunks):
             output_file = f"{output_dir}/chunk_{i}.mkv"
             chunks.append(output_file)
             command = (
-                f"ffmpeg -i {input_file} -ss {i} -t 1 -c:v libvpx-vp9 {output_file}"
+                f"ffmpeg -i {input_file} -ss {i * chunk_seconds} -t {chunk_seconds} "
+                f"-c:v libvpx-vp9 -map_metadata -1 -fflags +bitexact {output_file}"
             )
             subprocess.run(command, shell=True, check=True)
         # handle last chunk
-        if video_duration > num_chunks:
-            last_chunk_duration = video_duration - num_chunks
+        if video_duration > num_chunks * chunk_seconds:
+            last_chunk_duration = video_duration - num_chunks * chunk_seconds
             output_file = f"{output_dir}/chunk_{num_chunks}.mkv"
             chunks.append(output_file)
-            command = f"ffmpeg -i {input_file} -ss {num_chunks} -t {last_chunk_duration} -c:v libvpx-vp9 {output_file}"
+            command = f"ffmpeg -i {input_file} -ss {num_chunks * chunk_seconds} -t {last_chunk_duration} -c:v libvpx-vp9 -map_metadata -1 -fflags +bitexact {output_file}"
             subprocess.run(command, shell=True, check=True)
         response["message"] = f"Video chunks: {chunks}"
     except subprocess.CalledProcessError as err:
         response["error"] = err.output
     return response
+
+
+def segment_video(
+    input_file: str, output_dir: str, chunk_seconds: int = 1, encode_options: str = ""
+) -> Dict:
+    """
+    Disassemble a video into chunks with a single ffmpeg process.
+
+    The video is encoded once, a keyframe is forced every chunk_seconds and
+    the segment muxer cuts the output at those keyframes into the same
+    chunk_0.mkv, chunk_1.mkv ... layout as the per second mode. The last
+    chunk may be shorter than chunk_seconds. encode_options are added to
+    the options of the vp9 encoder.
+    """
+    response: Dict = {}
+    try:
+        command = (
+            f"ffmpeg -i {input_file} -c:v libvpx-vp9 {encode_options} "
+            f'-force_key_frames "expr:gte(t,n_forced*{chunk_seconds})" -map_metadata -1 -fflags +bitexact '
+            f"-f segment -segment_time {chunk_seconds} -reset_timestamps 1 "
+            f"-segment_format matroska {output_dir}/chunk_%d.mkv"
+        )
+        subprocess.run(command, shell=True, check=True)
+        response["message"] = f"Video segmented into chunks in {output_dir}"
+    except subprocess.CalledProcessError as err:
+        response["error"] = err.output
+    return response
+
+
+def encode_chunk_range(
+    input_file: str,
+    output_dir: str,
+    first_chunk: int,
+    duration: float,
+    chunk_seconds: int = 1,
+) -> List[str]:
+    """
+    Encode the part of the video starting at chunk first_chunk and lasting
+    duration seconds into chunks of chunk_seconds, numbered from first_chunk.
+
+    The range is encoded into a directory of its own and only its chunks
+    are moved to output_dir. A trailing segment past the end of the range,
+    left by keyframe rounding of a fractional duration, would otherwise
+    overwrite the first chunk of the next range.
+
+    Returns the paths of the chunk files that were written.
+    """
+    range_dir = f"{output_dir}_range_{first_chunk}"
+    os.makedirs(range_dir, exist_ok=True)
+    try:
+        command = (
+            f"ffmpeg -ss {first_chunk * chunk_seconds} -t {duration} -i {input_file} -c:v libvpx-vp9 "
+            f'-force_key_frames "expr:gte(t,n_forced*{chunk_seconds})" -map_metadata -1 -fflags +bitexact '
+            f"-f segment -segment_time {chunk_seconds} -segment_start_number {first_chunk} "
+            f"-reset_timestamps 1 -segment_format matroska {range_dir}/chunk_%d.mkv"
+        )
+        subprocess.run(command, shell=True, check=True)
+        chunk_files = []
+        for i in range(first_chunk, first_chunk + math.ceil(duration / chunk_seconds)):
+            if os.path.isfile(f"{range_dir}/chunk_{i}.mkv"):
+                os.replace(f"{range_dir}/chunk_{i}.mkv", f"{output_dir}/chunk_{i}.mkv")
+                chunk_files.append(f"{output_dir}/chunk_{i}.mkv")
+        return chunk_files
+    finally:
+        shutil.rmtree(range_dir, ignore_errors=True)
+
+
+def disassemble_video_parallel(
+    input_file: str,
+    output_dir: str,
+    on_chunks: Optional[Callable[[List[str]], None]] = None,
+    video_duration: Optional[float] = None,
+    chunk_seconds: int = 1,
+) -> Dict:
+    """
+    Disassemble a video into chunks, encoding ranges of the timeline at the
+    same time.
+
+    The timeline is split into ranges of DISASSEMBLE_RANGE_SECONDS, rounded
+    down to whole chunks, and up to DISASSEMBLE_WORKERS ffmpeg processes
+    encode them concurrently. Every range writes the same chunk_N.mkv files
+    as the other modes. on_chunks is called with the chunk files of each
+    range as soon as it is finished. The video is probed for its duration
+    unless video_duration is given.
+    """
+    response: Dict = {}
+    chunks = []
+    errors = []
+
+    if video_duration is None:
+        video_duration = get_video_duration(input_file)
+    range_chunks = max(config.DISASSEMBLE_RANGE_SECONDS // chunk_seconds, 1)
+    num_chunks = math.ceil(video_duration / chunk_seconds)
+    ranges = [
+        (
+            first_chunk,
+            min(
+                range_chunks * chunk_seconds,
+                video_duration - first_chunk * chunk_seconds,
+            ),
+        )
+        for first_chunk in range(0, num_chunks, range_chunks)
+    ]
+
+    with ThreadPoolExecutor(max_workers=config.DISASSEMBLE_WORKERS) as executor:
+        futures = {
+            executor.submit(
+                encode_chunk_range,
+                input_file,
+                output_dir,
+                first_chunk,
+                duration,
+                chunk_seconds,
+            ): (first_chunk, duration)
+            for first_chunk, duration in ranges
+        }
+        for future in as_completed(futures):
+            try:
+                chunk_files = future.result()
+            except subprocess.CalledProcessError as err:
+                errors.append(err.output)
+                continue
+
+            # only the last chunk of the video may be missing, when the video
+            # ends before its probed duration
+            first_chunk, duration = futures[future]
+            expected_chunks = math.ceil(duration / chunk_seconds)
+            if len(chunk_files) < expected_chunks and (
+                first_chunk + expected_chunks < num_chunks
+                or len(chunk_files) < expected_chunks - 1
+            ):
+                errors.append(
+                    f"range at chunk {first_chunk} has {len(chunk_files)} of "
+                    f"{expected_chunks} chunks"
+                )
+            chunks.extend(chunk_files)
+            if on_chunks:
+                on_chunks(chunk_files)
+
+    if errors:
+        response["error"] = errors
+    else:
+        response["message"] = f"Video chunks: {sorted(chunks)}"
+    return response
+
+
+def get_keyframe_chunk_times(
+    keyframe_times: List[float], video_duration: float, chunk_seconds: int = 1
+) -> Optional[List[float]]:
+    """
+    Choose the chunks of a video that is cut at its keyframes, every chunk
+    starts at the first keyframe chunk_seconds or more after the start of
+    the previous chunk.
+
+    Returns the start time of every chunk and the end time of the last
+    chunk, or None if a chunk would be longer than
+    VIDEO_COPY_MAX_CHUNK_SECONDS, or than twice chunk_seconds if that is
+    longer.
+    """
+    if not keyframe_times:
+        return None
+
+    chunk_times = [keyframe_times[0]]
+    for keyframe_time in keyframe_times[1:]:
+        if keyframe_time - chunk_times[-1] >= chunk_seconds:
+            chunk_times.append(keyframe_time)
+    chunk_times.append(max(keyframe_times[0] + video_duration, chunk_times[-1]))
+
+    chunk_durations = [end - start for start, end in zip(chunk_times, chunk_times[1:])]
+    if max(chunk_durations) > max(
+        config.VIDEO_COPY_MAX_CHUNK_SECONDS, 2 * chunk_seconds
+    ):
+        return None
+    return chunk_times
+
+
+def get_start_time(input_file: str) -> float:
+    """
+    Get the start time of a file in seconds using ffprobe.
+    """
+    command = f"ffprobe -v error -show_entries format=start_time -of default=noprint_wrappers=1:nokey=1 {input_file}"
+    try:
+        return float(
+            subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+            .stdout.strip()
+            .decode("utf-8")
+        )
+    except ValueError:
+        return 0.0
+
+
+def segment_at_chunk_times(
+    input_file: str, output_pattern: str, options: str, chunk_times: List[float]
+) -> None:
+    """
+    Cut a file into chunks at the given chunk times without re-encoding,
+    with the segment muxer options for the track and format of the chunks.
+
+    ffmpeg moves the start of the file to zero, the chunk times are moved
+    with it so the extracted audio and video are cut at the same times even
+    if they do not start together. Every SEGMENT_TIMES_PER_PROCESS chunks
+    are cut by one ffmpeg process, which starts at its first chunk and
+    numbers the chunks from it.
+    """
+    start_time = get_start_time(input_file)
+    chunk_times = [chunk_time - start_time for chunk_time in chunk_times]
+    last_chunk = len(chunk_times) - 2
+    for first_chunk in range(0, last_chunk + 1, SEGMENT_TIMES_PER_PROCESS):
+        next_chunk = min(first_chunk + SEGMENT_TIMES_PER_PROCESS, last_chunk + 1)
+
+        # the chunks before the first chunk are read but dropped, seeking
+        # in the audio without an index would not stop at the right packet
+        cut = ""
+        offset = 0.0
+        if first_chunk:
+            offset = chunk_times[first_chunk] - SEGMENT_TIME_DELTA
+            cut += f"-ss {offset:.3f} "
+        if next_chunk <= last_chunk:
+            cut += f"-to {chunk_times[next_chunk] - SEGMENT_TIME_DELTA:.3f} "
+
+        # without segment times the segment muxer cuts every two seconds
+        segment_times = chunk_times[first_chunk + 1 : next_chunk]
+        segments = f"-segment_time {math.ceil(chunk_times[-1]) + 1}"
+        if segment_times:
+            segments = "-segment_times " + ",".join(
+                f"{segment_time - offset:.3f}" for segment_time in segment_times
+            )
+
+        command = (
+            f"ffmpeg -i {input_file} {cut}{options} "
+            f"-map_metadata -1 -fflags +bitexact -f segment {segments} "
+            f"-segment_time_delta {SEGMENT_TIME_DELTA} "
+            f"-segment_start_number {first_chunk} -reset_timestamps 1 {output_pattern}"
+        )
+        subprocess.run(command, shell=True, check=True)
+
+
+def segment_video_at_keyframes(
+    input_file: str, output_dir: str, chunk_times: List[float]
+) -> Dict:
+    """
+    Disassemble a vp9 video into chunks at its keyframes without re-encoding,
+    chunk_times are from get_keyframe_chunk_times.
+    """
+    response: Dict = {}
+    try:
+        segment_at_chunk_times(
+            input_file,
+            f"{output_dir}/chunk_%d.mkv",
+            "-c:v copy -segment_format matroska",
+            chunk_times,
+        )
+        response["message"] = f"Video cut into chunks at keyframes in {output_dir}"
+    except subprocess.CalledProcessError as err:
+        response["error"] = err.output
+    return response
+
+
+def disassemble_video(
+    input_file: str,
+    output_dir: str,
+    on_chunks: Optional[Callable[[List[str]], None]] = None,
+    video_duration: Optional[float] = None,
+    chunk_times: Optional[List[float]] = None,
+    chunk_seconds: int = 1,
+) -> Dict:
+    """
+    Disassemble a video into chunks of chunk_seconds using the configured
+    mode, or at the given chunk times without re-encoding.
+
+    If on_chunks is given it is called with lists of finished chunk files.
+    Only the parallel mode calls it while encoding, the other modes call it
+    once with all the chunks at the end. video_duration saves probing the
+    video again when it is known.
+    """
+    if not chunk_times and config.DISASSEMBLE_MODE == "parallel":
+        return disassemble_video_parallel(
+            input_file, output_dir, on_chunks, video_duration, chunk_seconds
+        )
+
+    if chunk_times:
+        response = segment_video_at_keyframes(input_file, output_dir, chunk_times)
+    elif config.DISASSEMBLE_MODE == "per_second":
+        response = disassemble_video_per_second(
+            input_file, output_dir, video_duration, chunk_seconds
+        )
+    else:
+        response = segment_video(input_file, output_dir, chunk_seconds)
+
+    if on_chunks and "error" not in response:
+        on_chunks(
+            [
+                os.path.join(output_dir, chunk_file)
+                for chunk_file in os.listdir(output_dir)
+            ]
+        )
+    return response
+
+
+def disassemble_rendition(
+    input_file: str,
+    output_dir: str,
+    height: int,
+    bitrate: str,
+    chunk_times: Optional[List[float]] = None,
+    chunk_seconds: int = 1,
+) -> Dict:
+    """
+    Encode a rendition of a video at the given height and bitrate and
+    disassemble it into chunks with the same boundaries as the chunks of the
+    source rendition, of chunk_seconds or at the given chunk times.
+
+    A video cut at its own keyframes is encoded with keyframes where it has
+    them, and the encoded rendition is cut at the chunk times like the source.
+    """
+    encode_options = f"-vf scale=-2:{height} -b:v {bitrate}"
+    if not chunk_times:
+        return segment_video(input_file, output_dir, chunk_seconds, encode_options)
+
+    response: Dict = {}
+    encoded_file = f"{output_dir}.mkv"
+    try:
+        command = (
+            f"ffmpeg -i {input_file} -c:v libvpx-vp9 {encode_options} "
+            f"-force_key_frames source -map_metadata -1 -fflags +bitexact {encoded_file}"
+        )
+        subprocess.run(command, shell=True, check=True)
+    except subprocess.CalledProcessError as err:
+        response["error"] = err.output
+        return response
+
+    # the encoded rendition starts at zero like the chunk times of the input
+    start_time = get_start_time(input_file)
+    response = segment_video_at_keyframes(
+        encoded_file,
+        output_dir,
+        [chunk_time - start_time for chunk_time in chunk_times],
+    )
+    os.remove(encoded_file)
+    return response
+
+
+def disassemble_audio(
+    input_file: str,
+    output_dir: str,
+    chunk_times: Optional[List[float]] = None,
+    chunk_seconds: int = 1,
+) -> Dict:
+    """
+    Disassemble an opus audio file into chunks of chunk_seconds, or at the
+    chunk times of the video, without re-encoding. Chunk N has the audio of
+    the video chunk N.
+    """
+    response: Dict = {}
+    try:
+        if chunk_times:
+            segment_at_chunk_times(
+                input_file,
+                f"{output_dir}/chunk_%d.webm",
+                "-c:a copy -segment_format webm",
+                chunk_times,
+            )
+            response["message"] = f"Audio cut into chunks in {output_dir}"
+            return response
+        command = (
+            f"ffmpeg -i {input_file} -c:a copy -map_metadata -1 -fflags +bitexact "
+            f"-f segment -segment_time {chunk_seconds} -reset_timestamps 1 "
+            f"-segment_format webm {output_dir}/chunk_%d.webm"
+        )
+        subprocess.run(command, shell=True, check=True)
+        response["message"] = f"Audio segmented into chunks in {output_dir}"
+    except subprocess.CalledProcessError as err:
+        response["error"] = err.output
+    return response
+
+
+def fragment_chunk(chunk_file: str, output_file: str, offset: float) -> bool:
+    """
+    Remux a chunk into a fragmented MP4 chunk starting at offset seconds,
+    the fragmented chunk keeps its initialization segment.
+    """
+    command = (
+        ["ffmpeg", "-i", chunk_file]
+        + containerize.get_fragment_options(offset)
+        + ["-f", "mp4", "-y", output_file]
+    )
+    return subprocess.run(command).returncode == 0
+
+
+def fragment_chunks(
+    chunk_files: List[str],
+    output_dir: str,
+    chunk_times: Optional[List[float]] = None,
+    chunk_seconds: int = 1,
+) -> Dict:
+    """
+    Remux chunks into fragmented MP4 chunks with the same names in
+    output_dir, up to DISASSEMBLE_WORKERS at a time. The timestamps of every
+    chunk are moved to its start time, from the chunk times of a video cut
+    at its keyframes or from the chunk seconds.
+    """
+    response: Dict = {}
+    os.makedirs(output_dir, exist_ok=True)
+
+    fragments = {}
+    for chunk_file in chunk_files:
+        chunk_name = os.path.splitext(os.path.basename(chunk_file))[0]
+        chunk_number = int(chunk_name.split("_")[1])
+        fragments[os.path.join(output_dir, f"{chunk_name}.mp4")] = (
+            chunk_file,
+            timeline.get_chunk_start(chunk_times, chunk_seconds, chunk_number),
+        )
+
+    with ThreadPoolExecutor(max_workers=config.DISASSEMBLE_WORKERS) as executor:
+        statuses = executor.map(
+            lambda fragment: fragment_chunk(
+                fragments[fragment][0], fragment, fragments[fragment][1]
+            ),
+            fragments,
+        )
+        failed = [
+            fragment for fragment, status in zip(fragments, statuses) if not status
+        ]
+
+    if failed:
+        response["error"] = f"Could not fragment the chunks: {sorted(failed)}"
+    else:
+        response["fragment_files"] = list(fragments)
+    return response
@@ -3,14 +3,26 @@ This module is responsible for egressing the video from redis and saving it as a
  the cache directory.
 """
 
+import asyncio
+import errno
 import os
-from typing import List
+import shutil
+from asyncio.subprocess import Process
+from typing import AsyncIterator, BinaryIO, Dict, List, Optional, Tuple
+
+from redis.asyncio.lock import Lock
 
 import assemble
+import asyncdb
 import config
 import containerize
 import db
 import information
+import manifest
+import packed
+import rendition
+import tier
+import timeline
 import unique
 
 
@@ -35,45 +47,63 @@ def get_video_chunks(video_id: str) -> List:
     return db.get_video_chunks(video_id=video_id)
 
 
-def save_audio_from_redis_as_file(video_id: str, output_file: str) -> None:
+async def run_ffmpeg(ffmpeg_cmd: List[str]) -> bool:
+    """
+    Run an ffmpeg command without blocking the event loop.
+    """
+    process = await asyncio.create_subprocess_exec(*ffmpeg_cmd)
+    return await process.wait() == 0
+
+
+async def save_audio_from_redis_as_file(video_id: str, output_file: str) -> bool:
     """
     Save the audio from redis as a file.
+
+    Returns False if the audio is not stored.
     """
-    file_data = db.get_audio(video_id=video_id)
+    file_data = await tier.get_audio(video_id=video_id)
+    if file_data is None:
+        return False
     with open(output_file, "wb") as file:
         file.write(file_data)
+    return True
 
 
-def cut_audio_based_on_start_end_time(
-    input_file: str, output_file: str, video_id: str, start: int, end: int
-) -> None:
+async def cut_audio_based_on_start_end_time(
+    input_file: str, output_file: str, video_id: str, first_chunk: int, last_chunk: int
+) -> bool:
     """
-    Cut the audio based on the start and end time using ffmpeg.
-    The start and end time are in seconds.
+    Cut the audio of the video chunks first_chunk to last_chunk using ffmpeg.
     """
-    duration = int(information.get_video_information(video_id=video_id)["duration"])
-
-    if end == -1:
-        end = duration
+    offset, duration = timeline.get_chunk_offset(
+        await timeline.get_chunk_times(video_id), first_chunk, last_chunk
+    )
 
-    ffmpeg_t = f"-t {end - start + 1}" if end != duration else ""
+    ffmpeg_t = ["-t", str(duration)] if duration is not None else []
 
-    os.system(f"ffmpeg -i {input_file} -ss {start} {ffmpeg_t} -c copy {output_file}")
+    return await run_ffmpeg(
+        ["ffmpeg", "-i", input_file, "-ss", str(offset)]
+        + ffmpeg_t
+        + ["-c", "copy", output_file]
+    )
 
 
-def save_chunks_as_file(
-    video_id: str, video_chunk_dir: str, start: int, end: int
+async def save_chunks_as_file(
+    video_id: str,
+    video_chunk_dir: str,
+    first_chunk: int,
+    last_chunk: int,
+    track: str = "video",
 ) -> List:
     """
-    Save all the video and audio chunks as files.
+    Save all the video chunks of the video track of a rendition as files.
     """
-    if end == -1:
-        end = int(information.get_video_information(video_id=video_id)["duration"])
-
-    required_chunks = generate_all_chunks_in_range(start, end)
+    required_chunks = generate_all_chunks_in_range(first_chunk, last_chunk)
 
     # save video chunks
-    for video_chunk in get_video_chunks(video_id=video_id):
+    for video_chunk in await tier.get_video_chunks_by_chunk_ids(
+        video_id=video_id, chunk_ids=required_chunks, track=track
+    ):
 
         chunk_id, chunk = list(video_chunk[1].items())[0]
         chunk_id = chunk_id.decode("utf-8")
@@ -88,89 +118,169 @@ def save_chunks_as_file(
     return required_chunks
 
 
-def egress(video_id: str, start: int, end: int) -> str:
+async def save_audio_chunks_as_file(
+    video_id: str, audio_chunk_dir: str, first_chunk: int, last_chunk: int
+) -> List:
     """
-    Egress the video from redis and save it as a file in the cache directory.
+    Save the audio chunks of the requested video chunks as files.
+    """
+    required_chunks = generate_all_chunks_in_range(first_chunk, last_chunk)
+
+    saved_chunks = []
+    for audio_chunk in await tier.get_audio_chunks_by_chunk_ids(
+        video_id=video_id, chunk_ids=required_chunks
+    ):
+        chunk_id, chunk = list(audio_chunk[1].items())[0]
+        chunk_id = chunk_id.decode("utf-8")
 
-    Returns the path to the video file.
+        if chunk_id not in required_chunks:
+            continue
+
+        with open(f"{audio_chunk_dir}/{chunk_id}.webm", "wb") as file:
+            file.write(chunk)
+        saved_chunks.append(chunk_id)
+
+    # the audio may end slightly before the video, so the last chunks can be missing
+    saved_chunks.sort(key=lambda x: int(x.split("_")[1]))
+    return saved_chunks
+
+
+async def get_packed_chunk_urls(
+    video_id: str, track: str, first_chunk: int, last_chunk: int
+) -> List[str]:
     """
+    Get the subfile URLs of the requested chunks in the packed files.
 
-    # create temporary directory
-    egress_dir = os.path.join(config.EGRESS_PATH, unique.get_new_fetch_id())
-    os.mkdir(egress_dir)
+    Returns an empty list unless the chunks are stored in packed files.
+    """
+    if config.CHUNK_BACKEND != "packed" or await tier.is_cold(video_id):
+        return []
 
-    # create audio and video chunk directory
-    audio_chunk_dir = os.path.join(egress_dir, "chunks", "audio")
-    video_chunk_dir = os.path.join(egress_dir, "chunks", "video")
-    os.makedirs(audio_chunk_dir)
-    os.makedirs(video_chunk_dir)
+    await tier.record_access(video_id)
+    return packed.get_chunk_urls(
+        await tier.get_data_id(video_id),
+        track,
+        generate_all_chunks_in_range(first_chunk, last_chunk),
+    )
 
-    # create directory to store these assembled chunks
-    assembled_chunk_dir = os.path.join(egress_dir, "assembled")
-    os.mkdir(assembled_chunk_dir)
 
-    # create directory to store the final containerized video
-    containerized_video_dir = os.path.join(egress_dir, "containerized")
-    os.mkdir(containerized_video_dir)
+async def get_chunk_inputs(
+    video_id: str, track: str, chunk_dir: str, first_chunk: int, last_chunk: int
+) -> List[str]:
+    """
+    Get the concat demuxer inputs of the requested chunks of a video track
+    or the audio track, in order.
 
-    # create the cache directory for this video if it doesn't exist
-    cache_directory = os.path.join(config.CACHE_PATH, video_id)
-    if not os.path.exists(cache_directory):
-        os.mkdir(cache_directory)
+    Chunks stored in packed files are read in place by ffmpeg, other chunks
+    are saved as files in chunk_dir first.
+    """
+    chunk_urls = await get_packed_chunk_urls(video_id, track, first_chunk, last_chunk)
+    if chunk_urls:
+        return chunk_urls
+
+    if track == "audio":
+        chunks = await save_audio_chunks_as_file(
+            video_id=video_id,
+            audio_chunk_dir=chunk_dir,
+            first_chunk=first_chunk,
+            last_chunk=last_chunk,
+        )
+        return [os.path.join(chunk_dir, chunk + ".webm") for chunk in chunks]
 
-    # save all the chunks as files
-    chunks = save_chunks_as_file(
+    chunks = await save_chunks_as_file(
         video_id=video_id,
-        video_chunk_dir=video_chunk_dir,
-        start=start,
-        end=end,
+        video_chunk_dir=chunk_dir,
+        first_chunk=first_chunk,
+        last_chunk=last_chunk,
+        track=track,
     )
 
     # chunks will have the format chunk_1, chunk_2, chunk_3 etc.
     # we need to sort them in ascending order by the number
     chunks.sort(key=lambda x: int(x.split("_")[1]))
+    return [os.path.join(chunk_dir, chunk + ".mkv") for chunk in chunks]
+
 
-    # assemble the chunks
-    # assembled video path
-    assembled_video_path = os.path.join(assembled_chunk_dir, "video.mkv")
-    video_input_txt_path = os.path.join(assembled_chunk_dir, "video_input.txt")
+async def save_cut_audio_as_file(
+    video_id: str,
+    audio_chunk_dir: str,
+    output_file: str,
+    first_chunk: int,
+    last_chunk: int,
+) -> bool:
+    """
+    Save the audio of the video chunks first_chunk to last_chunk as a file.
 
-    # assemble the video chunks
-    assemble.concatenate_videos(
-        video_files=[os.path.join(video_chunk_dir, chunk + ".mkv") for chunk in chunks],
-        output_file=assembled_video_path,
-        video_input_txt_path=video_input_txt_path,
+    Chunked audio is assembled from the audio chunks of the requested video
+    chunks, audio stored as one blob is saved whole and then cut.
+    Returns False if the audio could not be saved.
+    """
+    video_information = await information.get_video_information_async(video_id)
+    if video_information.get("audio_chunked"):
+        audio_files = await get_chunk_inputs(
+            video_id, "audio", audio_chunk_dir, first_chunk, last_chunk
+        )
+        return bool(audio_files) and not await assemble.concatenate_videos(
+            video_files=audio_files,
+            output_file=output_file,
+            video_input_txt_path=os.path.join(audio_chunk_dir, "audio_input.txt"),
+        )
+
+    full_audio_path = os.path.join(audio_chunk_dir, "full_audio.mkv")
+    if not await save_audio_from_redis_as_file(
+        video_id=video_id, output_file=full_audio_path
+    ):
+        return False
+    return await cut_audio_based_on_start_end_time(
+        input_file=full_audio_path,
+        output_file=output_file,
+        video_id=video_id,
+        first_chunk=first_chunk,
+        last_chunk=last_chunk,
     )
 
-    if information.get_video_information(video_id=video_id).get("audio_codec"):
 
-        full_audio_path = os.path.join(assembled_chunk_dir, "full_audio.mkv")
-        save_audio_from_redis_as_file(
-            video_id=video_id,
-            output_file=full_audio_path,
-        )
+async def get_chunk_range(video_id: str, start: int, end: int) -> Tuple[int, int]:
+    """
+    Get the first and last chunk of the video covering the requested seconds.
+    """
+    return timeline.get_chunk_range(
+        await timeline.get_chunk_times(video_id), start, end
+    )
 
-        cut_audio_path = os.path.join(assembled_chunk_dir, "cut_audio.webm")
-        cut_audio_based_on_start_end_time(
-            input_file=full_audio_path,
-            output_file=cut_audio_path,
-            video_id=video_id,
-            start=start,
-            end=end,
-        )
 
-    else:
-        cut_audio_path = None
-
-    # containerize the video
-    containerized_video_path = os.path.join(containerized_video_dir, "video.webm")
-    containerize.mux_audio_video(
-        audio_file=cut_audio_path,
-        video_file=assembled_video_path,
-        output_file=containerized_video_path,
+def select_rendition(
+    video_information: Dict, rendition_name: Optional[str], max_bitrate: Optional[int]
+) -> Optional[str]:
+    """
+    Get the name of the requested rendition of a video, by its name or the
+    highest bitrate up to max_bitrate, the source rendition by default.
+
+    Returns None if the video has no rendition with the given name.
+    """
+    selected = rendition.select_rendition(
+        rendition.get_renditions(video_information), rendition_name, max_bitrate
     )
+    return selected["name"] if selected else None
 
-    # move the containerized video to cache directory
+
+def get_cache_directory(video_id: str, rendition_name: Optional[str] = None) -> str:
+    """
+    Get the cache directory of a rendition of a video, the renditions other
+    than the source are cached in a directory of their own.
+    """
+    cache_directory = os.path.join(config.CACHE_PATH, video_id)
+    if rendition_name and rendition_name != rendition.SOURCE:
+        return os.path.join(cache_directory, rendition_name)
+    return cache_directory
+
+
+async def get_cache_video_path(
+    video_id: str, start: int, end: int, rendition_name: Optional[str] = None
+) -> str:
+    """
+    Get the path of the cached video file for the requested start and end.
+    """
 
     # cache video should have the format video_id_start_end.webm
     # if start is 0 and end is -1 then it should be video_id.webm
@@ -178,67 +288,806 @@ def egress(video_id: str, start: int, end: int) -> str:
     # if start is 10 and end is 20 then it should be video_id_10_20.webm
     # if start is 20 and end is -1 then it should be video_id_20_{duration}.webm
 
+    cache_directory = get_cache_directory(video_id, rendition_name)
+
     if start == 0 and end == -1:
-        cache_video_path = os.path.join(cache_directory, f"{video_id}.webm")
-    elif start == 0:
-        cache_video_path = os.path.join(
-            cache_directory, f"{video_id}_{start}_{end}.webm"
-        )
-    elif end == -1:
-        end = information.get_video_information(video_id=video_id)["duration"]
-        cache_video_path = os.path.join(
-            cache_directory, f"{video_id}_{start}_{end}.webm"
+        return os.path.join(cache_directory, f"{video_id}.webm")
+
+    if end == -1:
+        end = (await information.get_video_information_async(video_id=video_id))[
+            "duration"
+        ]
+
+    return os.path.join(cache_directory, f"{video_id}_{start}_{end}.webm")
+
+
+async def egress(
+    video_id: str, start: int, end: int, rendition_name: Optional[str] = None
+) -> Optional[str]:
+    """
+    Egress a rendition of the video from redis and save it as a file in the
+    cache directory.
+
+    Returns the path to the video file, or None if it could not be egressed.
+    """
+
+    # create temporary directory
+    egress_dir = os.path.join(config.EGRESS_PATH, unique.get_new_fetch_id())
+    os.mkdir(egress_dir)
+
+    try:
+        # create audio and video chunk directory
+        audio_chunk_dir = os.path.join(egress_dir, "chunks", "audio")
+        video_chunk_dir = os.path.join(egress_dir, "chunks", "video")
+        os.makedirs(audio_chunk_dir)
+        os.makedirs(video_chunk_dir)
+
+        # create directory to store these assembled chunks
+        assembled_chunk_dir = os.path.join(egress_dir, "assembled")
+        os.mkdir(assembled_chunk_dir)
+
+        # create directory to store the final containerized video
+        containerized_video_dir = os.path.join(egress_dir, "containerized")
+        os.mkdir(containerized_video_dir)
+
+        # create the cache directory for this video if it doesn't exist
+        os.makedirs(get_cache_directory(video_id, rendition_name), exist_ok=True)
+
+        # save all the chunks as files, unless ffmpeg can read them in place
+        first_chunk, last_chunk = await get_chunk_range(video_id, start, end)
+        video_files = await get_chunk_inputs(
+            video_id,
+            rendition.get_track(rendition_name),
+            video_chunk_dir,
+            first_chunk,
+            last_chunk,
         )
-    else:
-        cache_video_path = os.path.join(
-            cache_directory, f"{video_id}_{start}_{end}.webm"
+
+        # assemble the chunks
+        # assembled video path
+        assembled_video_path = os.path.join(assembled_chunk_dir, "video.mkv")
+        video_input_txt_path = os.path.join(assembled_chunk_dir, "video_input.txt")
+
+        # assemble the video chunks
+        if not video_files or await assemble.concatenate_videos(
+            video_files=video_files,
+            output_file=assembled_video_path,
+            video_input_txt_path=video_input_txt_path,
+        ):
+            print("error while concatenating the video chunks")
+            return None
+
+        video_information = await information.get_video_information_async(video_id)
+        if video_information.get("audio_codec"):
+
+            cut_audio_path = os.path.join(assembled_chunk_dir, "cut_audio.webm")
+            if not await save_cut_audio_as_file(
+                video_id=video_id,
+                audio_chunk_dir=audio_chunk_dir,
+                output_file=cut_audio_path,
+                first_chunk=first_chunk,
+                last_chunk=last_chunk,
+            ):
+                print("error while cutting the audio")
+                return None
+
+        else:
+            cut_audio_path = None
+
+        # containerize the video
+        containerized_video_path = os.path.join(containerized_video_dir, "video.webm")
+        if not await containerize.mux_audio_video(
+            audio_file=cut_audio_path,
+            video_file=assembled_video_path,
+            output_file=containerized_video_path,
+        ):
+            print("error while muxing the audio and video")
+            return None
+
+        # move the containerized video to cache directory, the rename is atomic
+        # so other requests never see a partially written video
+        cache_video_path = await get_cache_video_path(
+            video_id, start, end, rendition_name
         )
+        os.replace(containerized_video_path, cache_video_path)
+        return cache_video_path
+    finally:
+        # delete the temporary directory
+        shutil.rmtree(egress_dir, ignore_errors=True)
 
-    # move the containerized video to cache directory
-    os.system(f"mv {containerized_video_path} {cache_video_path}")
 
-    # delete the temporary directory
-    os.system(f"rm -rf {egress_dir}")
+async def acquire_egress_lock(
+    video_id: str,
+    start: int,
+    end: int,
+    blocking: bool,
+    rendition_name: Optional[str] = None,
+) -> Optional[Lock]:
+    """
+    Acquire the lock for egressing the requested video, so that only one
+    request assembles the same video at a time, in any worker process.
 
-    return cache_video_path
+    If blocking, wait at most EGRESS_LOCK_WAIT seconds for the lock.
+    Returns the lock if it was acquired, else None.
+    """
+    cache_video_name = os.path.relpath(
+        await get_cache_video_path(video_id, start, end, rendition_name),
+        config.CACHE_PATH,
+    )
+    lock = asyncdb.get_lock(
+        f"egress_lock_{cache_video_name}", timeout=config.EGRESS_LOCK_TIMEOUT
+    )
+    try:
+        if await lock.acquire(
+            blocking=blocking, blocking_timeout=config.EGRESS_LOCK_WAIT
+        ):
+            return lock
+    except Exception:
+        pass
+    return None
 
 
-def requested_video_in_cache(video_id: str, start: int, end: int) -> str:
+async def release_egress_lock(lock: Optional[Lock]) -> None:
+    """
+    Release the lock for egressing a video, if it is still held.
+    """
+    if not lock:
+        return
+    try:
+        await lock.release()
+    except Exception:
+        pass
+
+
+async def coalesced_egress(
+    video_id: str, start: int, end: int, rendition_name: Optional[str] = None
+) -> Optional[str]:
+    """
+    Egress the video, unless another request is already egressing the same
+    video. In that case wait for it and serve its result from the cache.
+
+    Returns the path to the video file, or None if it could not be egressed.
+    """
+    lock = await acquire_egress_lock(
+        video_id, start, end, blocking=True, rendition_name=rendition_name
+    )
+    try:
+        cached_video = await requested_video_in_cache(
+            video_id, start, end, rendition_name
+        )
+        if cached_video:
+            return cached_video
+        return await egress(video_id, start, end, rendition_name)
+    finally:
+        await release_egress_lock(lock)
+
+
+async def requested_video_in_cache(
+    video_id: str, start: int, end: int, rendition_name: Optional[str] = None
+) -> str:
     """
     Check if the requested video is in the cache directory.
 
     Returns the path to the video file if it is in the cache directory.
     """
 
-    # cache video should have the format video_id_start_end.webm
-    # if start is 0 and end is -1 then it should be video_id.webm
-    # if start is 0 and end is 10 then it should be video_id_0_10.webm
-    # if start is 10 and end is 20 then it should be video_id_10_20.webm
-    # if start is 20 and end is -1 then it should be video_id_20_{duration}.webm
-
-    cache_directory = os.path.join(config.CACHE_PATH, video_id)
+    cache_directory = get_cache_directory(video_id, rendition_name)
 
     if not os.path.exists(cache_directory):
         return None
 
-    if start == 0 and end == -1:
-        cache_video_path = os.path.join(cache_directory, f"{video_id}.webm")
-    elif start == 0:
-        cache_video_path = os.path.join(
-            cache_directory, f"{video_id}_{start}_{end}.webm"
+    cache_video_path = await get_cache_video_path(video_id, start, end, rendition_name)
+
+    # check if file exist if it does then return it
+    if os.path.isfile(cache_video_path):
+        return cache_video_path
+
+    # otherwise cut the requested video from the cached videos that cover it
+    return await cut_from_cached_videos(video_id, start, end, rendition_name)
+
+
+async def get_cached_video_ranges(
+    video_id: str, rendition_name: Optional[str] = None
+) -> List[Tuple[int, int, str]]:
+    """
+    Get the first chunk, last chunk and path of every cached video of a
+    rendition of a video, the cached videos are named by the requested
+    seconds.
+    """
+    cache_directory = get_cache_directory(video_id, rendition_name)
+    chunk_times = await timeline.get_chunk_times(video_id)
+    cached_video_ranges = []
+
+    for file_name in os.listdir(cache_directory):
+        name, extension = os.path.splitext(file_name)
+        if extension != ".webm":
+            continue
+
+        if name == video_id:
+            cached_video_ranges.append(
+                (
+                    *timeline.get_chunk_range(chunk_times, 0, -1),
+                    os.path.join(cache_directory, file_name),
+                )
+            )
+            continue
+
+        try:
+            _, cached_start, cached_end = name.rsplit("_", 2)
+            cached_video_ranges.append(
+                (
+                    *timeline.get_chunk_range(
+                        chunk_times, int(cached_start), int(cached_end)
+                    ),
+                    os.path.join(cache_directory, file_name),
+                )
+            )
+        except ValueError:
+            continue
+
+    return cached_video_ranges
+
+
+async def find_cached_videos_covering_range(
+    video_id: str,
+    first_chunk: int,
+    last_chunk: int,
+    rendition_name: Optional[str] = None,
+) -> List[Tuple[str, int, int, int]]:
+    """
+    Find cached videos that together cover the chunks first_chunk to
+    last_chunk.
+
+    A single cached video that covers the whole range is preferred, else
+    the range is covered greedily with overlapping cached videos.
+
+    Returns a list of (path, cached first chunk, piece first chunk, piece
+    last chunk) in order, or an empty list if the cached videos do not cover
+    the range.
+    """
+    cached_video_ranges = sorted(
+        await get_cached_video_ranges(video_id, rendition_name)
+    )
+
+    pieces = []
+    chunk = first_chunk
+    while chunk <= last_chunk:
+        covering = [
+            cached_video_range
+            for cached_video_range in cached_video_ranges
+            if cached_video_range[0] <= chunk <= cached_video_range[1]
+        ]
+        if not covering:
+            return []
+
+        cached_first, cached_last, path = max(
+            covering, key=lambda cached_video_range: cached_video_range[1]
         )
-    elif end == -1:
-        end = information.get_video_information(video_id=video_id)["duration"]
-        cache_video_path = os.path.join(
-            cache_directory, f"{video_id}_{start}_{end}.webm"
+        pieces.append((path, cached_first, chunk, min(cached_last, last_chunk)))
+        chunk = cached_last + 1
+
+    return pieces
+
+
+async def cut_cached_video(
+    input_file: str, output_file: str, offset: float, duration: Optional[float]
+) -> bool:
+    """
+    Cut a part of a cached video without re-encoding.
+    The offset and duration are in seconds, every chunk starts with a
+    keyframe so a cut at the start of a chunk is exact.
+    """
+    cut_cmd = ["ffmpeg", "-i", input_file, "-ss", str(offset)]
+    if duration is not None:
+        cut_cmd += ["-t", str(duration)]
+    cut_cmd += ["-c", "copy", "-y", output_file]
+
+    return await run_ffmpeg(cut_cmd)
+
+
+async def cut_from_cached_videos(
+    video_id: str, start: int, end: int, rendition_name: Optional[str] = None
+) -> Optional[str]:
+    """
+    Produce the requested video from the cached videos that cover it, and
+    store it in the cache directory.
+
+    Returns the path to the video file, or None if the cached videos do not
+    cover the requested video.
+    """
+    chunk_times = await timeline.get_chunk_times(video_id)
+    first_chunk, last_chunk = timeline.get_chunk_range(chunk_times, start, end)
+
+    pieces = await find_cached_videos_covering_range(
+        video_id, first_chunk, last_chunk, rendition_name
+    )
+    if not pieces:
+        return None
+
+    egress_dir = os.path.join(config.EGRESS_PATH, unique.get_new_fetch_id())
+    os.mkdir(egress_dir)
+
+    try:
+        piece_paths = []
+        for index, (path, cached_first, piece_first, piece_last) in enumerate(pieces):
+            piece_path = os.path.join(egress_dir, f"piece_{index}.webm")
+            offset, duration = timeline.get_chunk_offset(
+                chunk_times, piece_first, piece_last
+            )
+            if not await cut_cached_video(
+                input_file=path,
+                output_file=piece_path,
+                offset=offset - chunk_times[cached_first],
+                duration=duration,
+            ):
+                return None
+            piece_paths.append(piece_path)
+
+        if len(piece_paths) == 1:
+            video_path = piece_paths[0]
+        else:
+            video_path = os.path.join(egress_dir, "video.webm")
+            await assemble.concatenate_videos(
+                video_files=piece_paths,
+                output_file=video_path,
+                video_input_txt_path=os.path.join(egress_dir, "video_input.txt"),
+            )
+            if not os.path.isfile(video_path):
+                return None
+
+        cache_video_path = await get_cache_video_path(
+            video_id, start, end, rendition_name
         )
+        os.replace(video_path, cache_video_path)
+        return cache_video_path
+    finally:
+        shutil.rmtree(egress_dir, ignore_errors=True)
+
+
+# ffmpeg is polled this often until it opens the named pipe of a chunk
+PIPE_POLL_SECONDS = 0.005
+
+
+async def get_chunks(
+    video_id: str, track: str, chunk_ids: List[str]
+) -> Dict[str, bytes]:
+    """
+    Get the given chunks of a video track or the audio track by chunk id,
+    missing chunks are left out.
+    """
+    chunks = {}
+    for entry in await tier.get_chunks_by_chunk_ids(video_id, track, chunk_ids):
+        chunk_id, chunk = list(entry[1].items())[0]
+        chunk_id = chunk_id.decode("utf-8")
+        if chunk_id in chunk_ids:
+            chunks[chunk_id] = chunk
+    return chunks
+
+
+def make_chunk_pipes(pipe_dir: str, chunk_ids: List[str]) -> Dict[str, str]:
+    """
+    Create a named pipe for each chunk, ffmpeg reads the chunks from them as
+    if they were files.
+
+    Returns the paths of the pipes by chunk id, in order.
+    """
+    os.makedirs(pipe_dir)
+    pipe_paths = {}
+    for chunk_id in chunk_ids:
+        pipe_paths[chunk_id] = os.path.join(pipe_dir, chunk_id)
+        os.mkfifo(pipe_paths[chunk_id])
+    return pipe_paths
+
+
+def write_to_pipe(pipe_fd: int, chunk: bytes) -> None:
+    """
+    Write a chunk to an open named pipe and close it.
+    """
+    with open(pipe_fd, "wb") as pipe_file:
+        pipe_file.write(chunk)
+
+
+async def write_chunk_to_pipe(pipe_path: str, chunk: bytes, process: Process) -> bool:
+    """
+    Write a chunk to its named pipe once ffmpeg opens it for reading.
+
+    The pipe is opened without blocking until ffmpeg opens it, so that the
+    wait ends if ffmpeg exits first.
+    Returns False if ffmpeg exited before reading the chunk.
+    """
+    while True:
+        try:
+            pipe_fd = os.open(pipe_path, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError as err:
+            if err.errno != errno.ENXIO:
+                raise
+        if process.returncode is not None:
+            return False
+        await asyncio.sleep(PIPE_POLL_SECONDS)
+
+    os.set_blocking(pipe_fd, True)
+    await asyncio.to_thread(write_to_pipe, pipe_fd, chunk)
+    return True
+
+
+async def feed_chunks(
+    video_id: str,
+    track: str,
+    pipe_paths: Dict[str, str],
+    process: Process,
+    chunks: Optional[Dict[str, bytes]] = None,
+) -> None:
+    """
+    Feed the chunks of a video track or the audio track to ffmpeg through
+    their named pipes, in order. Unless the chunks are given they are read
+    from redis EGRESS_PIPE_CHUNKS chunks at a time.
+
+    ffmpeg is killed if a chunk can not be fed, so that it does not wait
+    for it forever.
+    """
+    chunk_ids = list(pipe_paths)
+    try:
+        for batch_start in range(0, len(chunk_ids), config.EGRESS_PIPE_CHUNKS):
+            batch = chunk_ids[batch_start : batch_start + config.EGRESS_PIPE_CHUNKS]
+            batch_chunks = chunks or await get_chunks(video_id, track, batch)
+            for chunk_id in batch:
+                if not await write_chunk_to_pipe(
+                    pipe_paths[chunk_id], batch_chunks[chunk_id], process
+                ):
+                    return
+    except Exception as err:
+        print("error while feeding chunks to ffmpeg: ", err)
+        if process.returncode is None:
+            process.kill()
+
+
+async def get_stream_inputs(
+    video_id: str, track: str, pipe_dir: str, first_chunk: int, last_chunk: int
+) -> Tuple[List[str], Dict[str, str], Optional[Dict[str, bytes]]]:
+    """
+    Get the concat demuxer inputs of the requested chunks of a video track
+    or the audio track for a stream, in order.
+
+    Chunks stored in packed files are read in place by ffmpeg, other chunks
+    are read through named pipes that are fed from redis with feed_chunks
+    once ffmpeg is started. Pipes are only made for the stored chunks, as
+    ffmpeg would wait forever for a chunk that is never fed. The audio may
+    end slightly before the video, and the audio chunks, which are small,
+    are read from redis at once, the video chunks are looked up in their
+    chunk index.
+
+    Returns the inputs, the named pipes by chunk id and the chunks read.
+    """
+    chunk_urls = await get_packed_chunk_urls(video_id, track, first_chunk, last_chunk)
+    if chunk_urls:
+        return chunk_urls, {}, None
+
+    chunk_ids = generate_all_chunks_in_range(first_chunk, last_chunk)
+    chunks = None
+    if track == "audio":
+        chunks = await get_chunks(video_id, track, chunk_ids)
+        chunk_ids = [chunk_id for chunk_id in chunk_ids if chunk_id in chunks]
     else:
-        cache_video_path = os.path.join(
-            cache_directory, f"{video_id}_{start}_{end}.webm"
+        chunk_ids = await tier.get_stored_chunk_ids(video_id, track, chunk_ids)
+
+    pipe_paths = make_chunk_pipes(pipe_dir, chunk_ids)
+    return list(pipe_paths.values()), pipe_paths, chunks
+
+
+# streams that are still being muxed, they are muxed to the end even when
+# their client disconnects
+mux_tasks = set()
+
+
+async def mux_stream_to_file(
+    process: Process,
+    stream_file: BinaryIO,
+    progress: asyncio.Event,
+    feed_tasks: List[asyncio.Task],
+    cache_video_path: Optional[str],
+    egress_dir: str,
+    lock: Optional[Lock],
+) -> None:
+    """
+    Write the output of a mux stream process to a file as fast as it is
+    produced, setting progress after every buffer.
+
+    If cache_video_path is given the file is remuxed to it once the process
+    is done, so that the cached video has cues and a duration. The
+    temporary directory is deleted and the egress lock released as soon as
+    the video is muxed, not when the client of the stream has read it, so
+    the requests waiting for the lock are served from the cache without
+    waiting for a slow client.
+    """
+    try:
+        while True:
+            buffer = await process.stdout.read(config.EGRESS_BUFFER_SIZE)
+            if not buffer:
+                break
+            stream_file.write(buffer)
+            stream_file.flush()
+            progress.set()
+
+        if await process.wait() == 0 and cache_video_path:
+            remuxed_video_path = os.path.join(egress_dir, "remuxed.webm")
+            if await containerize.remux(stream_file.name, remuxed_video_path):
+                os.makedirs(os.path.dirname(cache_video_path), exist_ok=True)
+                os.replace(remuxed_video_path, cache_video_path)
+    except Exception as err:
+        print("error while muxing a stream: ", err)
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        for feed_task in feed_tasks:
+            feed_task.cancel()
+        stream_file.close()
+        shutil.rmtree(egress_dir, ignore_errors=True)
+        await release_egress_lock(lock)
+
+
+async def read_muxed_stream(
+    stream_path: str, mux_task: asyncio.Task, progress: asyncio.Event
+) -> AsyncIterator[bytes]:
+    """
+    Read the file a mux stream is written to while it is growing, until the
+    mux task is done and the whole file is read.
+    """
+    with open(stream_path, "rb") as stream_file:
+        while True:
+            done = mux_task.done()
+            progress.clear()
+            buffer = stream_file.read(config.EGRESS_BUFFER_SIZE)
+            if buffer:
+                yield buffer
+            elif done:
+                break
+            else:
+                await progress.wait()
+
+
+async def stream_egress(
+    video_id: str,
+    start: int,
+    end: int,
+    lock: Optional[Lock] = None,
+    rendition_name: Optional[str] = None,
+) -> AsyncIterator[bytes]:
+    """
+    Egress a rendition of the video from redis as a stream of webm bytes.
+
+    A single ffmpeg process concatenates the requested video chunks and
+    muxes them with the audio, the chunks are fed to it from redis through
+    named pipes. Only audio stored as one blob is cut into a temporary
+    directory first. The output is written to a file in the temporary
+    directory as fast as it is produced and yielded from there, so the
+    client gets the first bytes without waiting for the whole video and
+    ffmpeg does not wait for the client.
+
+    If EGRESS_STREAM_TO_CACHE is set the video is remuxed to the cache
+    directory once it is complete. The egress lock, if given, is released
+    once the video is muxed.
+    """
+
+    # create temporary directory
+    egress_dir = os.path.join(config.EGRESS_PATH, unique.get_new_fetch_id())
+    os.mkdir(egress_dir)
+
+    mux_task = None
+    stream_file = None
+    process = None
+
+    try:
+        first_chunk, last_chunk = await get_chunk_range(video_id, start, end)
+        track = rendition.get_track(rendition_name)
+        video_inputs, video_pipes, _ = await get_stream_inputs(
+            video_id,
+            track,
+            os.path.join(egress_dir, "pipes", "video"),
+            first_chunk,
+            last_chunk,
         )
+        video_input_txt_path = os.path.join(egress_dir, "video_input.txt")
+        assemble.write_concat_list(video_inputs, video_input_txt_path)
 
-    # check if file exist if it does then return it
-    if os.path.isfile(cache_video_path):
-        return cache_video_path
+        # stream copy seeking on the input does not drop the audio before the
+        # start, so the audio is concatenated from its chunks or cut on its own
+        audio_input_txt_path = None
+        audio_pipes = {}
+        audio_chunks = None
+        video_information = await information.get_video_information_async(video_id)
+        if video_information.get("audio_codec"):
+            if video_information.get("audio_chunked"):
+                audio_inputs, audio_pipes, audio_chunks = await get_stream_inputs(
+                    video_id,
+                    "audio",
+                    os.path.join(egress_dir, "pipes", "audio"),
+                    first_chunk,
+                    last_chunk,
+                )
+            else:
+                audio_inputs = [os.path.join(egress_dir, "cut_audio.webm")]
+                await save_cut_audio_as_file(
+                    video_id=video_id,
+                    audio_chunk_dir=egress_dir,
+                    output_file=audio_inputs[0],
+                    first_chunk=first_chunk,
+                    last_chunk=last_chunk,
+                )
+            audio_input_txt_path = os.path.join(egress_dir, "audio_input.txt")
+            assemble.write_concat_list(audio_inputs, audio_input_txt_path)
 
-    return None
+        cache_video_path = None
+        if config.EGRESS_STREAM_TO_CACHE:
+            cache_video_path = await get_cache_video_path(
+                video_id, start, end, rendition_name
+            )
+
+        stream_path = os.path.join(egress_dir, "video.webm")
+        stream_file = open(stream_path, "wb")
+        process = await containerize.open_concat_mux_stream(
+            video_input_txt_path=video_input_txt_path,
+            audio_input_txt_path=audio_input_txt_path,
+        )
+
+        feed_tasks = [
+            asyncio.create_task(feed_chunks(video_id, track, video_pipes, process))
+        ]
+        if audio_pipes:
+            feed_tasks.append(
+                asyncio.create_task(
+                    feed_chunks(video_id, "audio", audio_pipes, process, audio_chunks)
+                )
+            )
+
+        # from here on the mux task cleans up, the stream is read until it is done
+        progress = asyncio.Event()
+        mux_task = asyncio.create_task(
+            mux_stream_to_file(
+                process,
+                stream_file,
+                progress,
+                feed_tasks,
+                cache_video_path,
+                egress_dir,
+                lock,
+            )
+        )
+        mux_tasks.add(mux_task)
+        mux_task.add_done_callback(mux_tasks.discard)
+        mux_task.add_done_callback(lambda _: progress.set())
+    finally:
+        if not mux_task:
+            if process and process.returncode is None:
+                process.kill()
+                await process.wait()
+            if stream_file:
+                stream_file.close()
+            shutil.rmtree(egress_dir, ignore_errors=True)
+            await release_egress_lock(lock)
+
+    async for buffer in read_muxed_stream(stream_path, mux_task, progress):
+        yield buffer
+
+
+async def get_audio_chunk(video_id: str, chunk_number: int) -> bytes:
+    """
+    Get the audio of a single chunk.
+
+    Chunked audio is read as stored in redis, audio stored as one blob is
+    cut with ffmpeg.
+    """
+    if not 0 <= chunk_number < await tier.get_video_chunk_count(video_id=video_id):
+        return None
+
+    video_information = await information.get_video_information_async(video_id)
+    if video_information.get("audio_chunked"):
+        for audio_chunk in await tier.get_audio_chunks_by_chunk_ids(
+            video_id=video_id, chunk_ids=[f"chunk_{chunk_number}"]
+        ):
+            chunk_id, chunk = list(audio_chunk[1].items())[0]
+            if chunk_id.decode("utf-8") == f"chunk_{chunk_number}":
+                return bytes(chunk)
+        return None
+
+    egress_dir = os.path.join(config.EGRESS_PATH, unique.get_new_fetch_id())
+    os.mkdir(egress_dir)
+
+    try:
+        cut_audio_path = os.path.join(egress_dir, "cut_audio.webm")
+        await save_cut_audio_as_file(
+            video_id=video_id,
+            audio_chunk_dir=egress_dir,
+            output_file=cut_audio_path,
+            first_chunk=chunk_number,
+            last_chunk=chunk_number,
+        )
+
+        with open(cut_audio_path, "rb") as file:
+            return file.read()
+    finally:
+        shutil.rmtree(egress_dir, ignore_errors=True)
+
+
+async def fragment_chunk(
+    video_id: str, chunk_number: int, chunk: Optional[bytes]
+) -> Optional[Tuple[bytes, bytes]]:
+    """
+    Remux a video or audio chunk into the fragmented MP4 initialization
+    segment and media segment served by HLS, the media segment starts at
+    the start time of the chunk in the video.
+    """
+    if chunk is None:
+        return None
+    segment_times = await manifest.get_segment_times(video_id)
+    return await containerize.remux_to_fragment(chunk, segment_times[chunk_number])
+
+
+async def get_segment(
+    video_id: str, chunk_number: int, track: str
+) -> Optional[Tuple[bytes, bytes]]:
+    """
+    Get the initialization segment and the media segment of a chunk of a
+    video track or the audio track.
+
+    The fragmented MP4 chunks stored at ingest are split without ffmpeg,
+    the chunks of videos stored before them are remuxed.
+    """
+    chunk_id = f"chunk_{chunk_number}"
+    video_information = await information.get_video_information_async(video_id)
+    if video_information.get("hls_fragments"):
+        fragment = (
+            await get_chunks(video_id, rendition.get_fragment_track(track), [chunk_id])
+        ).get(chunk_id)
+        if fragment is None:
+            return None
+        return containerize.split_init_segment(bytes(fragment))
+
+    if track == "audio":
+        chunk = await get_audio_chunk(video_id, chunk_number)
+    else:
+        chunk = (await get_chunks(video_id, track, [chunk_id])).get(chunk_id)
+    return await fragment_chunk(
+        video_id, chunk_number, bytes(chunk) if chunk is not None else None
+    )
+
+
+async def get_video_segment(
+    video_id: str, chunk_number: int, rendition_name: Optional[str] = None
+) -> Optional[bytes]:
+    """
+    Get a single video chunk of a rendition as a media segment.
+    """
+    segment = await get_segment(
+        video_id, chunk_number, rendition.get_track(rendition_name)
+    )
+    return segment[1] if segment else None
+
+
+async def get_video_init_segment(
+    video_id: str, rendition_name: Optional[str] = None
+) -> Optional[bytes]:
+    """
+    Get the initialization segment of the video segments of a rendition,
+    taken from its first chunk.
+    """
+    segment = await get_segment(video_id, 0, rendition.get_track(rendition_name))
+    return segment[0] if segment else None
+
+
+async def get_audio_segment(video_id: str, chunk_number: int) -> Optional[bytes]:
+    """
+    Get the audio of a single chunk as a media segment.
+    """
+    segment = await get_segment(video_id, chunk_number, "audio")
+    return segment[1] if segment else None
+
+
+async def get_audio_init_segment(video_id: str) -> Optional[bytes]:
+    """
+    Get the initialization segment of the audio segments, taken from the
+    first chunk.
+    """
+    segment = await get_segment(video_id, 0, "audio")
+    return segment[0] if segment else None
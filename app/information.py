@@ -1,21 +1,174 @@
 """
 Get video information from redis.
+
+The video information is cached for the duration of a request and, for
+METADATA_CACHE_TTL seconds, in the process. It is not immutable after
+ingest: the tier of the stored data is written to the metadata of every
+video using the data when the data is demoted or promoted, and videos that
+share their data with other videos (see dedup) depend on that tier being
+current. Every write after ingest, like the tier changes, and every delete
+must call invalidate_video_information, which removes the video from the
+process cache of every worker through a redis pub/sub channel.
 """
 
-from typing import Dict
+import functools
+import inspect
+import threading
+import time
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional, Tuple
 
+import asyncdb
 import config
 import db
 
+# video information cached in this process, video_id -> (expiry, information)
+process_cache: Dict[str, Tuple[float, Dict]] = {}
+process_cache_lock = threading.Lock()
+
+# video information cached for the current request, video_id -> information
+request_cache: ContextVar[Optional[Dict[str, Dict]]] = ContextVar(
+    "request_cache", default=None
+)
+
+
+def get_cached_video_information(video_id: str) -> Optional[Dict]:
+    """
+    Get video information from the request or process cache.
+    """
+    scoped_cache = request_cache.get()
+    if scoped_cache is not None and video_id in scoped_cache:
+        return scoped_cache[video_id]
+
+    with process_cache_lock:
+        cached = process_cache.get(video_id)
+    if cached and cached[0] > time.monotonic():
+        if scoped_cache is not None:
+            scoped_cache[video_id] = cached[1]
+        return cached[1]
+    return None
+
+
+def cache_video_information(video_id: str, video_information: Dict) -> None:
+    """
+    Add video information read from redis to the request and process cache.
+    """
+    if config.METADATA_CACHE_TTL:
+        with process_cache_lock:
+            process_cache[video_id] = (
+                time.monotonic() + config.METADATA_CACHE_TTL,
+                video_information,
+            )
+
+    scoped_cache = request_cache.get()
+    if scoped_cache is not None:
+        scoped_cache[video_id] = video_information
+
 
 def get_video_information(video_id: str) -> Dict:
     """
     Get video information from redis hash.
     """
-    if not db.does_video_metadata_exist_in_redis_hash(video_id, config.REDIS_HASH_NAME):
-        return False
+    video_information = get_cached_video_information(video_id)
+    if video_information:
+        return video_information
 
+    # a single HGET, it returns nothing if the video does not exist
     video_information = db.get_video_metadata_from_redis_hash(
         video_id=video_id, hash_name=config.REDIS_HASH_NAME
     )
+    if not video_information:
+        return False
+
+    cache_video_information(video_id, video_information)
+    return video_information
+
+
+async def get_video_information_async(video_id: str) -> Dict:
+    """
+    Get video information from redis hash, without blocking the event loop.
+    """
+    video_information = get_cached_video_information(video_id)
+    if video_information:
+        return video_information
+
+    video_information = await asyncdb.get_video_metadata_from_redis_hash(
+        video_id=video_id, hash_name=config.REDIS_HASH_NAME
+    )
+    if not video_information:
+        return False
+
+    cache_video_information(video_id, video_information)
     return video_information
+
+
+def request_scoped(endpoint: Callable) -> Callable:
+    """
+    Decorator for endpoints, the video information is fetched at most once
+    while the endpoint runs.
+    """
+
+    if inspect.iscoroutinefunction(endpoint):
+
+        @functools.wraps(endpoint)
+        async def async_wrapper(*args, **kwargs):
+            token = request_cache.set({})
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                request_cache.reset(token)
+
+        return async_wrapper
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        token = request_cache.set({})
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            request_cache.reset(token)
+
+    return wrapper
+
+
+def invalidate_video_information(video_id: str) -> None:
+    """
+    Remove the video information from the process cache of every worker.
+    """
+    evict_video_information(video_id)
+    db.publish(config.REDIS_METADATA_INVALIDATION_CHANNEL, video_id)
+
+
+def evict_video_information(video_id: str) -> None:
+    """
+    Remove the video information from the process cache of this worker.
+    """
+    with process_cache_lock:
+        process_cache.pop(video_id, None)
+
+
+def listen_for_invalidations() -> None:
+    """
+    Evict the video information of the video IDs published on the
+    invalidation channel. If the connection is lost the whole process cache
+    is cleared, as invalidations may have been missed.
+    """
+    while True:
+        try:
+            pubsub = db.subscribe(config.REDIS_METADATA_INVALIDATION_CHANNEL)
+            for message in pubsub.listen():
+                if message["type"] == "message":
+                    evict_video_information(message["data"].decode())
+        except Exception as err:
+            print("error while listening for metadata invalidations: ", err)
+        with process_cache_lock:
+            process_cache.clear()
+        time.sleep(1)
+
+
+def start_invalidation_listener() -> None:
+    """
+    Listen for invalidations of the video information in a background thread.
+    """
+    if config.METADATA_CACHE_TTL:
+        threading.Thread(target=listen_for_invalidations, daemon=True).start()
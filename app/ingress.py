@@ -2,65 +2,116 @@
 Module for ingressing a video into the system.
 """
 
+import hashlib
+import math
 import os
 import shutil
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable, Dict, List, Optional
 
 import config
 import db
 import decontainerize
+import dedup
 import disassemble
 import metadata
+import progress
+import rendition
+import tier
+import timeline
 import transcode
 import unique
+import videoindex
 
 
-def audio_codec(input_file: str) -> str:
+def extract_audio(input_file: str, output_file: str) -> Dict:
     """
-    Get the audio codec of the input file.
-
-    If the audio codec is not found, return None.
+    Extract the audio from the input file.
     """
+    return decontainerize.extract_audio(input_file, output_file)
 
-    try:
-        return metadata.get_video_metadata(input_file)["audio_codec"]
-    except KeyError:
-        return None
+
+def extract_video(input_file: str, output_file: str) -> Dict:
+    """
+    Extract the video from the input file.
+    """
+    return decontainerize.extract_video(input_file, output_file)
 
 
-def video_codec(input_file: str) -> str:
+def transcode_audio(
+    input_file: str, output_file: str, codec: Optional[str] = None
+) -> Dict:
     """
-    Get the video codec of the input file.
+    Transcode the audio to opus, codec is the codec of the input audio.
     """
-    return metadata.get_video_metadata(input_file)["video_codec"]
+    return transcode.transcode_to_opus(input_file, output_file, codec)
 
 
-def extract_audio(input_file: str, output_file: str) -> Dict:
+def disassemble_audio(
+    input_file: str,
+    output_dir: str,
+    chunk_times: Optional[List[float]] = None,
+    chunk_seconds: int = 1,
+) -> Dict:
     """
-    Extract the audio from the input file.
+    Disassemble the opus audio into chunks of chunk_seconds, or at the chunk
+    times of the video.
     """
-    decontainerize.extract_audio(input_file, output_file)
+    return disassemble.disassemble_audio(
+        input_file, output_dir, chunk_times, chunk_seconds
+    )
 
 
-def extract_video(input_file: str, output_file: str) -> Dict:
+def disassemble_rendition(
+    input_file: str,
+    output_dir: str,
+    ladder_rendition: Dict,
+    chunk_times: Optional[List[float]] = None,
+    chunk_seconds: int = 1,
+) -> Dict:
     """
-    Extract the video from the input file.
+    Encode a rendition of the ladder and disassemble it into chunks with the
+    same boundaries as the chunks of the video.
     """
-    return decontainerize.extract_video(input_file, output_file)
+    return disassemble.disassemble_rendition(
+        input_file,
+        output_dir,
+        ladder_rendition["height"],
+        ladder_rendition["bitrate"],
+        chunk_times,
+        chunk_seconds,
+    )
 
 
-def transcode_audio(input_file: str, output_file: str) -> Dict:
+def disassemble_video(
+    input_file: str,
+    output_file: str,
+    on_chunks: Optional[Callable[[List[str]], None]] = None,
+    video_duration: Optional[float] = None,
+    chunk_times: Optional[List[float]] = None,
+    chunk_seconds: int = 1,
+) -> Dict:
     """
-    Transcode the audio to opus.
+    Disassemble the video to vp9, vp9 videos with chunk times are cut at
+    their keyframes.
     """
-    return transcode.transcode_to_opus(input_file, output_file)
+    return disassemble.disassemble_video(
+        input_file, output_file, on_chunks, video_duration, chunk_times, chunk_seconds
+    )
 
 
-def disassemble_video(input_file: str, output_file: str) -> Dict:
+def fragment_chunks(
+    chunk_files: List[str],
+    output_dir: str,
+    chunk_times: Optional[List[float]] = None,
+    chunk_seconds: int = 1,
+) -> Dict:
     """
-    Disassemble the video to vp9.
+    Remux chunks into the fragmented MP4 chunks served as HLS segments.
     """
-    return disassemble.disassemble_video(input_file, output_file)
+    return disassemble.fragment_chunks(
+        chunk_files, output_dir, chunk_times, chunk_seconds
+    )
 
 
 def delete_video_ingress_directory(video_id: str) -> None:
@@ -89,10 +140,396 @@ def get_video_ingest_path(video_id: str) -> str:
     return os.path.join(video_directory, "video.mkv")
 
 
-def ingress(input_file: str, video_id: str, file_name: str) -> Dict:
+def save_uploaded_video(upload_file: BinaryIO, output_file: str) -> Dict:
+    """
+    Copy the uploaded video to the output file.
+
+    The upload is copied in buffers of UPLOAD_BUFFER_SIZE bytes so that the
+    whole video is never held in memory. The sha256 hash and the size of the
+    file are computed while copying. If the upload is larger than
+    MAX_UPLOAD_SIZE the output file is removed and an error is returned.
+    """
+    response: Dict = {}
+    file_hash = hashlib.sha256()
+    file_size = 0
+
+    with open(output_file, "wb") as file:
+        while True:
+            buffer = upload_file.read(config.UPLOAD_BUFFER_SIZE)
+            if not buffer:
+                break
+
+            file_size += len(buffer)
+            if config.MAX_UPLOAD_SIZE and file_size > config.MAX_UPLOAD_SIZE:
+                response["error"] = (
+                    f"Video is larger than the maximum upload size of "
+                    f"{config.MAX_UPLOAD_SIZE} bytes"
+                )
+                break
+
+            file_hash.update(buffer)
+            file.write(buffer)
+
+    if "error" in response:
+        os.remove(output_file)
+        return response
+
+    response["file_sha256"] = file_hash.hexdigest()
+    response["file_size"] = file_size
+    return response
+
+
+def get_keyframe_chunk_times(
+    input_file: str,
+    probe: Dict,
+    video_metadata: Dict,
+    video_duration: float,
+    chunk_seconds: int,
+) -> Optional[List[float]]:
+    """
+    Get the chunk times of a vp9 video that is cut at its own keyframes
+    without re-encoding, or None if the video is encoded.
+
+    The times are on the timeline of the extracted audio and video, which
+    starts at the start of the input file.
+    """
+    if not config.VIDEO_COPY or video_metadata["video_codec"] != "vp9":
+        return None
+    start_time = float(probe["format"].get("start_time") or 0)
+    keyframe_times = [
+        keyframe_time - start_time
+        for keyframe_time in metadata.probe_keyframe_times(input_file)
+    ]
+    return disassemble.get_keyframe_chunk_times(
+        keyframe_times, video_duration, chunk_seconds
+    )
+
+
+def get_ingest_plan(input_file: str, probe: Dict, video_metadata: Dict) -> Dict:
+    """
+    Plan the steps of the ingest from the probe of the input file, so the
+    extracted audio and video are not probed again.
+    """
+    has_audio = bool(video_metadata["audio_codec"])
+    video_duration = metadata.get_video_stream_duration(probe)
+    chunk_seconds = video_metadata.get("chunk_seconds") or config.CHUNK_SECONDS
+    return {
+        "has_audio": has_audio,
+        "audio_codec": video_metadata["audio_codec"],
+        "transcode_audio": has_audio and video_metadata["audio_codec"] != "opus",
+        "audio_chunked": has_audio and config.AUDIO_CHUNKED,
+        "video_duration": video_duration,
+        "chunk_seconds": chunk_seconds,
+        "chunk_times": get_keyframe_chunk_times(
+            input_file, probe, video_metadata, video_duration, chunk_seconds
+        ),
+        "renditions": rendition.get_ladder(video_metadata["resolution"]),
+    }
+
+
+def ingress_audio(
+    input_file: str, video_id: str, video_directory: str, plan: Dict
+) -> Dict:
+    """
+    Extract the audio, transcode it to opus unless it already is and store
+    it as chunks aligned with the video chunks, and as fragmented MP4 chunks.
+
+    Returns the status, the opus audio file if it is stored as one blob with
+    the metadata instead, and the sha256 of the chunks. The status is False
+    if any step fails, so the video is not stored with missing audio.
+    """
+    response: Dict = {"status": True, "audio_file": None, "chunk_hashes": {}}
+    if not plan["has_audio"]:
+        return response
+
+    extracted_output_audio_file = os.path.join(
+        video_directory, "extracted", "audio.mkv"
+    )
+    if "error" in extract_audio(input_file, extracted_output_audio_file):
+        print("error while extracting the audio")
+        response["status"] = False
+        return response
+
+    # opus audio is stored as it was extracted
+    transcoded_output_audio_file = extracted_output_audio_file
+    if plan["transcode_audio"]:
+        transcoded_output_audio_file = os.path.join(
+            video_directory, "transcoded", "audio.mkv"
+        )
+        if "error" in transcode_audio(
+            extracted_output_audio_file,
+            transcoded_output_audio_file,
+            plan["audio_codec"],
+        ):
+            print("error while transcoding the audio")
+            response["status"] = False
+            return response
+
+    # cut the audio into chunks aligned with the video chunks, they are
+    # stored so egress only fetches the audio of the requested chunks, unless
+    # the audio is stored as one blob, and remuxed into the HLS segments
+    disassembled_audio_directory = os.path.join(
+        video_directory, "disassembled", "audio"
+    )
+    os.makedirs(disassembled_audio_directory, exist_ok=True)
+    audio_response = disassemble_audio(
+        transcoded_output_audio_file,
+        disassembled_audio_directory,
+        plan["chunk_times"],
+        plan["chunk_seconds"],
+    )
+    audio_chunk_files = [
+        os.path.join(disassembled_audio_directory, chunk_file)
+        for chunk_file in os.listdir(disassembled_audio_directory)
+    ]
+    if "error" in audio_response or not audio_chunk_files:
+        print("error while disassembling the audio")
+        response["status"] = False
+        return response
+
+    if plan["audio_chunked"]:
+        response["chunk_hashes"] = dedup.hash_chunk_files("audio", audio_chunk_files)
+        response["status"] = db.add_audio_chunk_files_to_redis_stream(
+            video_id=video_id, chunk_files=audio_chunk_files
+        )
+    else:
+        response["audio_file"] = transcoded_output_audio_file
+        response["chunk_hashes"]["audio"] = dedup.hash_file(
+            transcoded_output_audio_file
+        )
+    response["status"] = response["status"] and ingress_fragments(
+        audio_chunk_files, video_id, "audio", video_directory, plan
+    )
+    print("status of adding audio chunk to redis stream: ", response["status"])
+    return response
+
+
+def ingress_fragments(
+    chunk_files: List[str], video_id: str, track: str, video_directory: str, plan: Dict
+) -> bool:
+    """
+    Remux the chunks of a video or audio track into fragmented MP4 chunks
+    and store them in the fragmented MP4 track of the track.
+    """
+    fragment_response = fragment_chunks(
+        chunk_files,
+        os.path.join(video_directory, "fragmented", track),
+        plan["chunk_times"],
+        plan["chunk_seconds"],
+    )
+    if "error" in fragment_response:
+        print("error while fragmenting the chunks: ", fragment_response["error"])
+        return False
+    return db.add_video_chunk_files_to_redis_stream(
+        video_id,
+        fragment_response["fragment_files"],
+        rendition.get_fragment_track(track),
+    )
+
+
+def get_bitrate(chunk_files: List[str], video_duration: float) -> int:
+    """
+    Get the average bitrate in bits per second of the chunks of a video.
+    """
+    chunk_bytes = sum(os.path.getsize(chunk_file) for chunk_file in chunk_files)
+    return int(chunk_bytes * 8 / video_duration) if video_duration else 0
+
+
+def ingress_renditions(
+    input_file: str, video_id: str, video_directory: str, plan: Dict, chunk_count: int
+) -> Dict:
+    """
+    Encode the renditions of the ladder from the extracted video, input_file,
+    and store the chunks of every rendition in its own video track. A
+    rendition that could not be encoded into chunk_count chunks, the chunk
+    count of the source, is left out.
+
+    Returns the status, the name, resolution and bitrate of every rendition
+    and the sha256 of the chunks.
+    """
+    response: Dict = {"status": True, "renditions": [], "chunk_hashes": {}}
+    if plan["renditions"]:
+        progress.update_ingest_progress(video_id, "encoding_renditions")
+
+    for ladder_rendition in plan["renditions"]:
+        track = rendition.get_track(ladder_rendition["name"])
+        rendition_directory = os.path.join(video_directory, "disassembled", track)
+        os.makedirs(rendition_directory, exist_ok=True)
+        rendition_response = disassemble_rendition(
+            input_file,
+            rendition_directory,
+            ladder_rendition,
+            plan["chunk_times"],
+            plan["chunk_seconds"],
+        )
+        chunk_files = [
+            os.path.join(rendition_directory, chunk_file)
+            for chunk_file in os.listdir(rendition_directory)
+        ]
+        if "error" in rendition_response or len(chunk_files) != chunk_count:
+            print(
+                f"leaving out the {ladder_rendition['name']} rendition: ",
+                rendition_response.get(
+                    "error", f"{len(chunk_files)} of {chunk_count} chunks"
+                ),
+            )
+            continue
+
+        if not db.add_video_chunk_files_to_redis_stream(
+            video_id, chunk_files, track
+        ) or not ingress_fragments(chunk_files, video_id, track, video_directory, plan):
+            response["status"] = False
+            return response
+
+        response["chunk_hashes"].update(dedup.hash_chunk_files(track, chunk_files))
+        response["renditions"].append(
+            {
+                "name": ladder_rendition["name"],
+                "resolution": metadata.get_video_metadata(
+                    os.path.join(rendition_directory, "chunk_0.mkv")
+                ).get("resolution"),
+                "bitrate": get_bitrate(chunk_files, plan["video_duration"]),
+            }
+        )
+    return response
+
+
+def ingress_video(
+    input_file: str, video_id: str, video_directory: str, plan: Dict
+) -> Dict:
+    """
+    Extract the video and disassemble it into vp9 chunks, the chunks and
+    their fragmented MP4 chunks are stored as soon as they are encoded.
+
+    Returns the status, the sha256 of the chunks, the number of chunks and
+    the bitrate of the video, or the status and the error if the video could
+    not be extracted.
+    """
+    extracted_output_video_file = os.path.join(
+        video_directory, "extracted", "video.mkv"
+    )
+    progress.update_ingest_progress(video_id, "extracting")
+    extract_response = extract_video(input_file, extracted_output_video_file)
+    if "error" in extract_response:
+        print("error while extracting the video")
+        return {
+            "status": False,
+            "error": extract_response["error"] or "Could not extract the video",
+        }
+
+    disassembled_video_directory = os.path.join(
+        video_directory, "disassembled", "video"
+    )
+    os.makedirs(disassembled_video_directory, exist_ok=True)
+
+    # track and chunk ID -> sha256 of the chunk, to find identical stored chunks
+    chunk_hashes: Dict[str, str] = {}
+    chunk_statuses = []
+    chunks_encoded = 0
+    video_chunk_files: List[str] = []
+
+    def add_video_chunks(chunk_files: List[str]) -> None:
+        nonlocal chunks_encoded
+        video_chunk_files.extend(chunk_files)
+        chunk_hashes.update(dedup.hash_chunk_files("video", chunk_files))
+        chunk_statuses.append(
+            db.add_video_chunk_files_to_redis_stream(
+                video_id=video_id, chunk_files=chunk_files
+            )
+            and ingress_fragments(chunk_files, video_id, "video", video_directory, plan)
+        )
+        chunks_encoded += len(chunk_files)
+        progress.update_ingest_progress(
+            video_id, "disassembling", chunks_encoded=chunks_encoded
+        )
+
+    chunks_total = math.ceil(plan["video_duration"] / plan["chunk_seconds"])
+    if plan["chunk_times"]:
+        chunks_total = len(plan["chunk_times"]) - 1
+    progress.update_ingest_progress(
+        video_id, "disassembling", chunks_total=chunks_total
+    )
+
+    # disassemble the video
+    video_response = disassemble_video(
+        extracted_output_video_file,
+        disassembled_video_directory,
+        on_chunks=add_video_chunks,
+        video_duration=plan["video_duration"],
+        chunk_times=plan["chunk_times"],
+        chunk_seconds=plan["chunk_seconds"],
+    )
+    status = (
+        "error" not in video_response and bool(chunk_statuses) and all(chunk_statuses)
+    )
+    print("status of adding video chunk to redis stream: ", status)
+    return {
+        "status": status,
+        "chunk_hashes": chunk_hashes,
+        "chunk_count": len(video_chunk_files),
+        "bitrate": get_bitrate(video_chunk_files, plan["video_duration"]),
+    }
+
+
+def ingress_stored_content(video_metadata: Dict, content_hash: Optional[str]) -> bool:
+    """
+    Add a video that uses the stored data with the given key of the content
+    hash, instead of storing the data again.
+
+    The tier lock of the data is held, so the data does not change tier
+    while the video is added. Returns False if no video uses the data.
+    """
+    stored_metadata = dedup.find_stored_data(content_hash) if content_hash else None
+    if not stored_metadata:
+        return False
+
+    data_id = dedup.get_data_id(stored_metadata)
+    lock = tier.get_tier_lock(data_id)
+    if not lock.acquire(blocking_timeout=tier.TIER_LOCK_TIMEOUT):
+        return False
+    try:
+        # the data may have changed tier while waiting for the lock
+        stored_metadata = dedup.find_stored_data(content_hash)
+        if not stored_metadata or dedup.get_data_id(stored_metadata) != data_id:
+            return False
+        dedup.use_stored_data(video_metadata, stored_metadata)
+        return db.add_video_metadata_with_reference(
+            video_metadata,
+            hash_name=config.REDIS_HASH_NAME,
+            references_name=dedup.get_references_name(data_id),
+            index_scores=videoindex.get_index_scores(video_metadata),
+            index_sets=videoindex.get_index_sets(video_metadata),
+            content_hashes=dedup.get_content_hashes(video_metadata),
+        )
+    finally:
+        tier.release_lock(lock)
+
+
+def finish_ingress(video_id: str) -> Dict:
+    """
+    Delete the video ingress directory, mark the video as ready and return
+    its metadata.
+    """
+    delete_video_ingress_directory(video_id)
+    progress.update_ingest_progress(video_id, "ready")
+
+    return db.get_video_metadata_from_redis_hash(
+        video_id=video_id, hash_name=config.REDIS_HASH_NAME
+    )
+
+
+def ingress(
+    input_file: str,
+    video_id: str,
+    file_name: str,
+    upload_information: Optional[Dict] = None,
+) -> Dict:
     """
     First we create a new video ID.
 
+    The input file is probed once and the steps of the ingest are planned
+    from the probe.
+
     Our target is to extract the audio and video from the input file, and
     check if the audio and video codecs are opus and vp9 respectively.
 
@@ -101,96 +538,166 @@ def ingress(input_file: str, video_id: str, file_name: str) -> Dict:
 
     After that we have a opus audio file and a vp9 video file.
 
-    Then we disassemble the video file into a one second video file.
-    Then we disassemble the audio file into a one second audio file.
-
-    The last chunk in the disassembled file maybe less than one second as it
+    Then we disassemble the video file into chunks of the chunk seconds of
+    the video, CHUNK_SECONDS unless the upload asks for other chunk seconds.
+    Then we disassemble the audio file into chunks of the same length.
+    A vp9 video with keyframes close enough together is cut at its own
+    keyframes without re-encoding instead, and the audio at the same times.
+    The renditions of RENDITION_LADDER below the height of the video are
+    encoded and cut into chunks at the same times as the video.
+    The audio is extracted, transcoded and disassembled at the same time as
+    the video is extracted and disassembled.
+
+    The last chunk in the disassembled file maybe shorter than the others as it
     is the last chunk and the file may be in decimal seconds example 100.5 seconds.
 
     Then we store these chunks into the redis time series.
 
     Then we store the video metadata into the redis stream.
 
+    An upload of a file that is already stored, or that is encoded into
+    chunks that are already stored, uses the stored chunks and only its
+    metadata is stored. A file that is already stored is found before it is
+    encoded. Chunks that are already stored are only found once the audio
+    and the source rendition are encoded, so only their storage is saved,
+    but the renditions are encoded after the check and are not encoded
+    again.
+
     We finally return the video metadata and the video ID.
     """
 
-    video_metadata = metadata.get_video_metadata(input_file)
+    progress.update_ingest_progress(video_id, "probing")
+    probe = metadata.probe_video(input_file)
+    video_metadata = metadata.get_video_metadata_from_probe(probe)
     print("checking video metadata")
     print(video_metadata)
+    if "error" in video_metadata:
+        delete_video_ingress_directory(video_id)
+        progress.update_ingest_progress(
+            video_id, "failed", error=video_metadata["error"]
+        )
+        return {}
+
     video_metadata["video_id"] = video_id
     video_metadata["url"] = f"/video/{video_id}.webm"
     video_metadata["file_name"] = file_name
-
-    # create a directory for with name as the video ID
-    video_directory = os.path.join(config.INGRESS_PATH, video_id)
-    os.makedirs(video_directory, exist_ok=True)
-
-    # create a directory for the the extracted audio and video
-    extracted_audio_video_directory = os.path.join(video_directory, "extracted")
-    os.makedirs(extracted_audio_video_directory, exist_ok=True)
-
-    # extract the audio and video
-    extracted_output_audio_file = os.path.join(
-        extracted_audio_video_directory, "audio.mkv"
+    video_metadata["tier"] = "hot"
+    if upload_information:
+        video_metadata.update(upload_information)
+
+    # the stored data of the same file is only used if it has the requested
+    # chunk seconds and the same renditions
+    video_metadata["chunk_seconds"] = (
+        video_metadata.get("chunk_seconds") or config.CHUNK_SECONDS
     )
-    extracted_output_video_file = os.path.join(
-        extracted_audio_video_directory, "video.mkv"
+    video_metadata["rendition_ladder"] = rendition.get_ladder_key(
+        rendition.get_ladder(video_metadata["resolution"])
     )
-    extract_audio(input_file, extracted_output_audio_file)
-    extract_video(input_file, extracted_output_video_file)
-
-    transcoded_audio_video_directory = os.path.join(video_directory, "transcoded")
-    os.makedirs(transcoded_audio_video_directory, exist_ok=True)
 
-    transcoded_output_audio_file = os.path.join(
-        transcoded_audio_video_directory, "audio.mkv"
+    if ingress_stored_content(
+        video_metadata, dedup.get_content_hash(video_metadata, "file_sha256")
+    ):
+        return finish_ingress(video_id)
+
+    plan = get_ingest_plan(input_file, probe, video_metadata)
+    video_metadata["audio_chunked"] = plan["audio_chunked"]
+    video_metadata["chunk_seconds"] = plan["chunk_seconds"]
+    video_metadata["video_duration"] = plan["video_duration"]
+    video_metadata["keyframe_chunks"] = bool(plan["chunk_times"])
+    video_metadata["hls_fragments"] = True
+
+    # every track that may be stored, to delete them if the ingest fails
+    rendition_tracks = rendition.get_tracks(
+        {**video_metadata, "renditions": plan["renditions"]}
     )
 
-    if audio_codec(extracted_output_audio_file):
-
-        if audio_codec(extracted_output_audio_file) != "opus":
+    # create a directory for with name as the video ID, with directories for
+    # the extracted, transcoded and disassembled audio and video
+    video_directory = os.path.join(config.INGRESS_PATH, video_id)
+    for directory in ("extracted", "transcoded", "disassembled"):
+        os.makedirs(os.path.join(video_directory, directory), exist_ok=True)
 
-            transcode_audio(extracted_output_audio_file, transcoded_output_audio_file)
-        else:
-            # copy the extracted audio file to the transcoded audio directory
-            os.system(
-                f"cp {extracted_output_audio_file} {transcoded_audio_video_directory}"
+    # the audio is transcoded and stored while the video is encoded
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            audio_branch = executor.submit(
+                ingress_audio, input_file, video_id, video_directory, plan
             )
-
-    # create a directory for the disassembled audio and video
-    # disassembled_audio_directory = os.path.join(
-    #     video_directory, "disassembled", "audio"
-    # )
-    disassembled_video_directory = os.path.join(
-        video_directory, "disassembled", "video"
+            video_response = ingress_video(input_file, video_id, video_directory, plan)
+            audio_response = audio_branch.result()
+    except Exception:
+        db.delete_video_data(video_id, rendition_tracks)
+        raise
+
+    if not audio_response["status"] or not video_response["status"]:
+        db.delete_video_data(video_metadata["video_id"], rendition_tracks)
+        delete_video_ingress_directory(video_metadata["video_id"])
+        progress.update_ingest_progress(
+            video_id,
+            "failed",
+            error=video_response.get(
+                "error", "Could not store the audio and video chunks"
+            ),
+        )
+        return {}
+
+    # the same chunks are already stored, like for a video uploaded again
+    # with other tags, the chunks that were just stored are not needed. The
+    # audio and the source rendition were encoded already, the renditions
+    # are only encoded if the chunks are not stored
+    video_metadata["video_bitrate"] = video_response["bitrate"]
+    video_metadata["chunks_sha256"] = dedup.get_chunks_sha256(
+        {**audio_response["chunk_hashes"], **video_response["chunk_hashes"]}
     )
-    # os.makedirs(disassembled_audio_directory, exist_ok=True)
-    os.makedirs(disassembled_video_directory, exist_ok=True)
-
-    # disassemble the audio and video
-    # disassemble_audio(extracted_output_audio_file, disassembled_audio_directory)
-    disassemble_video(extracted_output_video_file, disassembled_video_directory)
-
-    # store the audio and video chunks into the redis time series
-    status = db.add_video_chunk_to_redis_stream(
-        video_id=video_metadata["video_id"], chunk_dir=disassembled_video_directory
+    if ingress_stored_content(
+        video_metadata, dedup.get_content_hash(video_metadata, "chunks_sha256")
+    ):
+        db.delete_video_data(video_id, rendition_tracks)
+        return finish_ingress(video_id)
+
+    renditions_response = ingress_renditions(
+        os.path.join(video_directory, "extracted", "video.mkv"),
+        video_id,
+        video_directory,
+        plan,
+        video_response["chunk_count"],
     )
-    print("status of adding video chunk to redis stream: ", status)
-
-    if audio_codec(extracted_output_audio_file):
-        status = db.add_audio_to_redis(
-            video_id=video_metadata["video_id"], audio_file=transcoded_output_audio_file
+    print(
+        "status of adding renditions to redis stream: ", renditions_response["status"]
+    )
+    if not renditions_response["status"]:
+        db.delete_video_data(video_id, rendition_tracks)
+        delete_video_ingress_directory(video_id)
+        progress.update_ingest_progress(
+            video_id, "failed", error="Could not store the renditions"
         )
-        print("status of adding audio to redis: ", status)
-
-    status = db.add_video_metadata_to_redis_hash(
-        video_metadata, hash_name=config.REDIS_HASH_NAME
+        return {}
+    video_metadata["renditions"] = renditions_response["renditions"]
+
+    progress.update_ingest_progress(video_id, "storing")
+
+    # the audio is stored on the redis node of the video first, then the
+    # metadata in one transaction, the video becomes visible only after all
+    # of its data is stored
+    video_metadata["data_id"] = video_id
+    status = db.add_audio_and_video_metadata_to_redis(
+        video_metadata,
+        hash_name=config.REDIS_HASH_NAME,
+        audio_file=audio_response["audio_file"],
+        index_scores=videoindex.get_index_scores(video_metadata),
+        index_sets=videoindex.get_index_sets(video_metadata),
+        references_name=dedup.get_references_name(video_id),
+        content_hashes=dedup.get_content_hashes(video_metadata),
+        chunk_times=timeline.dump_chunk_times(plan["chunk_times"]),
     )
-    print("status of adding video metadata to redis stream: ", status)
+    print("status of adding audio and video metadata to redis: ", status)
+    if not status:
+        db.delete_video_data(video_id, rendition_tracks)
+        delete_video_ingress_directory(video_id)
+        progress.update_ingest_progress(
+            video_id, "failed", error="Could not store the video metadata"
+        )
+        return {}
 
     # delete the video directory
-    delete_video_ingress_directory(video_metadata["video_id"])
-
-    return db.get_video_metadata_from_redis_hash(
-        video_id=video_metadata["video_id"], hash_name=config.REDIS_HASH_NAME
-    )
+    return finish_ingress(video_id)
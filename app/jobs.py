@@ -0,0 +1,162 @@
+"""
+Module for running video ingest jobs in the background.
+
+The jobs run in the worker process that received the video. Every worker
+process writes a heartbeat to redis, the unfinished jobs of a worker whose
+heartbeat stopped are finished by the other workers or by the worker that
+replaces it.
+"""
+
+import os
+import socket
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional
+
+import config
+import db
+import ingress
+import progress
+import rendition
+
+# The ingest pipeline spends most of its time waiting for ffmpeg and redis,
+# so a thread pool is enough to run several ingest jobs at the same time.
+executor = ThreadPoolExecutor(max_workers=config.INGEST_WORKERS)
+
+# a worker process without a heartbeat for this many seconds is dead
+WORKER_TIMEOUT = 3 * config.INGEST_HEARTBEAT_INTERVAL
+
+
+def get_worker_id() -> str:
+    """
+    Get the ID of this worker process, recorded in the jobs it runs.
+    """
+    return f"{socket.gethostname()}_{os.getpid()}"
+
+
+def run_ingest_job(
+    input_file: str,
+    video_id: str,
+    file_name: str,
+    upload_information: Optional[Dict] = None,
+) -> Dict:
+    """
+    Run the ingest pipeline for a video and record a failure in the progress.
+    """
+    try:
+        return ingress.ingress(input_file, video_id, file_name, upload_information)
+    except Exception as err:
+        traceback.print_exc()
+        progress.update_ingest_progress(video_id, "failed", error=str(err))
+        if os.path.exists(os.path.join(config.INGRESS_PATH, video_id)):
+            ingress.delete_video_ingress_directory(video_id)
+        return {}
+
+
+def submit_ingest_job(
+    input_file: str,
+    video_id: str,
+    file_name: str,
+    upload_information: Optional[Dict] = None,
+) -> Future:
+    """
+    Queue the ingest pipeline for a video. The video ID is the job ID.
+    """
+    progress.update_ingest_progress(video_id, "queued", worker=get_worker_id())
+    return executor.submit(
+        run_ingest_job, input_file, video_id, file_name, upload_information
+    )
+
+
+def is_worker_alive(worker: Optional[str], heartbeats: Dict[str, str]) -> bool:
+    """
+    Check if a worker process wrote a heartbeat in the last WORKER_TIMEOUT
+    seconds. Jobs queued before the heartbeats have no worker.
+    """
+    if not worker or worker not in heartbeats:
+        return False
+    return time.time() - float(heartbeats[worker]) < WORKER_TIMEOUT
+
+
+def finish_orphaned_job(video_id: str) -> None:
+    """
+    Finish the ingest job of a dead worker process. A video whose metadata
+    was stored is ready, any other job is marked failed and the data stored
+    so far is deleted.
+    """
+    if os.path.exists(os.path.join(config.INGRESS_PATH, video_id)):
+        ingress.delete_video_ingress_directory(video_id)
+    if db.does_video_metadata_exist_in_redis_hash(
+        video_id=video_id, hash_name=config.REDIS_HASH_NAME
+    ):
+        progress.update_ingest_progress(video_id, "ready")
+        return
+
+    db.delete_video_data(video_id, rendition.get_ladder_tracks())
+    progress.update_ingest_progress(
+        video_id, "failed", error="The ingest job was interrupted"
+    )
+
+
+def recover_jobs() -> None:
+    """
+    Finish the unfinished ingest jobs of dead worker processes, delete the
+    ingress directories of finished jobs on this host and forget the jobs
+    that failed more than INGEST_FAILED_TTL seconds ago.
+    """
+    heartbeats = db.get_redis_hash(config.REDIS_INGEST_WORKERS_HASH_NAME)
+    failed_before = time.time() - config.INGEST_FAILED_TTL
+    finished_jobs = set()
+    for ingest_progress in list(
+        db.iterate_video_metadata_in_redis_hash(config.REDIS_PROGRESS_HASH_NAME)
+    ):
+        video_id = ingest_progress["video_id"]
+        if ingest_progress["stage"] == "failed":
+            finished_jobs.add(video_id)
+            # jobs that failed before the failure time was recorded
+            if "failed_at" not in ingest_progress:
+                progress.update_ingest_progress(video_id, "failed")
+            elif ingest_progress["failed_at"] < failed_before:
+                progress.delete_ingest_progress(video_id)
+        elif ingest_progress["stage"] == "ready":
+            finished_jobs.add(video_id)
+        elif not is_worker_alive(ingest_progress.get("worker"), heartbeats):
+            finish_orphaned_job(video_id)
+
+    # the uploads of jobs that are not queued yet have no progress
+    for video_id in os.listdir(config.INGRESS_PATH):
+        if video_id in finished_jobs:
+            ingress.delete_video_ingress_directory(video_id)
+
+    db.delete_redis_hash_fields(
+        config.REDIS_INGEST_WORKERS_HASH_NAME,
+        [worker for worker in heartbeats if not is_worker_alive(worker, heartbeats)],
+    )
+
+
+def run_heartbeat() -> None:
+    """
+    Write the heartbeat of this worker process and recover the jobs of dead
+    worker processes every INGEST_HEARTBEAT_INTERVAL seconds.
+    """
+    while True:
+        db.set_redis_hash_field(
+            config.REDIS_INGEST_WORKERS_HASH_NAME,
+            get_worker_id(),
+            str(int(time.time())),
+        )
+        try:
+            recover_jobs()
+        except Exception as err:
+            print("error while recovering ingest jobs: ", err)
+        time.sleep(config.INGEST_HEARTBEAT_INTERVAL)
+
+
+def start_heartbeat() -> None:
+    """
+    Start writing heartbeats and recovering jobs in a background thread, the
+    jobs left by a restarted worker process are recovered at startup.
+    """
+    threading.Thread(target=run_heartbeat, daemon=True).start()
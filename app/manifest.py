@@ -0,0 +1,135 @@
+"""
+Module for generating HLS playlists from the video chunks stored in redis.
+
+Every video chunk, as long as the chunk seconds of the video unless it was
+cut at its own keyframes, is served as a segment of the video playlist, the
+audio is served as a separate audio playlist with segments of the same
+length, so players can start and seek without re-assembling the video.
+The segments are the fragmented MP4 chunks written at ingest, with their
+timestamps moved to the start time of the chunk, as the timestamps of the
+stored chunks start at zero. The chunks of videos stored before them are
+remuxed when they are served.
+Every rendition of the video has a video playlist of its own, the chunks of
+the renditions have the same boundaries so players can switch between them
+at every segment.
+"""
+
+import math
+from typing import Dict, List, Optional
+
+import information
+import rendition
+import tier
+import timeline
+
+MEDIA_TYPE = "application/vnd.apple.mpegurl"
+VIDEO_CODEC = "vp09.00.10.08"
+AUDIO_CODEC = "opus"
+DEFAULT_BANDWIDTH = 1000000
+
+
+async def get_segment_times(video_id: str) -> List[float]:
+    """
+    Get the start time of every segment of the video, one per stored chunk,
+    and the end time of the last segment.
+    Videos cut at their keyframes have segments of the length of their chunks,
+    the last chunk of the other videos ends at the end of the video.
+    """
+    video_information = await information.get_video_information_async(video_id)
+    if video_information.get("keyframe_chunks"):
+        return await timeline.get_chunk_times(video_id)
+    return timeline.get_counted_chunk_times(
+        await tier.get_video_chunk_count(video_id),
+        timeline.get_chunk_seconds(video_information),
+        timeline.get_video_duration(video_information),
+    )
+
+
+async def get_segment_durations(video_id: str) -> List[float]:
+    """
+    Get the duration of every segment of the video.
+    """
+    return timeline.get_chunk_durations(await get_segment_times(video_id))
+
+
+def get_bandwidth(video_information: Dict) -> int:
+    """
+    Estimate the bandwidth of the video in bits per second from the size of
+    the uploaded file.
+    """
+    if video_information.get("file_size") and video_information.get("duration"):
+        return int(video_information["file_size"] * 8 / video_information["duration"])
+    return DEFAULT_BANDWIDTH
+
+
+def generate_master_playlist(
+    video_information: Dict, max_bitrate: Optional[int] = None
+) -> str:
+    """
+    Generate the HLS master playlist of a video with a variant stream for
+    every rendition, or for those up to max_bitrate. The bandwidth of a
+    rendition is the bitrate of its video.
+    """
+    renditions = rendition.get_renditions(video_information)
+    if max_bitrate is not None:
+        renditions = rendition.limit_bitrate(renditions, max_bitrate)
+
+    lines = ["#EXTM3U", "#EXT-X-VERSION:7"]
+    codecs = VIDEO_CODEC
+    audio_group = ""
+    if video_information.get("audio_codec"):
+        lines.append(
+            '#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="audio",'
+            'DEFAULT=YES,AUTOSELECT=YES,URI="audio.m3u8"'
+        )
+        codecs = f"{VIDEO_CODEC},{AUDIO_CODEC}"
+        audio_group = ',AUDIO="audio"'
+
+    for stream in renditions:
+        bandwidth = stream["bitrate"] or get_bandwidth(video_information)
+        stream_information = (
+            f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},CODECS="{codecs}"'
+        )
+        if stream["resolution"]:
+            stream_information += f",RESOLUTION={stream['resolution']}"
+        lines.append(stream_information + audio_group)
+        lines.append("video.m3u8" + get_rendition_query(stream["name"]))
+
+    return "\n".join(lines) + "\n"
+
+
+def get_rendition_query(rendition_name: str) -> str:
+    """
+    Get the query string selecting a rendition in the URIs of the playlists,
+    the source rendition is served without it.
+    """
+    if rendition_name == rendition.SOURCE:
+        return ""
+    return f"?rendition={rendition_name}"
+
+
+def generate_media_playlist(
+    segment_durations: List[float], track: str, query: str = ""
+) -> str:
+    """
+    Generate the HLS media playlist of the video or audio track of a video.
+    The segments are named {track}/{chunk_number}.m4s{query}, they share the
+    initialization segment {track}/init.mp4{query}.
+    """
+    target_duration = max([1] + [math.ceil(duration) for duration in segment_durations])
+
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:7",
+        f"#EXT-X-TARGETDURATION:{target_duration}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+        "#EXT-X-INDEPENDENT-SEGMENTS",
+        f'#EXT-X-MAP:URI="{track}/init.mp4{query}"',
+    ]
+    for chunk_number, duration in enumerate(segment_durations):
+        lines.append(f"#EXTINF:{duration:.3f},")
+        lines.append(f"{track}/{chunk_number}.m4s{query}")
+    lines.append("#EXT-X-ENDLIST")
+
+    return "\n".join(lines) + "\n"
@@ -4,28 +4,64 @@ Module for getting metadata of videos.
 
 import json
 import subprocess
-from datetime import datetime
-from typing import Dict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
 
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
 
-def get_video_metadata(file_path: str) -> Dict:
+
+def probe_video(file_path: str) -> Dict:
     """
-    Get video metadata using ffprobe.
+    Get the format and streams of a video using ffprobe.
     """
     try:
         command = f"ffprobe -v quiet -print_format json -show_format -show_streams {file_path}"
-        output = subprocess.check_output(command, shell=True)
-        output = json.loads(output)
+        return json.loads(subprocess.check_output(command, shell=True))
     except Exception as err:
         return {"error": f"An error occurred while getting video metadata: {err}"}
 
+
+def probe_keyframe_times(file_path: str) -> List[float]:
+    """
+    Get the times in seconds of the keyframes of the video stream using
+    ffprobe. Only the packet headers are read, the video is not decoded.
+    """
+    try:
+        command = (
+            f"ffprobe -v error -select_streams v:0 "
+            f"-show_entries packet=pts_time,flags -of csv=p=0 {file_path}"
+        )
+        keyframe_times = []
+        for line in subprocess.check_output(command, shell=True).decode().splitlines():
+            pts_time, _, flags = line.partition(",")
+            if "K" in flags and pts_time not in ("", "N/A"):
+                keyframe_times.append(float(pts_time))
+        return sorted(keyframe_times)
+    except Exception:
+        return []
+
+
+def get_video_metadata(file_path: str) -> Dict:
+    """
+    Get video metadata using ffprobe.
+    """
+    return get_video_metadata_from_probe(probe_video(file_path))
+
+
+def get_video_metadata_from_probe(output: Dict) -> Dict:
+    """
+    Get video metadata from the output of probe_video.
+    """
+    if "error" in output:
+        return output
+
     video_metadata: Dict = {}
     video_metadata["duration"] = None
     video_metadata["video_codec"] = None
     video_metadata["audio_codec"] = None
     video_metadata["resolution"] = None
     video_metadata["fps"] = None
-    video_metadata["timestamp"] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    video_metadata["timestamp"] = datetime.utcnow().strftime(TIMESTAMP_FORMAT)
 
     for stream in output["streams"]:
         if stream["codec_type"] == "video":
@@ -37,3 +73,35 @@ def get_video_metadata(file_path: str) -> Dict:
     video_metadata["duration"] = int(float(output["format"]["duration"]))
 
     return video_metadata
+
+
+def get_video_stream_duration(output: Dict) -> float:
+    """
+    Get the duration in seconds of the video stream from the output of
+    probe_video, or of the whole file if the container has no stream
+    durations. Matroska has the stream durations in HH:MM:SS.ss tags.
+    """
+    for stream in output["streams"]:
+        if stream["codec_type"] != "video":
+            continue
+        if stream.get("duration"):
+            return float(stream["duration"])
+        duration_tag = stream.get("tags", {}).get("DURATION")
+        if duration_tag:
+            hours, minutes, seconds = duration_tag.split(":")
+            return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    return float(output["format"]["duration"])
+
+
+def parse_timestamp(timestamp: str) -> Optional[float]:
+    """
+    Get the seconds since the epoch of a metadata timestamp, which is in UTC.
+    """
+    try:
+        return (
+            datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+            .replace(tzinfo=timezone.utc)
+            .timestamp()
+        )
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,211 @@
+"""
+Packed file backend for the video and audio chunks.
+
+All the chunks of a track of a video are appended to one packed file,
+{video_id}/{track}.pack in PACKED_STORAGE_PATH, and the offset and length of
+every chunk are written to a fixed layout index file, {track}.idx, where the
+entry of chunk N is at byte N * INDEX_ENTRY.size. Chunks are read as slices
+of a memory map of the packed file, so they are not copied.
+
+The functions return chunks like redis stream entries, so the db module can
+use this backend behind the same interface.
+"""
+
+import mmap
+import os
+import shutil
+import struct
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import config
+
+# offset and length of a chunk in the packed file, a length of 0 means the
+# chunk is missing
+INDEX_ENTRY = struct.Struct("<QQ")
+
+# at most this many packed files are kept memory mapped by every process
+MAX_MAPPINGS = 1024
+
+# (video_id, track) -> (stat of the files, memory map of the packed file, index)
+mappings: Dict[Tuple[str, str], Tuple[Tuple, mmap.mmap, bytes]] = {}
+mappings_lock = threading.Lock()
+write_lock = threading.Lock()
+
+
+def get_video_dir(video_id: str) -> str:
+    """
+    Get the directory of the packed files of a video.
+    """
+    return os.path.join(config.PACKED_STORAGE_PATH, video_id)
+
+
+def get_pack_path(video_id: str, track: str) -> str:
+    """
+    Get the path of the packed file of a track of a video.
+    """
+    return os.path.join(get_video_dir(video_id), f"{track}.pack")
+
+
+def get_index_path(video_id: str, track: str) -> str:
+    """
+    Get the path of the index file of a track of a video.
+    """
+    return os.path.join(get_video_dir(video_id), f"{track}.idx")
+
+
+def add_chunk_files(video_id: str, track: str, chunk_files: List[str]) -> bool:
+    """
+    Append the given chunk files to the packed file of a track and write
+    their offsets to the index.
+    """
+    try:
+        os.makedirs(get_video_dir(video_id), exist_ok=True)
+        index_path = get_index_path(video_id, track)
+        with write_lock, open(get_pack_path(video_id, track), "ab") as pack_file, open(
+            index_path, "r+b" if os.path.exists(index_path) else "wb"
+        ) as index_file:
+            for chunk_file in chunk_files:
+                chunk_number = int(
+                    os.path.basename(chunk_file).split(".")[0].split("_")[1]
+                )
+                with open(chunk_file, "rb") as file:
+                    chunk = file.read()
+                offset = pack_file.tell()
+                pack_file.write(chunk)
+                index_file.seek(chunk_number * INDEX_ENTRY.size)
+                index_file.write(INDEX_ENTRY.pack(offset, len(chunk)))
+        return True
+    except Exception:
+        return False
+
+
+def get_mapping(video_id: str, track: str) -> Optional[Tuple[mmap.mmap, bytes]]:
+    """
+    Get the memory map of the packed file and the index of a track.
+
+    The mapping is reused while the files are unchanged. Mappings that are
+    dropped are closed once no chunk slices of them are left.
+    """
+    key = (video_id, track)
+    try:
+        pack_stat = os.stat(get_pack_path(video_id, track))
+        index_stat = os.stat(get_index_path(video_id, track))
+    except FileNotFoundError:
+        with mappings_lock:
+            mappings.pop(key, None)
+        return None
+
+    files_stat = (
+        pack_stat.st_ino,
+        pack_stat.st_size,
+        index_stat.st_ino,
+        index_stat.st_size,
+    )
+    with mappings_lock:
+        cached = mappings.get(key)
+    if cached and cached[0] == files_stat:
+        return cached[1], cached[2]
+    if not pack_stat.st_size:
+        return None
+
+    with open(get_pack_path(video_id, track), "rb") as pack_file:
+        pack_map = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+    with open(get_index_path(video_id, track), "rb") as index_file:
+        index = index_file.read()
+
+    with mappings_lock:
+        mappings.pop(key, None)
+        if len(mappings) >= MAX_MAPPINGS:
+            mappings.pop(next(iter(mappings)))
+        mappings[key] = (files_stat, pack_map, index)
+    return pack_map, index
+
+
+def get_chunk_location(index: bytes, chunk_number: int) -> Tuple[int, int]:
+    """
+    Get the offset and length of a chunk from the index.
+    """
+    position = chunk_number * INDEX_ENTRY.size
+    if chunk_number < 0 or position + INDEX_ENTRY.size > len(index):
+        return 0, 0
+    return INDEX_ENTRY.unpack_from(index, position)
+
+
+def get_chunks_by_chunk_ids(video_id: str, track: str, chunk_ids: List[str]) -> List:
+    """
+    Get only the given chunks of a track, as slices of the packed file.
+    """
+    mapping = get_mapping(video_id, track)
+    if not mapping:
+        return []
+
+    pack_map, index = mapping
+    pack_view = memoryview(pack_map)
+    entries = []
+    for chunk_id in chunk_ids:
+        offset, length = get_chunk_location(index, int(chunk_id.split("_")[1]))
+        if length:
+            entries.append(
+                (None, {chunk_id.encode(): pack_view[offset : offset + length]})
+            )
+    return entries
+
+
+def get_chunks(video_id: str, track: str) -> List:
+    """
+    Get all the chunks of a track, as slices of the packed file.
+    """
+    mapping = get_mapping(video_id, track)
+    if not mapping:
+        return []
+    chunk_ids = [f"chunk_{i}" for i in range(len(mapping[1]) // INDEX_ENTRY.size)]
+    return get_chunks_by_chunk_ids(video_id, track, chunk_ids)
+
+
+def get_chunk_count(video_id: str, track: str) -> int:
+    """
+    Get the number of chunks of a track.
+    """
+    mapping = get_mapping(video_id, track)
+    if not mapping:
+        return 0
+    return sum(
+        1
+        for chunk_number in range(len(mapping[1]) // INDEX_ENTRY.size)
+        if get_chunk_location(mapping[1], chunk_number)[1]
+    )
+
+
+def get_chunk_urls(video_id: str, track: str, chunk_ids: List[str]) -> List[str]:
+    """
+    Get ffmpeg subfile URLs of the given chunks of a track, so ffmpeg reads
+    the chunks in place from the packed file.
+    """
+    mapping = get_mapping(video_id, track)
+    if not mapping:
+        return []
+
+    pack_path = get_pack_path(video_id, track)
+    urls = []
+    for chunk_id in chunk_ids:
+        offset, length = get_chunk_location(mapping[1], int(chunk_id.split("_")[1]))
+        if length:
+            urls.append(f"subfile,,start,{offset},end,{offset + length},,:{pack_path}")
+    return urls
+
+
+def delete_video(video_id: str) -> bool:
+    """
+    Delete the packed files of a video.
+    """
+    with mappings_lock:
+        for key in [key for key in mappings if key[0] == video_id]:
+            mappings.pop(key, None)
+    try:
+        shutil.rmtree(get_video_dir(video_id))
+    except FileNotFoundError:
+        pass
+    except Exception:
+        return False
+    return True
@@ -0,0 +1,75 @@
+"""
+Module for keeping track of the progress of video ingest jobs in redis.
+"""
+
+import time
+from typing import Dict, Optional
+
+import asyncdb
+import config
+import db
+
+
+def get_ingest_progress(video_id: str) -> Dict:
+    """
+    Get the progress of the ingest job of a video from redis hash.
+    """
+    return db.get_video_metadata_from_redis_hash(
+        video_id=video_id, hash_name=config.REDIS_PROGRESS_HASH_NAME
+    )
+
+
+async def get_ingest_progress_async(video_id: str) -> Dict:
+    """
+    Get the progress of the ingest job of a video, without blocking the
+    event loop.
+    """
+    return await asyncdb.get_video_metadata_from_redis_hash(
+        video_id=video_id, hash_name=config.REDIS_PROGRESS_HASH_NAME
+    )
+
+
+def update_ingest_progress(
+    video_id: str,
+    stage: str,
+    chunks_encoded: Optional[int] = None,
+    chunks_total: Optional[int] = None,
+    error: Optional[str] = None,
+    worker: Optional[str] = None,
+) -> bool:
+    """
+    Update the stage and progress of the ingest job of a video, worker is the
+    ID of the worker process running the job.
+
+    Values that are not given are kept from the previous update. The time a
+    job failed is recorded to forget it later.
+    """
+    ingest_progress = get_ingest_progress(video_id) or {
+        "video_id": video_id,
+        "chunks_encoded": 0,
+        "chunks_total": None,
+    }
+    ingest_progress["stage"] = stage
+    if chunks_encoded is not None:
+        ingest_progress["chunks_encoded"] = chunks_encoded
+    if chunks_total is not None:
+        ingest_progress["chunks_total"] = chunks_total
+    if error is not None:
+        ingest_progress["error"] = error
+    if worker is not None:
+        ingest_progress["worker"] = worker
+    if stage == "failed":
+        ingest_progress["failed_at"] = int(time.time())
+
+    return db.add_video_metadata_to_redis_hash(
+        ingest_progress, hash_name=config.REDIS_PROGRESS_HASH_NAME
+    )
+
+
+def delete_ingest_progress(video_id: str) -> bool:
+    """
+    Delete the progress of the ingest job of a video.
+    """
+    return db.delete_video_metadata_from_redis_hash(
+        video_id=video_id, hash_name=config.REDIS_PROGRESS_HASH_NAME
+    )
@@ -0,0 +1,98 @@
+"""
+Tool to move the video data to the redis nodes that own it.
+
+Run it after nodes are added to REDIS_NODES:
+
+    python rebalance.py
+
+Nodes that were removed from REDIS_NODES are drained with --drain:
+
+    python rebalance.py --drain old-host:6379
+
+Every node is scanned for the keys of videos, the keys of the videos that
+hash to another node are copied there with DUMP and RESTORE, which keeps
+the stream entry IDs of the chunk index, and then deleted. Keys stored
+before the data was sharded are renamed to use the video ID as a hash tag.
+Requests for a video fail while its keys are moved.
+"""
+
+import argparse
+from typing import Dict, List
+
+import redis
+
+import db
+import shard
+
+
+def move_key(
+    source: redis.Redis, key: str, target: redis.Redis, target_key: str
+) -> None:
+    """
+    Move a key to another name, on the same or another redis node.
+    """
+    value = source.dump(key)
+    if value is None:
+        return
+    ttl = source.pttl(key)
+    target.restore(target_key, ttl if ttl > 0 else 0, value, replace=True)
+    source.delete(key)
+
+
+def rebalance_node(source: redis.Redis, dry_run: bool) -> Dict[str, int]:
+    """
+    Move the keys of a node that belong to another node or have a name
+    without the hash tag.
+    """
+    counts = {"scanned": 0, "moved": 0}
+    for key in source.scan_iter(count=1000):
+        key = key.decode()
+        parsed_key = shard.parse_key(key)
+        if not parsed_key:
+            continue
+        counts["scanned"] += 1
+
+        prefix, video_id = parsed_key
+        target = db.get_node(video_id)
+        target_key = shard.get_key(prefix, video_id)
+        if target is source and key == target_key:
+            continue
+
+        counts["moved"] += 1
+        if not dry_run:
+            move_key(source, key, target, target_key)
+    return counts
+
+
+def rebalance(drain: List[str], dry_run: bool = False) -> None:
+    """
+    Rebalance the nodes of REDIS_NODES and drain the given nodes.
+    """
+    sources = [
+        (f"{host}:{port}", node) for (host, port), node in zip(shard.NODES, db.nodes)
+    ]
+    sources += [
+        (f"{host}:{port}", redis.Redis(host=host, port=port, db=0))
+        for host, port in shard.parse_nodes(",".join(drain))
+    ]
+
+    for name, source in sources:
+        counts = rebalance_node(source, dry_run)
+        print(f"{name}: {counts['scanned']} keys scanned, {counts['moved']} moved")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--drain",
+        action="append",
+        default=[],
+        help="host:port of a node removed from REDIS_NODES, can be repeated",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only count the keys that would be moved",
+    )
+    args = parser.parse_args()
+    rebalance(args.drain, args.dry_run)
@@ -0,0 +1,172 @@
+"""
+Module for the renditions of the videos.
+
+The source rendition of a video is the video as it is stored without a
+ladder, in the video track. Every rendition of RENDITION_LADDER with a
+height below the height of the video is encoded as well and stored in its
+own video track, like video_360p, with the same chunk boundaries as the
+source rendition. Egress and the HLS playlists serve a rendition chosen by
+name or by the highest bitrate a client accepts, and a player can switch
+renditions at every chunk.
+
+Every video and audio track is also stored as fragmented MP4 chunks in a
+track of its own, like video_360p_fmp4, which are served as HLS segments.
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+import config
+
+SOURCE = "source"
+
+
+def parse_ladder(ladder: str) -> List[Tuple[int, str]]:
+    """
+    Parse a comma separated list of height:bitrate renditions, the bitrate
+    is passed to ffmpeg as it is, like 800k.
+    """
+    renditions = []
+    for entry in ladder.split(","):
+        if not entry.strip():
+            continue
+        height, _, bitrate = entry.strip().partition(":")
+        renditions.append((int(height), bitrate))
+    return renditions
+
+
+LADDER = parse_ladder(config.RENDITION_LADDER)
+
+
+def get_height(resolution: Optional[str]) -> int:
+    """
+    Get the height from a WIDTHxHEIGHT resolution of the metadata.
+    """
+    try:
+        return int(resolution.split("x")[1])
+    except (AttributeError, IndexError, ValueError):
+        return 0
+
+
+def get_ladder(resolution: Optional[str]) -> List[Dict]:
+    """
+    Get the renditions of the ladder to encode for a video of the given
+    resolution, those below its height, highest first.
+    """
+    height = get_height(resolution)
+    return [
+        {"name": f"{rendition_height}p", "height": rendition_height, "bitrate": bitrate}
+        for rendition_height, bitrate in sorted(LADDER, reverse=True)
+        if rendition_height < height
+    ]
+
+
+def get_ladder_key(ladder: List[Dict]) -> str:
+    """
+    Get the height:bitrate list of the renditions of the ladder of a video,
+    empty without renditions.
+    """
+    return ",".join(
+        f"{ladder_rendition['height']}:{ladder_rendition['bitrate']}"
+        for ladder_rendition in ladder
+    )
+
+
+def get_track(rendition: Optional[str]) -> str:
+    """
+    Get the video track of a rendition, None is the source rendition.
+    """
+    if not rendition or rendition == SOURCE:
+        return "video"
+    return f"video_{rendition}"
+
+
+def get_fragment_track(track: str) -> str:
+    """
+    Get the track of the fragmented MP4 chunks of a video or audio track,
+    which are served as HLS segments.
+    """
+    return f"{track}_fmp4"
+
+
+def get_tracks(video_information: Dict) -> List[str]:
+    """
+    Get the tracks of a video besides the source video track and the audio
+    track, the video tracks of the renditions and the fragmented MP4 tracks
+    of videos stored with them.
+    """
+    tracks = [
+        get_track(stored_rendition["name"])
+        for stored_rendition in video_information.get("renditions") or []
+    ]
+    if not video_information.get("hls_fragments"):
+        return tracks
+
+    fragmented_tracks = ["video"] + tracks
+    if video_information.get("audio_codec"):
+        fragmented_tracks.append("audio")
+    return tracks + [get_fragment_track(track) for track in fragmented_tracks]
+
+
+def get_ladder_tracks() -> List[str]:
+    """
+    Get every track besides the source video track and the audio track that
+    a video ingested with the ladder can have, to delete the data of a video
+    whose renditions are not known.
+    """
+    return get_tracks(
+        {
+            "renditions": [{"name": f"{height}p"} for height, _ in LADDER],
+            "hls_fragments": True,
+            "audio_codec": True,
+        }
+    )
+
+
+def get_renditions(video_information: Dict) -> List[Dict]:
+    """
+    Get the name, resolution and bitrate of every rendition of a video, the
+    source rendition first. The bitrate of the source rendition is None for
+    videos stored before the ladder, which only have the source rendition.
+    """
+    source = {
+        "name": SOURCE,
+        "resolution": video_information.get("resolution"),
+        "bitrate": video_information.get("video_bitrate"),
+    }
+    return [source] + list(video_information.get("renditions") or [])
+
+
+def select_rendition(
+    renditions: List[Dict], name: Optional[str], max_bitrate: Optional[int]
+) -> Optional[Dict]:
+    """
+    Select a rendition by name, or the rendition with the highest bitrate
+    up to max_bitrate, the lowest if none is low enough. Without either the
+    source rendition is selected.
+
+    Returns None if there is no rendition with the given name.
+    """
+    if name:
+        for candidate in renditions:
+            if candidate["name"] == name:
+                return candidate
+        return None
+    if max_bitrate is None:
+        return renditions[0]
+    return limit_bitrate(renditions, max_bitrate)[0]
+
+
+def limit_bitrate(renditions: List[Dict], max_bitrate: int) -> List[Dict]:
+    """
+    Get the renditions with a bitrate up to max_bitrate, highest first, or
+    the rendition with the lowest bitrate if none is low enough.
+    """
+    if len(renditions) == 1:
+        return renditions
+    by_bitrate = sorted(
+        renditions, key=lambda candidate: candidate["bitrate"], reverse=True
+    )
+    fitting = [
+        candidate for candidate in by_bitrate if candidate["bitrate"] <= max_bitrate
+    ]
+    return fitting or by_bitrate[-1:]
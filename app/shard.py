@@ -0,0 +1,116 @@
+"""
+Module for spreading the video data over the redis nodes.
+
+Every video is stored on one node, chosen by consistent hashing of the video
+ID, so adding a node only moves the videos that hash to the new node. The
+keys of a video contain the video ID as a hash tag, like video_{video_id}, so
+in a Redis Cluster they also map to the same slot.
+"""
+
+import bisect
+import hashlib
+import re
+from typing import List, Optional, Sequence, Tuple
+
+import config
+
+# the keys that hold the data of a video
+KEY_PREFIXES = (
+    "video",
+    "video_chunk_index",
+    "audio",
+    "audio_chunks",
+    "audio_chunk_index",
+)
+
+# the keys that hold the chunks of the renditions of a video, like
+# video_360p and video_360p_chunk_index
+RENDITION_KEY_PREFIX = r"video_\d+p(?:_chunk_index)?"
+
+# the keys that hold the fragmented MP4 chunks of the tracks of a video, like
+# video_fmp4, video_360p_fmp4 and audio_fmp4_chunk_index
+FRAGMENT_KEY_PREFIX = r"(?:video(?:_\d+p)?|audio)_fmp4(?:_chunk_index)?"
+
+# matches the keys of a video, with the video ID as a hash tag or, for
+# videos stored before the data was sharded, without it
+KEY_PATTERN = re.compile(
+    r"^("
+    + "|".join(KEY_PREFIXES + (RENDITION_KEY_PREFIX, FRAGMENT_KEY_PREFIX))
+    + r")_(?:\{([0-9a-f]{32})\}|([0-9a-f]{32}))$"
+)
+
+
+def parse_nodes(nodes: str) -> List[Tuple[str, int]]:
+    """
+    Parse a comma separated list of host:port redis nodes.
+    """
+    parsed_nodes = []
+    for node in nodes.split(","):
+        if not node.strip():
+            continue
+        host, _, port = node.strip().rpartition(":")
+        parsed_nodes.append((host, int(port)))
+    return parsed_nodes
+
+
+def hash_value(value: str) -> int:
+    """
+    Hash a string to a position on the ring.
+    """
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+def build_ring(nodes: List[Tuple[str, int]]) -> List[Tuple[int, int]]:
+    """
+    Build the consistent hash ring, REDIS_VIRTUAL_NODES positions for every
+    node. The positions depend only on the host and port of the node, not on
+    its place in the list.
+    """
+    return sorted(
+        (hash_value(f"{host}:{port}#{replica}"), index)
+        for index, (host, port) in enumerate(nodes)
+        for replica in range(config.REDIS_VIRTUAL_NODES)
+    )
+
+
+NODES = parse_nodes(config.REDIS_NODES)
+RING = build_ring(NODES)
+
+
+def get_node_index(video_id: str, ring: List[Tuple[int, int]] = RING) -> int:
+    """
+    Get the index of the node that stores the data of a video, the first
+    node position on the ring after the hash of the video ID.
+    """
+    position = bisect.bisect(ring, (hash_value(video_id),))
+    return ring[position % len(ring)][1]
+
+
+def get_key(prefix: str, video_id: str) -> str:
+    """
+    Get the name of a key of a video, with the video ID as a hash tag.
+    """
+    return f"{prefix}_{{{video_id}}}"
+
+
+def get_video_keys(video_id: str, tracks: Sequence[str] = ()) -> List[str]:
+    """
+    Get the names of all the keys of a video, with the chunks and chunk
+    index of the given video tracks of its renditions.
+    """
+    return [get_key(prefix, video_id) for prefix in KEY_PREFIXES] + [
+        get_key(prefix, video_id)
+        for track in tracks
+        for prefix in (track, f"{track}_chunk_index")
+    ]
+
+
+def parse_key(key: str) -> Optional[Tuple[str, str]]:
+    """
+    Get the prefix and the video ID of a key of a video.
+    Returns None if the key does not hold the data of a video.
+    """
+    match = KEY_PATTERN.match(key)
+    if not match:
+        return None
+    return match.group(1), match.group(2) or match.group(3)
@@ -0,0 +1,535 @@
+"""
+Module for moving rarely watched videos between redis and the cold tier.
+
+Videos that were not accessed for TIER_DEMOTE_AFTER seconds are demoted:
+their chunks and audio are written to COLD_STORAGE_PATH on disk and removed
+from redis. A demoted video is promoted back to redis in the background when
+it is accessed, meanwhile its chunks are read from disk. The tier of a video,
+"hot" or "cold", is kept in its metadata. Chunks stored in packed files are
+on disk already, those videos are not demoted.
+
+The cold copy of a video is kept after it is promoted, the video data never
+changes after ingest, so demoting it again only removes it from redis.
+
+Videos with the same content share their stored data, which is moved as a
+whole: it is demoted once none of these videos was accessed and the tier is
+recorded in the metadata of all of them.
+"""
+
+import asyncio
+import os
+import shutil
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from redis.lock import Lock
+
+import asyncdb
+import config
+import db
+import dedup
+import information
+import metadata
+import rendition
+
+# the last access of a video is written to redis at most once per this many
+# seconds by every worker process
+LAST_ACCESS_RESOLUTION = 60
+
+# video_id -> time of the last access written to redis by this process
+recorded_accesses: Dict[str, float] = {}
+
+# demote and promote hold a lock for at most this many seconds
+TIER_LOCK_TIMEOUT = 600
+
+# videos that are being promoted by this process
+promotions: Set[str] = set()
+promotions_lock = threading.Lock()
+
+
+def get_cold_video_dir(data_id: str) -> str:
+    """
+    Get the directory of the data of a video in the cold tier.
+    """
+    return os.path.join(config.COLD_STORAGE_PATH, data_id)
+
+
+def is_cold_copy_complete(data_id: str) -> bool:
+    """
+    Check if the whole data of a video was written to the cold tier.
+    """
+    return os.path.isdir(get_cold_video_dir(data_id))
+
+
+def write_stream_entries(entries: List, directory: str, extension: str) -> None:
+    """
+    Write the chunks of redis stream entries as files, one per chunk.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for _, fields in entries:
+        for chunk_id, chunk in fields.items():
+            with open(
+                os.path.join(directory, f"{chunk_id.decode()}.{extension}"), "wb"
+            ) as file:
+                file.write(chunk)
+
+
+def write_cold_copy(data_id: str, tracks: Sequence[str] = ()) -> bool:
+    """
+    Write the chunks and the audio of a video from redis to the cold tier,
+    with the chunks of the given video tracks of its renditions.
+
+    The files are written to a temporary directory that is renamed once it
+    is complete, so readers never see a partial cold copy.
+    """
+    video_chunks = db.get_video_chunks(data_id)
+    if not video_chunks:
+        return False
+
+    partial_dir = get_cold_video_dir(data_id) + ".partial"
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    try:
+        write_stream_entries(video_chunks, os.path.join(partial_dir, "video"), "mkv")
+        for track in tracks:
+            write_stream_entries(
+                db.get_video_chunks(data_id, track),
+                os.path.join(partial_dir, track),
+                "mkv",
+            )
+        write_stream_entries(
+            db.get_audio_chunks(data_id), os.path.join(partial_dir, "audio"), "webm"
+        )
+        audio = db.get_audio(data_id)
+        if audio:
+            with open(os.path.join(partial_dir, "audio.mkv"), "wb") as file:
+                file.write(audio)
+        os.replace(partial_dir, get_cold_video_dir(data_id))
+        return True
+    except Exception as err:
+        print("error while writing the cold copy of a video: ", err)
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        return False
+
+
+def set_tier(data_id: str, tier: str) -> bool:
+    """
+    Record the tier of the stored data in the metadata of the videos using
+    it.
+    """
+    status = True
+    for video_id in dedup.get_video_ids(data_id):
+        video_metadata = db.get_video_metadata_from_redis_hash(
+            video_id=video_id, hash_name=config.REDIS_HASH_NAME
+        )
+        if not video_metadata:
+            continue
+        video_metadata["tier"] = tier
+        # a video deleted since its metadata was read is not added again
+        if not db.update_video_metadata_in_redis_hash(
+            video_metadata, hash_name=config.REDIS_HASH_NAME
+        ) and db.does_video_metadata_exist_in_redis_hash(
+            video_id=video_id, hash_name=config.REDIS_HASH_NAME
+        ):
+            status = False
+        information.invalidate_video_information(video_id)
+    return status
+
+
+def get_tier_lock(data_id: str) -> Lock:
+    """
+    Get the lock held while the stored data of a video changes tier.
+    """
+    return db.get_lock(f"tier_lock_{data_id}", timeout=TIER_LOCK_TIMEOUT)
+
+
+def release_lock(lock: Lock) -> None:
+    """
+    Release the lock of a video, if it is still held.
+    """
+    try:
+        lock.release()
+    except Exception:
+        pass
+
+
+def demote_video(video_id: str) -> bool:
+    """
+    Move the data of a video from redis to the cold tier.
+    """
+    video_metadata = db.get_video_metadata_from_redis_hash(
+        video_id=video_id, hash_name=config.REDIS_HASH_NAME
+    )
+    if not video_metadata:
+        return False
+    data_id = dedup.get_data_id(video_metadata)
+    lock = get_tier_lock(data_id)
+    if not lock.acquire(blocking=False):
+        return False
+    try:
+        video_metadata = db.get_video_metadata_from_redis_hash(
+            video_id=video_id, hash_name=config.REDIS_HASH_NAME
+        )
+        if not video_metadata or video_metadata.get("tier") == "cold":
+            return False
+
+        tracks = rendition.get_tracks(video_metadata)
+        if not is_cold_copy_complete(data_id) and not write_cold_copy(data_id, tracks):
+            return False
+
+        # readers that still see the video as hot fall back to the cold copy
+        # once the redis data is deleted
+        if not set_tier(data_id, "cold"):
+            return False
+        return db.delete_video_data(data_id, tracks)
+    finally:
+        release_lock(lock)
+
+
+def promote_video(video_id: str) -> bool:
+    """
+    Move the data of a video from the cold tier back to redis.
+    """
+    video_metadata = db.get_video_metadata_from_redis_hash(
+        video_id=video_id, hash_name=config.REDIS_HASH_NAME
+    )
+    if not video_metadata:
+        return False
+    data_id = dedup.get_data_id(video_metadata)
+    lock = get_tier_lock(data_id)
+    if not lock.acquire(blocking=False):
+        return False
+    try:
+        video_metadata = db.get_video_metadata_from_redis_hash(
+            video_id=video_id, hash_name=config.REDIS_HASH_NAME
+        )
+        if not video_metadata or video_metadata.get("tier") != "cold":
+            return False
+
+        cold_video_dir = get_cold_video_dir(data_id)
+        tracks = rendition.get_tracks(video_metadata)
+        status = db.add_video_chunk_files_to_redis_stream(
+            data_id, list_cold_files(os.path.join(cold_video_dir, "video"))
+        )
+        for track in tracks:
+            status = status and db.add_video_chunk_files_to_redis_stream(
+                data_id, list_cold_files(os.path.join(cold_video_dir, track)), track
+            )
+        status = status and db.add_audio_chunk_files_to_redis_stream(
+            data_id, list_cold_files(os.path.join(cold_video_dir, "audio"))
+        )
+        if os.path.isfile(os.path.join(cold_video_dir, "audio.mkv")):
+            status = status and db.add_audio_to_redis(
+                data_id, os.path.join(cold_video_dir, "audio.mkv")
+            )
+
+        if not status or not set_tier(data_id, "hot"):
+            db.delete_video_data(data_id, tracks)
+            return False
+        return True
+    finally:
+        release_lock(lock)
+
+
+def promote_video_in_background(video_id: str) -> None:
+    """
+    Promote a video in a background thread, unless this process is already
+    promoting it.
+    """
+    with promotions_lock:
+        if video_id in promotions:
+            return
+        promotions.add(video_id)
+
+    def run_promotion() -> None:
+        try:
+            promote_video(video_id)
+        except Exception as err:
+            print("error while promoting a video: ", err)
+        finally:
+            with promotions_lock:
+                promotions.discard(video_id)
+
+    threading.Thread(target=run_promotion, daemon=True).start()
+
+
+def list_cold_files(directory: str) -> List[str]:
+    """
+    List the chunk files of a directory of the cold tier.
+    """
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, file_name) for file_name in os.listdir(directory)]
+
+
+def get_cold_chunk_file(data_id: str, track: str, chunk_id: str) -> str:
+    """
+    Get the path of a chunk of a video or the audio track in the cold tier.
+    """
+    extension = "webm" if track == "audio" else "mkv"
+    return os.path.join(get_cold_video_dir(data_id), track, f"{chunk_id}.{extension}")
+
+
+def read_cold_chunks(data_id: str, track: str, chunk_ids: List[str]) -> List:
+    """
+    Read the given chunks of a video or the audio track from the cold tier.
+
+    The chunks are returned like redis stream entries, so the read path does
+    not depend on the tier.
+    """
+    entries = []
+    for chunk_id in chunk_ids:
+        chunk_file = get_cold_chunk_file(data_id, track, chunk_id)
+        if not os.path.isfile(chunk_file):
+            continue
+        with open(chunk_file, "rb") as file:
+            entries.append((None, {chunk_id.encode(): file.read()}))
+    return entries
+
+
+def read_cold_audio(data_id: str) -> Optional[bytes]:
+    """
+    Read the audio stored as one blob from the cold tier.
+    """
+    audio_file = os.path.join(get_cold_video_dir(data_id), "audio.mkv")
+    if not os.path.isfile(audio_file):
+        return None
+    with open(audio_file, "rb") as file:
+        return file.read()
+
+
+def is_demoting() -> bool:
+    """
+    Check if videos are demoted. Chunks stored in packed files are on disk
+    already, moving them to the cold tier would not free redis memory.
+    """
+    return (
+        bool(config.TIER_DEMOTE_AFTER and config.TIER_SWEEP_INTERVAL)
+        and config.CHUNK_BACKEND != "packed"
+    )
+
+
+async def record_access(video_id: str) -> None:
+    """
+    Record the time a video was accessed, used to find videos to demote.
+    """
+    if not is_demoting():
+        return
+    now = time.time()
+    if now - recorded_accesses.get(video_id, 0) < LAST_ACCESS_RESOLUTION:
+        return
+    recorded_accesses[video_id] = now
+    await asyncdb.set_redis_hash_field(
+        config.REDIS_LAST_ACCESS_HASH_NAME, video_id, str(int(now))
+    )
+
+
+async def is_cold(video_id: str) -> bool:
+    """
+    Check if a video is in the cold tier. While a video is promoted it is
+    still cold, so its partially written redis data is not read.
+    """
+    video_information = await information.get_video_information_async(video_id)
+    return bool(video_information) and video_information.get("tier") == "cold"
+
+
+async def get_data_id(video_id: str) -> str:
+    """
+    Get the ID the chunks and audio of a video are stored under.
+    """
+    video_information = await information.get_video_information_async(video_id)
+    if not video_information:
+        return video_id
+    return dedup.get_data_id(video_information)
+
+
+async def get_chunks_by_chunk_ids(
+    video_id: str, track: str, chunk_ids: List[str]
+) -> List:
+    """
+    Get the given chunks of a video track or the audio track from redis, or
+    from the cold tier if the video was demoted. A demoted video is promoted.
+    """
+    await record_access(video_id)
+    data_id = await get_data_id(video_id)
+    if not await is_cold(video_id):
+        if track == "audio":
+            entries = await asyncdb.get_audio_chunks_by_chunk_ids(data_id, chunk_ids)
+        else:
+            entries = await asyncdb.get_video_chunks_by_chunk_ids(
+                data_id, chunk_ids, track
+            )
+        # the video may have been demoted since its metadata was read
+        if entries or not is_cold_copy_complete(data_id):
+            return entries
+
+    entries = await asyncio.to_thread(read_cold_chunks, data_id, track, chunk_ids)
+    if entries:
+        promote_video_in_background(video_id)
+    return entries
+
+
+async def get_stored_chunk_ids(
+    video_id: str, track: str, chunk_ids: List[str]
+) -> List[str]:
+    """
+    Get the given chunk IDs of a video track or the audio track that are
+    stored, in order, from either tier. The chunks are only read if they
+    are not in a chunk index.
+    """
+    data_id = await get_data_id(video_id)
+    if not await is_cold(video_id):
+        stored_chunk_ids = await asyncdb.get_indexed_chunk_ids(
+            data_id, track, chunk_ids
+        )
+        if stored_chunk_ids is None:
+            entries = await get_chunks_by_chunk_ids(video_id, track, chunk_ids)
+            stored = {
+                chunk_id.decode("utf-8") for entry in entries for chunk_id in entry[1]
+            }
+            return [chunk_id for chunk_id in chunk_ids if chunk_id in stored]
+        # the video may have been demoted since its metadata was read
+        if stored_chunk_ids or not is_cold_copy_complete(data_id):
+            return stored_chunk_ids
+
+    return [
+        chunk_id
+        for chunk_id in chunk_ids
+        if os.path.isfile(get_cold_chunk_file(data_id, track, chunk_id))
+    ]
+
+
+async def get_video_chunks_by_chunk_ids(
+    video_id: str, chunk_ids: List[str], track: str = "video"
+) -> List:
+    """
+    Get only the given video chunks of the video track of a rendition, from
+    either tier.
+    """
+    return await get_chunks_by_chunk_ids(video_id, track, chunk_ids)
+
+
+async def get_audio_chunks_by_chunk_ids(video_id: str, chunk_ids: List[str]) -> List:
+    """
+    Get only the given audio chunks, from either tier.
+    """
+    return await get_chunks_by_chunk_ids(video_id, "audio", chunk_ids)
+
+
+async def get_audio(video_id: str) -> Optional[bytes]:
+    """
+    Get the audio stored as one blob, from either tier.
+    """
+    await record_access(video_id)
+    data_id = await get_data_id(video_id)
+    if not await is_cold(video_id):
+        audio = await asyncdb.get_audio(data_id)
+        if audio or not is_cold_copy_complete(data_id):
+            return audio
+
+    audio = await asyncio.to_thread(read_cold_audio, data_id)
+    if audio:
+        promote_video_in_background(video_id)
+    return audio
+
+
+async def get_video_chunk_count(video_id: str) -> int:
+    """
+    Get the number of video chunks, from either tier.
+    """
+    data_id = await get_data_id(video_id)
+    if not await is_cold(video_id):
+        chunk_count = await asyncdb.get_video_chunk_count(data_id)
+        if chunk_count or not is_cold_copy_complete(data_id):
+            return chunk_count
+    return len(list_cold_files(os.path.join(get_cold_video_dir(data_id), "video")))
+
+
+def get_last_access(video_metadata: Dict, last_accesses: Dict[str, str]) -> float:
+    """
+    Get the time of the last access of a video, or of its ingest if it was
+    never accessed.
+    """
+    if video_metadata["video_id"] in last_accesses:
+        return float(last_accesses[video_metadata["video_id"]])
+    ingested = metadata.parse_timestamp(video_metadata.get("timestamp"))
+    return ingested if ingested is not None else time.time()
+
+
+def prune_recorded_accesses() -> None:
+    """
+    Forget the accesses recorded by this process more than
+    LAST_ACCESS_RESOLUTION seconds ago, the next access of these videos is
+    written to redis anyway.
+    """
+    recorded_before = time.time() - LAST_ACCESS_RESOLUTION
+    for video_id, recorded_at in recorded_accesses.copy().items():
+        if recorded_at < recorded_before:
+            recorded_accesses.pop(video_id, None)
+
+
+def sweep() -> int:
+    """
+    Demote the hot data of the videos that were not accessed for
+    TIER_DEMOTE_AFTER seconds. Data shared by several videos is demoted once
+    none of them was accessed.
+
+    Returns the number of demoted videos.
+    """
+    prune_recorded_accesses()
+    last_accesses = db.get_redis_hash(config.REDIS_LAST_ACCESS_HASH_NAME)
+    demote_before = time.time() - config.TIER_DEMOTE_AFTER
+
+    # data_id -> (last access of the videos using the data, one of the videos)
+    hot_data: Dict[str, Tuple[float, str]] = {}
+    for video_metadata in db.iterate_video_metadata_in_redis_hash(
+        hash_name=config.REDIS_HASH_NAME
+    ):
+        if video_metadata.get("tier") == "cold":
+            continue
+        data_id = dedup.get_data_id(video_metadata)
+        last_access = get_last_access(video_metadata, last_accesses)
+        if data_id in hot_data:
+            last_access = max(last_access, hot_data[data_id][0])
+        hot_data[data_id] = (last_access, video_metadata["video_id"])
+
+    demoted = 0
+    for last_access, video_id in hot_data.values():
+        if last_access < demote_before and demote_video(video_id):
+            demoted += 1
+    return demoted
+
+
+def purge_video(video_id: str) -> None:
+    """
+    Forget the last access of a video.
+    """
+    db.delete_redis_hash_fields(config.REDIS_LAST_ACCESS_HASH_NAME, [video_id])
+    recorded_accesses.pop(video_id, None)
+
+
+def purge_data(data_id: str) -> None:
+    """
+    Remove the data of a video from the cold tier.
+    """
+    shutil.rmtree(get_cold_video_dir(data_id), ignore_errors=True)
+
+
+def run_sweeper() -> None:
+    """
+    Demote videos every TIER_SWEEP_INTERVAL seconds.
+    """
+    while True:
+        time.sleep(config.TIER_SWEEP_INTERVAL)
+        try:
+            sweep()
+        except Exception as err:
+            print("error while demoting videos: ", err)
+
+
+def start_sweeper() -> None:
+    """
+    Start demoting videos in a background thread.
+    """
+    if is_demoting():
+        threading.Thread(target=run_sweeper, daemon=True).start()
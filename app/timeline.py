@@ -0,0 +1,150 @@
+"""
+Module for the timeline of the chunks of a video.
+
+Chunk N of a video covers the chunk seconds of the video starting at N times
+the chunk seconds, videos stored before the chunk seconds were configurable
+have one second chunks. Videos that were cut at their own keyframes have
+chunks as long as their keyframe intervals instead, the start time of every
+chunk and the end time of the last chunk are stored in redis by data ID.
+Requests are in seconds and are mapped to the chunks covering them.
+"""
+
+import bisect
+import json
+from typing import Dict, List, Optional, Tuple
+
+import asyncdb
+import config
+import dedup
+import information
+
+# chunk times read from redis in this process by data ID, the chunks of the
+# stored data never change
+CHUNK_TIMES_CACHE_SIZE = 1024
+chunk_times_cache: Dict[str, List[float]] = {}
+
+
+def dump_chunk_times(chunk_times: Optional[List[float]]) -> Optional[str]:
+    """
+    Serialize the chunk times of a video cut at its keyframes to store them
+    in redis, the first chunk starts at the start of the video.
+    """
+    if not chunk_times:
+        return None
+    return json.dumps([0.0] + [round(chunk_time, 3) for chunk_time in chunk_times[1:]])
+
+
+def get_chunk_seconds(video_information: Dict) -> int:
+    """
+    Get the length in seconds of the chunks of a video.
+    """
+    return video_information.get("chunk_seconds") or 1
+
+
+def get_video_duration(video_information: Dict) -> float:
+    """
+    Get the duration in seconds of the video stream of a video, videos
+    stored before it was recorded only have the duration in whole seconds.
+    """
+    return video_information.get("video_duration") or video_information["duration"]
+
+
+def get_chunk_start(
+    chunk_times: Optional[List[float]], chunk_seconds: int, chunk_number: int
+) -> float:
+    """
+    Get the start time in seconds of a chunk, from the chunk times of a
+    video cut at its keyframes or from the chunk seconds of the video.
+    """
+    if chunk_times:
+        return chunk_times[chunk_number]
+    return float(chunk_number * chunk_seconds)
+
+
+def get_uniform_chunk_times(duration: int, chunk_seconds: int) -> List[float]:
+    """
+    Get the chunk times of a video stored as chunks of chunk_seconds,
+    duration is in whole seconds like in the metadata.
+    """
+    return [
+        float(chunk * chunk_seconds) for chunk in range(duration // chunk_seconds + 2)
+    ]
+
+
+def get_counted_chunk_times(
+    chunk_count: int, chunk_seconds: int, duration: float
+) -> List[float]:
+    """
+    Get the chunk times of chunk_count stored chunks of chunk_seconds, the
+    last chunk ends at the end of the video, duration in seconds.
+    """
+    chunk_times = [float(chunk * chunk_seconds) for chunk in range(chunk_count)]
+    last_start = chunk_times[-1] if chunk_times else 0.0
+    if duration <= last_start:
+        # the whole seconds duration of older videos can end before the
+        # start of their last chunk
+        return chunk_times + [last_start + chunk_seconds]
+    return chunk_times + [float(duration)]
+
+
+async def get_chunk_times(video_id: str) -> List[float]:
+    """
+    Get the start time of every chunk of a video and the end time of its
+    last chunk.
+    """
+    video_information = await information.get_video_information_async(video_id)
+    data_id = dedup.get_data_id(video_information)
+    chunk_times = chunk_times_cache.get(data_id)
+    if chunk_times:
+        return chunk_times
+
+    stored_chunk_times = None
+    if video_information.get("keyframe_chunks"):
+        stored_chunk_times = (
+            await asyncdb.get_redis_hash_fields(
+                config.REDIS_CHUNK_TIMES_HASH_NAME, [data_id]
+            )
+        )[0]
+    if not stored_chunk_times:
+        return get_uniform_chunk_times(
+            video_information["duration"], get_chunk_seconds(video_information)
+        )
+
+    chunk_times = json.loads(stored_chunk_times)
+    if len(chunk_times_cache) >= CHUNK_TIMES_CACHE_SIZE:
+        chunk_times_cache.pop(next(iter(chunk_times_cache)))
+    chunk_times_cache[data_id] = chunk_times
+    return chunk_times
+
+
+def get_chunk_range(chunk_times: List[float], start: int, end: int) -> Tuple[int, int]:
+    """
+    Get the first and last chunk covering the seconds start to end, end is
+    inclusive and -1 means the end of the video.
+    """
+    last_chunk = len(chunk_times) - 2
+    first_chunk = max(bisect.bisect_right(chunk_times, start) - 1, 0)
+    if end == -1:
+        return first_chunk, last_chunk
+    return first_chunk, min(bisect.bisect_left(chunk_times, end + 1) - 1, last_chunk)
+
+
+def get_chunk_offset(
+    chunk_times: List[float], first_chunk: int, last_chunk: int
+) -> Tuple[float, Optional[float]]:
+    """
+    Get the start time and the duration in seconds of the chunks first_chunk
+    to last_chunk. The duration is None if last_chunk is the last chunk of
+    the video.
+    """
+    offset = chunk_times[first_chunk]
+    if last_chunk >= len(chunk_times) - 2:
+        return offset, None
+    return offset, chunk_times[last_chunk + 1] - offset
+
+
+def get_chunk_durations(chunk_times: List[float]) -> List[float]:
+    """
+    Get the duration in seconds of every chunk.
+    """
+    return [end - start for start, end in zip(chunk_times, chunk_times[1:])]
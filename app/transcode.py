@@ -1,17 +1,20 @@
 import subprocess
-from typing import Dict
+from typing import Dict, Optional
 
 
-def transcode_to_opus(input_file: str, output_file: str) -> Dict:
+def transcode_to_opus(
+    input_file: str, output_file: str, codec: Optional[str] = None
+) -> Dict:
     response: Dict = {}
     try:
-        # check if input audio is already in Opus codec
-        check_command = f"ffprobe -v error -select_streams a:0 -show_entries stream=codec_name -of default=nw=1 {input_file}"
-        codec = (
-            subprocess.run(check_command, shell=True, stdout=subprocess.PIPE)
-            .stdout.strip()
-            .decode("utf-8")
-        )
+        # check if input audio is already in Opus codec, unless the codec is known
+        if codec is None:
+            check_command = f"ffprobe -v error -select_streams a:0 -show_entries stream=codec_name -of default=nw=1 {input_file}"
+            codec = (
+                subprocess.run(check_command, shell=True, stdout=subprocess.PIPE)
+                .stdout.strip()
+                .decode("utf-8")
+            )
         if codec == "opus":
             response["message"] = "Input audio is already in Opus codec"
         else:
@@ -0,0 +1,87 @@
+"""
+Module for the secondary indexes of the video catalog.
+
+The ingest timestamp, duration and fps of every video are indexed in sorted
+sets, the resolution and audio codec in one set per value. The indexes are
+updated in the same transaction as the video metadata at ingest and delete,
+and answer the filter and sort queries of the video list.
+
+Run this module to build the indexes of videos ingested before they existed:
+
+    python videoindex.py
+"""
+
+from typing import Dict, List, Optional
+
+import config
+import db
+import metadata
+
+SORTED_FIELDS = ("timestamp", "duration", "fps")
+SET_FIELDS = ("resolution", "audio_codec")
+
+
+def get_index_name(field: str) -> str:
+    """
+    Get the name of the sorted set index of a field.
+    """
+    return f"{config.REDIS_VIDEO_INDEX_PREFIX}_{field}"
+
+
+def get_index_set(field: str, value: Optional[str]) -> str:
+    """
+    Get the name of the set index of a value of a field, videos without the
+    field, like videos without audio, are in the set of "none".
+    """
+    return f"{config.REDIS_VIDEO_INDEX_PREFIX}_{field}_{value or 'none'}"
+
+
+def get_index_names() -> List[str]:
+    """
+    Get the names of all the sorted set indexes.
+    """
+    return [get_index_name(field) for field in SORTED_FIELDS]
+
+
+def get_index_scores(video_metadata: Dict) -> Dict[str, float]:
+    """
+    Get the score of a video in every sorted set index.
+    """
+    index_scores = {}
+    timestamp = metadata.parse_timestamp(video_metadata.get("timestamp"))
+    if timestamp is not None:
+        index_scores[get_index_name("timestamp")] = timestamp
+    for field in ("duration", "fps"):
+        if video_metadata.get(field) is not None:
+            index_scores[get_index_name(field)] = float(video_metadata[field])
+    return index_scores
+
+
+def get_index_sets(video_metadata: Dict) -> List[str]:
+    """
+    Get the set indexes a video is in.
+    """
+    return [get_index_set(field, video_metadata.get(field)) for field in SET_FIELDS]
+
+
+def rebuild_indexes() -> int:
+    """
+    Add every video of the redis hash to the indexes.
+
+    Returns the number of indexed videos.
+    """
+    indexed = 0
+    for video_metadata in db.iterate_video_metadata_in_redis_hash(
+        hash_name=config.REDIS_HASH_NAME
+    ):
+        if db.update_video_indexes(
+            video_metadata["video_id"],
+            get_index_scores(video_metadata),
+            get_index_sets(video_metadata),
+        ):
+            indexed += 1
+    return indexed
+
+
+if __name__ == "__main__":
+    print(f"{rebuild_indexes()} videos indexed")
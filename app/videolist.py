@@ -2,17 +2,92 @@
 Module for getting all video information.
 """
 
-from typing import Dict
+import json
+from typing import AsyncIterator, Dict, Optional, Tuple
 
+import asyncdb
 import config
-import db
+import videoindex
 
 
-def get_all_video_information() -> Dict:
+async def stream_video_information(cursor: int, limit: int) -> AsyncIterator[str]:
     """
-    Get all video information from redis hash.
+    Stream a page of the video information from redis hash as JSON,
+    {"videos": {video_id: video_information, ...}, "next_cursor": cursor}.
+
+    The hash is read with HSCAN until about limit videos are read, the
+    next_cursor is null after the last page. The video information is stored
+    as JSON, so it is streamed without decoding it.
+    """
+    yield '{"videos": {'
+    separator = ""
+    count = 0
+    while True:
+        cursor, video_information = await asyncdb.scan_redis_hash(
+            config.REDIS_HASH_NAME, cursor, limit - count
+        )
+        if video_information:
+            yield separator + ", ".join(
+                f"{json.dumps(video_id.decode())}: {information.decode()}"
+                for video_id, information in video_information.items()
+            )
+            separator = ", "
+        count += len(video_information)
+        if not cursor or count >= limit:
+            break
+    yield f'}}, "next_cursor": {json.dumps(cursor or None)}}}'
+
+
+async def stream_indexed_video_information(
+    sort: str,
+    descending: bool,
+    ranges: Dict[str, Tuple[float, float]],
+    filters: Dict[str, str],
+    has_audio: Optional[bool],
+    offset: int,
+    limit: int,
+) -> AsyncIterator[str]:
+    """
+    Stream a page of the video information of the videos matching the
+    filters, ordered by the sort field, as JSON,
+    {"videos": {video_id: video_information, ...}, "next_cursor": offset,
+    "total": total}.
+
+    ranges maps sorted fields to the minimum and maximum values and filters
+    maps set fields to their values. The video IDs are looked up in the
+    indexes, then their video information is read from the redis hash.
     """
-    video_information = db.get_all_video_metadata_from_redis_hash(
-        hash_name=config.REDIS_HASH_NAME
+    index_sets = [
+        videoindex.get_index_set(field, value) for field, value in filters.items()
+    ]
+    excluded_sets = []
+    no_audio_set = videoindex.get_index_set("audio_codec", None)
+    if has_audio:
+        excluded_sets.append(no_audio_set)
+    elif has_audio is not None:
+        index_sets.append(no_audio_set)
+
+    video_ids, total = await asyncdb.query_video_indexes(
+        videoindex.get_index_name(sort),
+        descending,
+        {
+            videoindex.get_index_name(field): field_range
+            for field, field_range in ranges.items()
+        },
+        index_sets,
+        excluded_sets,
+        offset,
+        limit,
+    )
+    video_information = await asyncdb.get_redis_hash_fields(
+        config.REDIS_HASH_NAME, video_ids
+    )
+
+    yield '{"videos": {'
+    yield ", ".join(
+        f"{json.dumps(video_id)}: {information.decode()}"
+        for video_id, information in zip(video_ids, video_information)
+        if information
     )
-    return video_information
+    next_cursor = offset + limit if offset + limit < total else None
+    yield f'}}, "next_cursor": {json.dumps(next_cursor)}, "total": {total}}}'
@@ -0,0 +1,100 @@
+import asyncio
+import os
+
+import pytest
+
+import byterange
+
+FILE_SIZE = 1000
+
+
+@pytest.mark.parametrize(
+    "range_header, byte_range",
+    [
+        ("bytes=0-99", (0, 99)),
+        ("bytes=100-100", (100, 100)),
+        # the last byte is clamped to the end of the file
+        ("bytes=900-5000", (900, 999)),
+        # open-ended
+        ("bytes=500-", (500, 999)),
+        # suffix, the last bytes of the file
+        ("bytes=-100", (900, 999)),
+        ("bytes=-5000", (0, 999)),
+        ("bytes= 10 - 20 ", (10, 20)),
+    ],
+)
+def test_parse_range_header(range_header, byte_range):
+    assert byterange.parse_range_header(range_header, FILE_SIZE) == byte_range
+
+
+@pytest.mark.parametrize(
+    "range_header",
+    [
+        None,
+        "",
+        "items=0-99",
+        "bytes=0-1,5-6",
+        "bytes=a-b",
+        "bytes=100",
+        # inverted
+        "bytes=500-100",
+    ],
+)
+def test_parse_range_header_serves_the_whole_file(range_header):
+    assert byterange.parse_range_header(range_header, FILE_SIZE) is None
+
+
+@pytest.mark.parametrize(
+    "range_header", ["bytes=1000-", "bytes=2000-3000", "bytes=-0", "bytes=-"]
+)
+def test_parse_range_header_unsatisfiable(range_header):
+    with pytest.raises(ValueError):
+        byterange.parse_range_header(range_header, FILE_SIZE)
+
+
+def read_body(response):
+    async def read():
+        return b"".join([buffer async for buffer in response.body_iterator])
+
+    return asyncio.run(read())
+
+
+@pytest.fixture
+def video_file(tmp_path):
+    path = tmp_path / "video.webm"
+    path.write_bytes(os.urandom(FILE_SIZE))
+    return str(path)
+
+
+def test_file_response_range(video_file):
+    response = byterange.file_response(video_file, "bytes=100-199")
+    assert response.status_code == 206
+    assert response.headers["content-range"] == "bytes 100-199/1000"
+    assert response.headers["content-length"] == "100"
+    with open(video_file, "rb") as file:
+        assert read_body(response) == file.read()[100:200]
+
+
+def test_file_response_whole_file(video_file):
+    response = byterange.file_response(video_file, None)
+    assert response.status_code == 200
+    assert response.headers["content-length"] == str(FILE_SIZE)
+    with open(video_file, "rb") as file:
+        assert read_body(response) == file.read()
+
+
+def test_file_response_unsatisfiable(video_file):
+    response = byterange.file_response(video_file, "bytes=1000-")
+    assert response.status_code == 416
+    assert response.headers["content-range"] == "bytes */1000"
+
+
+def test_file_response_of_deleted_file(video_file):
+    with open(video_file, "rb") as file:
+        data = file.read()
+    response = byterange.file_response(video_file, "bytes=-10")
+    os.remove(video_file)
+    assert read_body(response) == data[-10:]
+
+    with pytest.raises(FileNotFoundError):
+        byterange.file_response(video_file, None)
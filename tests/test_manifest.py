@@ -0,0 +1,104 @@
+import asyncio
+
+import information
+import manifest
+import tier
+
+VIDEO_INFORMATION = {
+    "video_id": "video",
+    "duration": 7,
+    "video_duration": 7.52,
+    "chunk_seconds": 3,
+    "resolution": "320x240",
+    "video_bitrate": 400000,
+    "audio_codec": "opus",
+    "renditions": [
+        {"name": "120p", "resolution": "160x120", "bitrate": 100000},
+        {"name": "180p", "resolution": "240x180", "bitrate": 200000},
+    ],
+}
+
+
+def get_uris(playlist):
+    return [line for line in playlist.splitlines() if not line.startswith("#")]
+
+
+def test_master_playlist():
+    playlist = manifest.generate_master_playlist(VIDEO_INFORMATION)
+    lines = playlist.splitlines()
+    assert lines[:2] == ["#EXTM3U", "#EXT-X-VERSION:7"]
+    assert '#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio"' in lines[2]
+    assert 'URI="audio.m3u8"' in lines[2]
+    assert lines[3] == (
+        '#EXT-X-STREAM-INF:BANDWIDTH=400000,CODECS="vp09.00.10.08,opus",'
+        'RESOLUTION=320x240,AUDIO="audio"'
+    )
+    assert get_uris(playlist) == [
+        "video.m3u8",
+        "video.m3u8?rendition=120p",
+        "video.m3u8?rendition=180p",
+    ]
+    assert playlist.endswith("\n")
+
+
+def test_master_playlist_with_max_bitrate():
+    playlist = manifest.generate_master_playlist(VIDEO_INFORMATION, 250000)
+    assert get_uris(playlist) == [
+        "video.m3u8?rendition=180p",
+        "video.m3u8?rendition=120p",
+    ]
+
+
+def test_master_playlist_without_audio_and_renditions():
+    playlist = manifest.generate_master_playlist(
+        {"video_id": "video", "duration": 10, "file_size": 1250000}
+    )
+    assert "#EXT-X-MEDIA" not in playlist
+    # the bandwidth of videos stored before the ladder is estimated
+    assert '#EXT-X-STREAM-INF:BANDWIDTH=1000000,CODECS="vp09.00.10.08"\n' in playlist
+    assert get_uris(playlist) == ["video.m3u8"]
+
+
+def test_media_playlist():
+    playlist = manifest.generate_media_playlist(
+        [3.0, 3.0, 1.52], "video", "?rendition=120p"
+    )
+    assert playlist.splitlines() == [
+        "#EXTM3U",
+        "#EXT-X-VERSION:7",
+        "#EXT-X-TARGETDURATION:3",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+        "#EXT-X-INDEPENDENT-SEGMENTS",
+        '#EXT-X-MAP:URI="video/init.mp4?rendition=120p"',
+        "#EXTINF:3.000,",
+        "video/0.m4s?rendition=120p",
+        "#EXTINF:3.000,",
+        "video/1.m4s?rendition=120p",
+        "#EXTINF:1.520,",
+        "video/2.m4s?rendition=120p",
+        "#EXT-X-ENDLIST",
+    ]
+
+
+def test_media_playlist_target_duration_rounds_up():
+    playlist = manifest.generate_media_playlist([1.927, 2.273, 1.8], "audio")
+    assert "#EXT-X-TARGETDURATION:3" in playlist
+    assert get_uris(playlist) == ["audio/0.m4s", "audio/1.m4s", "audio/2.m4s"]
+
+
+def test_segment_durations(monkeypatch):
+    async def get_video_information_async(video_id):
+        return VIDEO_INFORMATION
+
+    async def get_video_chunk_count(video_id):
+        return 3
+
+    monkeypatch.setattr(
+        information, "get_video_information_async", get_video_information_async
+    )
+    monkeypatch.setattr(tier, "get_video_chunk_count", get_video_chunk_count)
+    # the last segment ends at the end of the video stream
+    assert asyncio.run(manifest.get_segment_times("video")) == [0.0, 3.0, 6.0, 7.52]
+    durations = asyncio.run(manifest.get_segment_durations("video"))
+    assert [round(duration, 3) for duration in durations] == [3.0, 3.0, 1.52]
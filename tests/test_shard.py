@@ -0,0 +1,100 @@
+import pytest
+
+import config
+import shard
+
+NODES = [("redis-a", 6379), ("redis-b", 6379), ("redis-c", 6379)]
+VIDEO_IDS = [f"video-{number}" for number in range(2000)]
+
+
+@pytest.fixture(autouse=True)
+def virtual_nodes(monkeypatch):
+    monkeypatch.setattr(config, "REDIS_VIRTUAL_NODES", 160)
+
+
+def get_placement(nodes):
+    """
+    Get the node, by host and port, that stores every video.
+    """
+    ring = shard.build_ring(nodes)
+    return {
+        video_id: nodes[shard.get_node_index(video_id, ring)] for video_id in VIDEO_IDS
+    }
+
+
+def test_parse_nodes():
+    assert shard.parse_nodes("redis-a:6379, redis-b:6380,") == [
+        ("redis-a", 6379),
+        ("redis-b", 6380),
+    ]
+
+
+def test_placement_is_pinned():
+    # videos must stay on the node they were stored on across releases
+    ring = shard.build_ring(NODES)
+    assert shard.get_node_index("video-1", ring) == 2
+    assert shard.get_node_index("video-2", ring) == 1
+    assert shard.get_node_index("0f1e2d3c4b5a69788796a5b4c3d2e1f0", ring) == 0
+
+
+def test_placement_does_not_depend_on_node_order():
+    assert get_placement(NODES) == get_placement(list(reversed(NODES)))
+
+
+def test_placement_spreads_videos():
+    placement = get_placement(NODES)
+    for node in NODES:
+        assert list(placement.values()).count(node) > len(VIDEO_IDS) / 6
+
+
+def test_adding_a_node_only_moves_videos_to_it():
+    new_node = ("redis-d", 6379)
+    before = get_placement(NODES)
+    after = get_placement(NODES + [new_node])
+    moved = [video_id for video_id in VIDEO_IDS if before[video_id] != after[video_id]]
+    assert all(after[video_id] == new_node for video_id in moved)
+    assert 0 < len(moved) < len(VIDEO_IDS) / 2
+
+
+def test_removing_a_node_only_moves_its_videos():
+    before = get_placement(NODES)
+    after = get_placement(NODES[:2])
+    for video_id in VIDEO_IDS:
+        if before[video_id] != NODES[2]:
+            assert after[video_id] == before[video_id]
+
+
+def test_single_node():
+    ring = shard.build_ring(NODES[:1])
+    assert {shard.get_node_index(video_id, ring) for video_id in VIDEO_IDS} == {0}
+
+
+def test_keys_share_the_hash_tag():
+    keys = shard.get_video_keys("abc", ["video_240p"])
+    assert "video_{abc}" in keys
+    assert "video_240p_chunk_index_{abc}" in keys
+    assert all(key.endswith("_{abc}") for key in keys)
+
+
+VIDEO_ID = "0f1e2d3c4b5a69788796a5b4c3d2e1f0"
+
+
+@pytest.mark.parametrize(
+    "key, parsed",
+    [
+        (f"video_{{{VIDEO_ID}}}", ("video", VIDEO_ID)),
+        (f"audio_chunk_index_{{{VIDEO_ID}}}", ("audio_chunk_index", VIDEO_ID)),
+        (f"video_240p_{{{VIDEO_ID}}}", ("video_240p", VIDEO_ID)),
+        (
+            f"video_fmp4_chunk_index_{{{VIDEO_ID}}}",
+            ("video_fmp4_chunk_index", VIDEO_ID),
+        ),
+        (f"audio_fmp4_{{{VIDEO_ID}}}", ("audio_fmp4", VIDEO_ID)),
+        # videos stored before the data was sharded
+        (f"audio_chunks_{VIDEO_ID}", ("audio_chunks", VIDEO_ID)),
+        ("video_{abc}", None),
+        ("redis_video_list", None),
+    ],
+)
+def test_parse_key(key, parsed):
+    assert shard.parse_key(key) == parsed
@@ -0,0 +1,125 @@
+import asyncio
+import json
+
+import pytest
+
+import asyncdb
+import information
+import timeline
+
+# a video cut at its keyframes, the start time of every chunk and the end
+# time of the last chunk
+KEYFRAME_CHUNK_TIMES = [0.0, 1.927, 4.2, 6.0, 7.52]
+
+
+@pytest.fixture
+def video_information(monkeypatch):
+    """
+    Serve the given video information without redis, the chunk times of
+    videos cut at their keyframes are KEYFRAME_CHUNK_TIMES.
+    """
+    stored = {}
+
+    async def get_video_information_async(video_id):
+        return stored
+
+    async def get_redis_hash_fields(hash_name, keys):
+        return [json.dumps(KEYFRAME_CHUNK_TIMES)]
+
+    monkeypatch.setattr(
+        information, "get_video_information_async", get_video_information_async
+    )
+    monkeypatch.setattr(asyncdb, "get_redis_hash_fields", get_redis_hash_fields)
+    monkeypatch.setattr(timeline, "chunk_times_cache", {})
+    return stored
+
+
+def test_uniform_chunk_times():
+    assert timeline.get_uniform_chunk_times(10, 4) == [0.0, 4.0, 8.0, 12.0]
+    assert timeline.get_uniform_chunk_times(3, 1) == [0.0, 1.0, 2.0, 3.0, 4.0]
+
+
+def test_counted_chunk_times():
+    assert timeline.get_counted_chunk_times(3, 2, 5.5) == [0.0, 2.0, 4.0, 5.5]
+    # a whole seconds duration that ends before the start of the last chunk
+    assert timeline.get_counted_chunk_times(3, 2, 4) == [0.0, 2.0, 4.0, 6.0]
+
+
+@pytest.mark.parametrize(
+    "start, end, chunk_range",
+    [
+        (0, -1, (0, 2)),
+        (0, 3, (0, 0)),
+        (4, 4, (1, 1)),
+        (5, 9, (1, 2)),
+        (3, 8, (0, 2)),
+        (9, -1, (2, 2)),
+    ],
+)
+def test_chunk_range_with_chunk_seconds(start, end, chunk_range):
+    chunk_times = timeline.get_uniform_chunk_times(10, 4)
+    assert timeline.get_chunk_range(chunk_times, start, end) == chunk_range
+
+
+@pytest.mark.parametrize(
+    "start, end, chunk_range",
+    [
+        (0, -1, (0, 3)),
+        (0, 1, (0, 1)),
+        (0, 0, (0, 0)),
+        (1, 2, (0, 1)),
+        (2, 4, (1, 2)),
+        (6, 6, (3, 3)),
+        (7, 7, (3, 3)),
+    ],
+)
+def test_chunk_range_with_keyframe_chunk_times(start, end, chunk_range):
+    assert timeline.get_chunk_range(KEYFRAME_CHUNK_TIMES, start, end) == chunk_range
+
+
+def test_chunk_offset():
+    offset, duration = timeline.get_chunk_offset(KEYFRAME_CHUNK_TIMES, 1, 2)
+    assert offset == 1.927
+    assert duration == pytest.approx(4.073)
+    # the chunks up to the last chunk are cut without a duration
+    assert timeline.get_chunk_offset(KEYFRAME_CHUNK_TIMES, 2, 3) == (4.2, None)
+
+
+def test_chunk_start():
+    assert timeline.get_chunk_start(None, 4, 3) == 12.0
+    assert timeline.get_chunk_start(KEYFRAME_CHUNK_TIMES, 4, 3) == 6.0
+
+
+def test_chunk_durations():
+    assert timeline.get_chunk_durations([0.0, 4.0, 8.0, 10.0]) == [4.0, 4.0, 2.0]
+
+
+def test_dump_chunk_times():
+    assert timeline.dump_chunk_times(None) is None
+    assert json.loads(timeline.dump_chunk_times([0.021, 1.92749, 4.2])) == [
+        0.0,
+        1.927,
+        4.2,
+    ]
+
+
+def test_chunk_times_of_chunk_seconds(video_information):
+    video_information.update({"video_id": "video", "duration": 10, "chunk_seconds": 4})
+    chunk_times = asyncio.run(timeline.get_chunk_times("video"))
+    assert chunk_times == [0.0, 4.0, 8.0, 12.0]
+    assert timeline.get_chunk_range(chunk_times, 5, 9) == (1, 2)
+
+
+def test_chunk_times_of_older_videos(video_information):
+    video_information.update({"video_id": "video", "duration": 3})
+    assert asyncio.run(timeline.get_chunk_times("video")) == [0.0, 1.0, 2.0, 3.0, 4.0]
+
+
+def test_chunk_times_of_keyframe_chunks(video_information):
+    video_information.update(
+        {"video_id": "video", "duration": 7, "keyframe_chunks": True}
+    )
+    chunk_times = asyncio.run(timeline.get_chunk_times("video"))
+    assert chunk_times == KEYFRAME_CHUNK_TIMES
+    assert timeline.get_chunk_range(chunk_times, 2, 4) == (1, 2)
+    assert timeline.chunk_times_cache == {"video": KEYFRAME_CHUNK_TIMES}